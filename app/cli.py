@@ -0,0 +1,249 @@
+"""
+画像をまとめて検査するコマンドラインツール
+
+生成されたプログラム（code_generatorが保存するgenerated_code.pyなど）で
+ディレクトリやglobに一致する画像を検査し、画像ごとの結果をJSON Lines
+（拡張子が.csvの場合はCSV）で書き出す。最後にスループットとレイテンシ
+（p50/p95）を表示する。
+
+使い方:
+    ad-inspect app/generated_code.py images/ --workers 2 -o results.jsonl
+    ad-inspect generated_code.py "images/**/*.png" --threshold 0.4
+"""
+
+import argparse
+import csv
+import glob
+import json
+import logging
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from app.utils.code_executor import dry_run_code, execute_code
+from app.utils.metrics import percentile
+
+IMAGE_EXTENSIONS = (".png", ".jpg", ".jpeg")
+# 結果ファイルに書き出す項目
+RESULT_FIELDS = ["path", "status", "score", "message", "latency_ms", "output_text"]
+
+
+def collect_images(patterns):
+    """
+    ディレクトリ・ファイル・globのパターンから画像のパスを集める
+
+    Returns:
+        list: 重複のない画像のパス（ソート済み）
+    """
+    paths = set()
+    for pattern in patterns:
+        if os.path.isdir(pattern):
+            candidates = [
+                os.path.join(root, name)
+                for root, _, names in os.walk(pattern)
+                for name in names
+            ]
+        else:
+            candidates = glob.glob(pattern, recursive=True)
+        paths.update(
+            path
+            for path in candidates
+            if os.path.isfile(path) and path.lower().endswith(IMAGE_EXTENSIONS)
+        )
+    return sorted(paths)
+
+
+def summarize(records, elapsed):
+    """
+    検査結果の件数・スループット・レイテンシをまとめる
+
+    Args:
+        records (list): 画像ごとの結果（status, latency_msを持つ辞書）
+        elapsed (float): バッチ全体の所要時間（秒）
+    """
+    latencies = [record["latency_ms"] for record in records]
+    counts = {}
+    for record in records:
+        counts[record["status"]] = counts.get(record["status"], 0) + 1
+    return {
+        "images": len(records),
+        "counts": counts,
+        "elapsed_s": round(elapsed, 3),
+        "images_per_s": round(len(records) / elapsed, 3) if elapsed > 0 else 0.0,
+        "p50_ms": round(percentile(latencies, 50), 1),
+        "p95_ms": round(percentile(latencies, 95), 1),
+    }
+
+
+def inspect_image(code, path, box_threshold, tiled, use_cache):
+    """画像1枚を検査し、結果ファイルに書き出す形の辞書を返す"""
+    start = time.perf_counter()
+    result = execute_code(code, path, box_threshold, tiled=tiled, use_cache=use_cache)
+    return {
+        "path": path,
+        "status": result.get("status"),
+        "score": result.get("score"),
+        "message": result.get("message"),
+        "latency_ms": round((time.perf_counter() - start) * 1000, 1),
+        "output_text": result.get("output_text", ""),
+    }
+
+
+class ResultWriter:
+    """結果を1件ずつ書き出す（CSVまたはJSON Lines）"""
+
+    def __init__(self, file, as_csv=False):
+        self._file = file
+        self._csv = None
+        if as_csv:
+            self._csv = csv.DictWriter(file, fieldnames=RESULT_FIELDS)
+            self._csv.writeheader()
+
+    def write(self, record):
+        if self._csv is not None:
+            self._csv.writerow(record)
+        else:
+            self._file.write(json.dumps(record, ensure_ascii=False) + "\n")
+        self._file.flush()
+
+
+def run_batch(
+    code,
+    image_paths,
+    box_threshold=0.3,
+    workers=1,
+    tiled=False,
+    use_cache=True,
+    on_result=None,
+):
+    """
+    画像をworkers並列で検査する
+
+    Args:
+        code (str): 実行するプログラム
+        image_paths (list): 検査する画像のパス
+        box_threshold (float, optional): 物体検出のしきい値
+        workers (int, optional): 同時に検査する画像数
+        tiled (bool, optional): タイル検出を使うか
+        use_cache (bool, optional): 実行結果のキャッシュを使うか
+        on_result (callable, optional): 1枚終わるたびに呼ばれる on_result(record)
+
+    Returns:
+        tuple: (完了順の結果のリスト, 全体の所要時間（秒）)
+    """
+    records = []
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+        futures = [
+            executor.submit(inspect_image, code, path, box_threshold, tiled, use_cache)
+            for path in image_paths
+        ]
+        for future in as_completed(futures):
+            record = future.result()
+            records.append(record)
+            if on_result is not None:
+                on_result(record)
+    return records, time.perf_counter() - start
+
+
+def _progress(done, total, start, stream):
+    elapsed = time.perf_counter() - start
+    rate = done / elapsed if elapsed > 0 else 0.0
+    stream.write(f"\r[{done}/{total}] {rate:.2f} 枚/秒")
+    stream.flush()
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(
+        prog="ad-inspect", description="生成されたプログラムで画像をまとめて検査する"
+    )
+    parser.add_argument("program", help="検査に使うプログラムのファイル")
+    parser.add_argument(
+        "images", nargs="+", help="画像のファイル・ディレクトリ・globパターン"
+    )
+    parser.add_argument(
+        "--threshold", type=float, default=0.3, help="物体検出のしきい値"
+    )
+    parser.add_argument("--workers", type=int, default=1, help="同時に検査する画像数")
+    parser.add_argument(
+        "-o",
+        "--output",
+        default="results.jsonl",
+        help="結果の出力先（.csvならCSV、それ以外はJSON Lines）",
+    )
+    parser.add_argument("--tiled", action="store_true", help="タイル検出を使う")
+    parser.add_argument(
+        "--no-cache", action="store_true", help="実行結果のキャッシュを使わない"
+    )
+    parser.add_argument("--quiet", action="store_true", help="進捗を表示しない")
+    parser.add_argument("--verbose", action="store_true", help="実行ログを表示する")
+    return parser
+
+
+def main(argv=None):
+    """
+    コマンドラインのエントリポイント
+
+    Returns:
+        int: 終了コード（0: 完了、1: エラーになった画像がある、2: 入力エラー）
+    """
+    args = build_parser().parse_args(argv)
+    # 実行ごとのINFOログで進捗表示が流れないよう、--verbose以外は警告以上のみ出す
+    logging.getLogger().setLevel(logging.INFO if args.verbose else logging.WARNING)
+
+    try:
+        with open(args.program, encoding="utf-8") as f:
+            code = f.read()
+    except OSError as e:
+        print(f"プログラムを読み込めません: {e}", file=sys.stderr)
+        return 2
+    try:
+        dry_run_code(code)
+    except ValueError as e:
+        print(f"プログラムを実行できません: {e}", file=sys.stderr)
+        return 2
+
+    image_paths = collect_images(args.images)
+    if not image_paths:
+        print("検査する画像が見つかりません", file=sys.stderr)
+        return 2
+
+    start = time.perf_counter()
+    done = 0
+
+    with open(args.output, "w", encoding="utf-8", newline="") as f:
+        writer = ResultWriter(f, as_csv=args.output.lower().endswith(".csv"))
+
+        def on_result(record):
+            nonlocal done
+            done += 1
+            writer.write(record)
+            if not args.quiet:
+                _progress(done, len(image_paths), start, sys.stderr)
+
+        records, elapsed = run_batch(
+            code,
+            image_paths,
+            box_threshold=args.threshold,
+            workers=args.workers,
+            tiled=args.tiled,
+            use_cache=not args.no_cache,
+            on_result=on_result,
+        )
+    if not args.quiet:
+        sys.stderr.write("\n")
+
+    summary = summarize(records, elapsed)
+    counts = ", ".join(f"{status}: {n}" for status, n in summary["counts"].items())
+    print(f"{summary['images']}枚を検査しました（{counts}）")
+    print(
+        f"所要時間 {summary['elapsed_s']:.2f}秒, {summary['images_per_s']:.2f} 枚/秒, "
+        f"p50 {summary['p50_ms']:.1f}ms, p95 {summary['p95_ms']:.1f}ms"
+    )
+    print(f"結果: {args.output}")
+    return 1 if summary["counts"].get("error") else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,13 +1,28 @@
 import logging
 import os
+import time
+from datetime import datetime
 
 import streamlit as st
-from PIL import Image
 
 # セキュリティモジュールのインポート
 from security import IsolatedSessionState, SecureSessionManager
 from utils.code_executor import check_memory_usage, execute_code
-from utils.code_generator import generate_anomaly_detection_code
+from utils.code_generator import (
+    combine_conditions,
+    generate_anomaly_detection_code_stream,
+    generate_per_condition_code,
+    generate_speculative_code,
+)
+from utils.detection_warmup import DETECTION_WARMUP, warm_detection
+from utils.image_cache import get_image_cache
+from utils.inspection_api import start_api_server
+from utils.job_manager import CANCELLED, DONE, PENDING, get_job_manager
+from utils.metrics import start_metrics_server
+from utils.profiling import format_hotspots
+from utils.resource_monitor import get_resource_monitor, start_resource_monitor
+from utils.result_cache import get_result_cache
+from utils.timing import format_timings
 
 # ページ設定
 st.set_page_config(
@@ -16,6 +31,13 @@ st.set_page_config(
 
 logger = logging.getLogger(__name__)
 
+# METRICS_PORTが設定されていれば、別ポートで /metrics を公開する（プロセスで1回だけ）
+start_metrics_server()
+# API_PORTが設定されていれば、画面と同じモデルを使う検査APIも公開する
+start_api_server()
+# メモリ・CPUの使用量をバックグラウンドで記録する（再実行ごとの取得をなくす）
+start_resource_monitor()
+
 # CSSスタイルの追加（ローカル環境対応）
 st.markdown(
     """
@@ -117,7 +139,10 @@ def initialize_security_components():
     """セキュリティコンポーネントを適切な順序で初期化"""
     try:
         # 1. SecureSessionManagerを初期化（これがsession_idを作成）
-        security_manager = SecureSessionManager()
+        # セッションの終了時にはそのセッションのジョブもキャンセルして削除する
+        security_manager = SecureSessionManager(
+            on_cleanup=get_job_manager().clear_session
+        )
 
         # 2. セッションが初期化されたことを確認
         if not st.session_state.get("session_initialized", False):
@@ -286,7 +311,8 @@ with col1:
     # 現在の画像の小さな表示
     current_path = isolated_state.get_uploaded_image_path()
     if current_path and os.path.exists(current_path):
-        current_image = Image.open(current_path)
+        # 再実行ごとのデコードを避けるため共有キャッシュのサムネイルを使用
+        current_image = get_image_cache().get_preview(current_path)
         st.image(current_image, caption="現在の画像", width=200)
 
     uploaded_file = st.file_uploader(
@@ -400,12 +426,50 @@ with col3:
     if new_threshold != current_threshold:
         isolated_state.set_box_threshold(new_threshold)
 
+    current_tiled = isolated_state.get_tiled_detection()
+    new_tiled = st.checkbox(
+        "高解像度タイル検出",
+        value=current_tiled,
+        help="大きな画像をタイルに分割して検出します（小さな欠陥向け・処理時間増）",
+        key="tiled_secure",
+    )
+    if new_tiled != current_tiled:
+        isolated_state.set_tiled_detection(new_tiled)
+
+    current_per_condition = isolated_state.get_per_condition_generation()
+    new_per_condition = st.checkbox(
+        "条件ごとに並列生成",
+        value=current_per_condition,
+        help="条件ごとに関数を同時に生成して組み合わせます（変更した条件だけ再生成）",
+        key="per_condition_secure",
+    )
+    if new_per_condition != current_per_condition:
+        isolated_state.set_per_condition_generation(new_per_condition)
+
+    current_candidates = isolated_state.get_generation_candidates()
+    new_candidates = st.number_input(
+        "同時生成する候補数",
+        min_value=1,
+        max_value=5,
+        value=current_candidates,
+        help="複数の候補を同時に生成し、最初に検証を通過したものを採用します（API利用量が増えます）",
+        key="candidates_secure",
+    )
+    if new_candidates != current_candidates:
+        isolated_state.set_generation_candidates(int(new_candidates))
+
     generate_button = st.button(
         "🚀 プログラム生成",
         type="primary",
         disabled=not (new_api_key and conditions_valid),
         use_container_width=True,
     )
+    # 同じ条件の生成結果はキャッシュから返すため、作り直したい場合のボタン
+    regenerate_button = st.button(
+        "🔄 キャッシュを使わずに再生成",
+        disabled=not (new_api_key and conditions_valid and code_exists),
+        use_container_width=True,
+    )
 
     # ステップ5: プログラム実行
     step5_status = get_step_status(
@@ -423,34 +487,112 @@ with col3:
         unsafe_allow_html=True,
     )
 
+    profile_requested = st.checkbox(
+        "実行をプロファイル",
+        value=False,
+        help="cProfileとtorchのプロファイラで時間のかかっている関数を調べます（キャッシュを使わずに実行）",
+        key="profile_secure",
+    )
+
     execute_button = st.button(
         "▶️ 実行", type="primary", disabled=not code_exists, use_container_width=True
     )
 
-# 生成処理
-if generate_button and conditions_valid:
-    combined_conditions = "\n".join(
-        [f"- {condition.strip()}" for condition in valid_conditions]
+# 生成・実行はバックグラウンドのジョブで行い、画面はポーリングで進捗を表示する
+job_manager = get_job_manager()
+JOB_POLL_INTERVAL = 1.0
+
+
+def run_generation_job(job, conditions, api_key, per_condition, candidates, use_cache):
+    """生成ジョブの本体（ワーカースレッドで実行するためsession_stateは使わない）"""
+    if per_condition:
+        # 条件ごとに並列生成して組み合わせる
+        return generate_per_condition_code(
+            conditions, api_key, use_cache=use_cache, should_stop=job.cancelled
+        )
+    combined_conditions = combine_conditions(conditions)
+    if candidates > 1:
+        # 複数の候補を同時に生成し、最初に有効だったものを使う
+        return generate_speculative_code(
+            combined_conditions,
+            api_key,
+            candidates=candidates,
+            use_cache=use_cache,
+            should_stop=job.cancelled,
+        )
+    return generate_anomaly_detection_code_stream(
+        combined_conditions,
+        api_key,
+        on_text=job.set_progress,
+        use_cache=use_cache,
+        should_stop=job.cancelled,
     )
 
-    with st.spinner("🤖 AIがプログラムを生成中..."):
-        try:
-            # セキュアなAPIキー取得
-            secure_api_key = security_manager.get_api_key()
-            if not secure_api_key:
-                st.error("❌ APIキーが設定されていません")
-            else:
-                generated_code = generate_anomaly_detection_code(
-                    combined_conditions, secure_api_key
-                )
-                isolated_state.set_generated_code(generated_code)
-                st.success("✅ プログラム生成完了！")
-                st.rerun()
-        except ValueError as e:
-            st.warning(f"⚠️ 入力エラー: {str(e)}")
-        except Exception:
-            logger.exception("コード生成中にエラーが発生")
-            st.error("❌ コード生成に失敗しました。時間をおいて再試行してください。")
+
+def run_warmup_job(job, conditions, image_path, box_threshold, tiled):
+    """生成中に条件の物体名で検出モデルとキャッシュを温めるジョブ"""
+    return warm_detection(
+        combine_conditions(conditions),
+        image_path,
+        box_threshold,
+        tiled=tiled,
+        should_stop=job.cancelled,
+    )
+
+
+def run_execution_job(
+    job, code, image_path, box_threshold, tiled, session_id, profile_path=None
+):
+    """実行ジョブの本体（profile_pathを指定するとプロファイルを取る）"""
+
+    def on_wait(position):
+        # メモリの空きを待つ間は順番を画面に表示する（受け付けられたら消す）
+        job.set_progress(
+            f"メモリの空きを待っています（{position}番目）" if position else ""
+        )
+
+    return execute_code(
+        code,
+        image_path,
+        box_threshold,
+        tiled=tiled,
+        session_id=session_id,
+        profile="all" if profile_path else None,
+        profile_path=profile_path,
+        on_wait=on_wait,
+        should_stop=job.cancelled,
+    )
+
+
+# 生成処理
+if (generate_button or regenerate_button) and conditions_valid:
+    # セキュアなAPIキー取得
+    secure_api_key = security_manager.get_api_key()
+    if not secure_api_key:
+        st.error("❌ APIキーが設定されていません")
+    else:
+        job_manager.submit(
+            isolated_state.session_id,
+            "generate",
+            run_generation_job,
+            valid_conditions,
+            secure_api_key,
+            isolated_state.get_per_condition_generation(),
+            isolated_state.get_generation_candidates(),
+            not regenerate_button,
+        )
+        # 生成を待つ間に、アップロード済みの画像で検出の準備を進める
+        warmup_image_path = isolated_state.get_uploaded_image_path()
+        if DETECTION_WARMUP and warmup_image_path and os.path.exists(warmup_image_path):
+            job_manager.submit(
+                isolated_state.session_id,
+                "warmup",
+                run_warmup_job,
+                valid_conditions,
+                warmup_image_path,
+                isolated_state.get_box_threshold(),
+                isolated_state.get_tiled_detection(),
+            )
 
 # 実行処理 - セキュア版
 current_code = isolated_state.get_generated_code()
@@ -461,35 +603,139 @@ if execute_button and current_code:
     st.rerun()
 
 if execute_requested and current_code:
-    with st.spinner("▶️ プログラムを実行中..."):
-        try:
-            # セキュアな画像パス取得
-            image_path = isolated_state.get_uploaded_image_path()
-            if not image_path or not os.path.exists(image_path):
-                default_image_path = os.path.join(
-                    os.path.dirname(__file__), "utils", "apple_strawberry.png"
-                )
-                if os.path.exists(default_image_path):
-                    image_path = default_image_path
-                else:
-                    st.error("画像が見つかりません。")
-                    st.stop()
+    isolated_state.set_execute_requested(False)
+    # セキュアな画像パス取得
+    image_path = isolated_state.get_uploaded_image_path()
+    if not image_path or not os.path.exists(image_path):
+        default_image_path = os.path.join(
+            os.path.dirname(__file__), "utils", "apple_strawberry.png"
+        )
+        if os.path.exists(default_image_path):
+            image_path = default_image_path
+        else:
+            st.error("画像が見つかりません。")
+            st.stop()
 
-            execution_result = execute_code(
-                current_code,
-                image_path,
-                isolated_state.get_box_threshold(),
-            )
-            isolated_state.set_execution_result(execution_result)
-            st.success("✅ 実行完了！")
-            isolated_state.set_execute_requested(False)
+    # 実行が始まったら、まだ検出していない推測クエリのウォームアップは止める
+    warmup_job = job_manager.latest(isolated_state.session_id, "warmup")
+    if warmup_job is not None:
+        job_manager.cancel(warmup_job.id)
+
+    # プロファイルはセッション専用のディレクトリに保存する（ジョブのスレッドからは
+    # セッションの状態を参照できないため、ここでパスを決めておく）
+    profile_path = None
+    if profile_requested:
+        profile_path = security_manager.get_secure_file_path(
+            f"profile_{int(time.time())}"
+        )
+
+    job_manager.submit(
+        isolated_state.session_id,
+        "execute",
+        run_execution_job,
+        current_code,
+        image_path,
+        isolated_state.get_box_threshold(),
+        isolated_state.get_tiled_detection(),
+        isolated_state.session_id,
+        profile_path,
+    )
+
+# 終了したジョブの結果をセッションに反映する
+generation_job = job_manager.latest(isolated_state.session_id, "generate")
+if generation_job and generation_job.done and not generation_job.acknowledged:
+    job_manager.acknowledge(generation_job.id)
+    if generation_job.status == DONE:
+        isolated_state.set_generated_code(generation_job.result)
+        st.success("✅ プログラム生成完了！")
+        st.rerun()
+    elif generation_job.status == CANCELLED:
+        st.info("⏹ コード生成をキャンセルしました")
+    elif isinstance(generation_job.error, ValueError):
+        st.warning(f"⚠️ 入力エラー: {str(generation_job.error)}")
+    else:
+        logger.error(f"コード生成中にエラーが発生: {generation_job.error!r}")
+        st.error("❌ コード生成に失敗しました。時間をおいて再試行してください。")
+
+execution_job = job_manager.latest(isolated_state.session_id, "execute")
+if execution_job and execution_job.done and not execution_job.acknowledged:
+    job_manager.acknowledge(execution_job.id)
+    if execution_job.status == DONE:
+        isolated_state.set_execution_result(execution_job.result)
+        st.success("✅ 実行完了！")
+    elif execution_job.status == CANCELLED:
+        st.info("⏹ 実行をキャンセルしました")
+    else:
+        logger.error(f"実行中にエラーが発生: {execution_job.error!r}")
+        st.error("❌ 実行中にエラーが発生しました。設定を見直して再試行してください。")
+
+active_jobs = [
+    job for job in (generation_job, execution_job) if job is not None and not job.done
+]
+
+
+def render_active_jobs():
+    """実行中のジョブの進捗を表示し、終了したら画面全体を再実行する"""
+    for job in active_jobs:
+        if job.done:
             st.rerun()
-        except Exception:
-            logger.exception("実行中にエラーが発生")
-            st.error(
-                "❌ 実行中にエラーが発生しました。設定を見直して再試行してください。"
+        if job.status == PENDING:
+            # 同じ種類のジョブが埋まっていて、まだ開始していない
+            action = "生成" if job.kind == "generate" else "実行"
+            label = f"⏳ {action}の開始を待っています"
+            seconds = job.queued_for()
+        elif job.kind == "generate":
+            label = "🤖 AIがプログラムを生成中"
+            seconds = job.elapsed()
+        else:
+            label = "▶️ プログラムを実行中"
+            seconds = job.elapsed()
+        status_col, cancel_col = st.columns([4, 1])
+        with status_col:
+            st.info(f"{label}...（{seconds:.0f}秒）")
+        with cancel_col:
+            if st.button(
+                "⏹ キャンセル", key=f"cancel_{job.kind}", use_container_width=True
+            ):
+                job_manager.cancel(job.id)
+                st.rerun()
+        if job.kind == "execute" and job.progress:
+            st.caption(f"⏳ {job.progress}")
+        if job.kind == "generate" and job.progress:
+            # 生成中のコードを逐次表示する
+            st.code(
+                job.progress.replace("```python", "").replace("```", ""),
+                language="python",
             )
-            isolated_state.set_execute_requested(False)
+
+
+if active_jobs:
+    st.fragment(run_every=JOB_POLL_INTERVAL)(render_active_jobs)()
+
+
+def render_profile(profile):
+    """プロファイルの上位の関数と、保存したファイルのダウンロードを表示する"""
+    with st.expander("🔍 プロファイル", expanded=True):
+        if profile.get("error"):
+            st.warning(profile["error"])
+        titles = {
+            "cprofile": "Pythonの関数（累積時間順）",
+            "torch": "PyTorchの演算子（CPU時間順）",
+        }
+        for name, rows in profile.get("hotspots", {}).items():
+            if rows:
+                st.caption(titles.get(name, name))
+                st.code(format_hotspots(rows), language="text")
+        for name, path in profile.get("files", {}).items():
+            if os.path.exists(path):
+                with open(path, "rb") as f:
+                    st.download_button(
+                        label=f"📥 {os.path.basename(path)}",
+                        data=f.read(),
+                        file_name=os.path.basename(path),
+                        key=f"download_profile_{name}",
+                    )
+
 
 # 結果表示エリア（画面下部）- セキュア版
 current_generated_code = isolated_state.get_generated_code()
@@ -531,9 +777,24 @@ if current_generated_code or current_execution_result:
                 else:
                     st.error(f"❌ エラー: {result.get('message', 'システムエラー')}")
 
-            if "output_text" in result and result["output_text"]:
+            if result.get("cached"):
+                st.caption("⚡ 同じ条件の前回の実行結果を表示しています")
+                if st.button("🔄 キャッシュを使わずに再実行", key="rerun_uncached"):
+                    get_result_cache().invalidate_session(isolated_state.session_id)
+                    isolated_state.set_execute_requested(True)
+                    st.rerun()
+
+            if result.get("output_text") or result.get("timings"):
                 with st.expander("詳細出力", expanded=False):
-                    st.code(result["output_text"], language="text")
+                    if result.get("output_text"):
+                        st.code(result["output_text"], language="text")
+                    if result.get("timings"):
+                        # 段階ごとの所要時間（インデントは呼び出しの階層）
+                        st.caption("⏱ 所要時間の内訳")
+                        st.code(format_timings(result["timings"]), language="text")
+
+            if result.get("profile"):
+                render_profile(result["profile"])
 
 # フッター
 if not (current_generated_code or current_execution_result):
@@ -551,3 +812,34 @@ if not (current_generated_code or current_execution_result):
                 st.json(security_info)
             with col_sec2:
                 st.json(session_summary)
+
+
+def render_resource_trends():
+    """直近のメモリ・CPU使用量の推移を表示する（サンプラーの記録を読むだけ）"""
+    history = get_resource_monitor().history()
+    if not history:
+        st.caption("リソースの記録はまだありません")
+        return
+    times = [datetime.fromtimestamp(record["time"]) for record in history]
+    st.caption("メモリ・CPU使用率（%）")
+    st.line_chart(
+        {
+            "時刻": times,
+            "メモリ": [record["memory_percent"] for record in history],
+            "CPU": [record["cpu_percent"] for record in history],
+        },
+        x="時刻",
+    )
+    st.caption("プロセスのRSS（MB）")
+    st.line_chart(
+        {
+            "時刻": times,
+            "RSS": [record["rss_bytes"] / 2**20 for record in history],
+        },
+        x="時刻",
+    )
+
+
+if st.checkbox("リソースの推移を表示", key="show_resource_trends"):
+    with st.expander("📈 リソースの推移", expanded=True):
+        st.fragment(run_every=5)(render_resource_trends)()
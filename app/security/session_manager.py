@@ -22,9 +22,16 @@ class SecureSessionManager:
     4. Sessions are properly cleaned up
     """
 
-    def __init__(self):
-        """Initialize secure session manager."""
+    def __init__(self, on_cleanup=None):
+        """
+        Initialize secure session manager.
+
+        Args:
+            on_cleanup: Optional callback called with the session ID when the
+                session is cleaned up (e.g. to cancel the session's jobs)
+        """
         self.crypto = CryptoUtils()
+        self.on_cleanup = on_cleanup
         self._initialize_session()
 
     def _initialize_session(self) -> None:
@@ -183,6 +190,11 @@ class SecureSessionManager:
     def cleanup_session(self) -> None:
         """Clean up session data and temporary files."""
         try:
+            # Release resources held for this session outside session_state
+            session_id = st.session_state.get("secure_session_id")
+            if session_id and self.on_cleanup is not None:
+                self.on_cleanup(session_id)
+
             # Clear API key
             self.clear_api_key()
 
@@ -51,6 +51,9 @@ class IsolatedSessionState:
         self._init_if_not_exists("normal_conditions", [""])
         self._init_if_not_exists("box_threshold", 0.3)
         self._init_if_not_exists("execute_requested", False)
+        self._init_if_not_exists("tiled_detection", False)
+        self._init_if_not_exists("per_condition_generation", False)
+        self._init_if_not_exists("generation_candidates", 1)
 
     def _init_if_not_exists(self, key: str, default_value: Any) -> None:
         """Initialize a session state variable if it doesn't exist."""
@@ -125,6 +128,36 @@ class IsolatedSessionState:
         isolated_key = self._get_isolated_key("execute_requested")
         return st.session_state.get(isolated_key, False)
 
+    def set_tiled_detection(self, enabled: bool) -> None:
+        """Set tiled detection flag for this session only."""
+        isolated_key = self._get_isolated_key("tiled_detection")
+        st.session_state[isolated_key] = enabled
+
+    def get_tiled_detection(self) -> bool:
+        """Get tiled detection flag for this session."""
+        isolated_key = self._get_isolated_key("tiled_detection")
+        return st.session_state.get(isolated_key, False)
+
+    def set_per_condition_generation(self, enabled: bool) -> None:
+        """Set per-condition generation flag for this session only."""
+        isolated_key = self._get_isolated_key("per_condition_generation")
+        st.session_state[isolated_key] = enabled
+
+    def get_per_condition_generation(self) -> bool:
+        """Get per-condition generation flag for this session."""
+        isolated_key = self._get_isolated_key("per_condition_generation")
+        return st.session_state.get(isolated_key, False)
+
+    def set_generation_candidates(self, candidates: int) -> None:
+        """Set the number of speculative generation candidates for this session only."""
+        isolated_key = self._get_isolated_key("generation_candidates")
+        st.session_state[isolated_key] = candidates
+
+    def get_generation_candidates(self) -> int:
+        """Get the number of speculative generation candidates for this session."""
+        isolated_key = self._get_isolated_key("generation_candidates")
+        return st.session_state.get(isolated_key, 1)
+
     def clear_all_data(self) -> None:
         """Clear all isolated data for this session."""
         keys_to_clear = [
@@ -134,6 +167,9 @@ class IsolatedSessionState:
             "normal_conditions",
             "box_threshold",
             "execute_requested",
+            "tiled_detection",
+            "per_condition_generation",
+            "generation_candidates",
         ]
 
         for key in keys_to_clear:
@@ -172,6 +208,9 @@ class IsolatedSessionState:
             ),
             "box_threshold": self.get_box_threshold(),
             "execute_requested": self.get_execute_requested(),
+            "tiled_detection": self.get_tiled_detection(),
+            "per_condition_generation": self.get_per_condition_generation(),
+            "generation_candidates": self.get_generation_candidates(),
             "total_session_keys": len(self.get_all_session_keys()),
         }
 
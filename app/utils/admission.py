@@ -0,0 +1,285 @@
+"""
+メモリに基づく実行の受け付け（アドミッション制御）
+
+コンテナのメモリ（Cloud Runでは2Gi）に対して、同時に始まった実行が
+それぞれ画像と推論の中間データを確保すると、全員がメモリ不足になる。
+実行ごとに必要なメモリ（画像サイズ × 読み込み時の解像度の方針 + 推論の
+作業領域）を見積もり、モデルと実行中の見積もりの合計が予算を超える場合は
+到着順に待たせる。待っている間は何番目かを呼び出し元に知らせる。
+
+- 実行中のものがなければ、見積もりが予算を超えていても1件は実行する
+- リソースのサンプラーが動作中は、実際の空きメモリが見積もりより少ない間も待つ
+"""
+
+import logging
+import os
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+
+import psutil
+
+from .detector_backend import get_detector_backend
+from .resource_monitor import get_resource_monitor
+
+logger = logging.getLogger(__name__)
+
+# アドミッション制御を使うか（"0"で無効）
+ADMISSION_CONTROL = os.environ.get("ADMISSION_CONTROL", "1") != "0"
+# モデルと実行に使えるメモリ（MB）。未設定ならコンテナの上限 × ADMISSION_MEMORY_FRACTION
+ADMISSION_MEMORY_BUDGET_MB = int(os.environ.get("ADMISSION_MEMORY_BUDGET_MB", "0"))
+# 予算を自動で決める場合に使うメモリの上限の割合（残りはPython・Streamlit自体の分）
+ADMISSION_MEMORY_FRACTION = float(os.environ.get("ADMISSION_MEMORY_FRACTION", "0.75"))
+# 未ロードのモデルの見積もり（MB。grounding-dino-tinyのfp32の重みが約700MB）
+ADMISSION_MODEL_MB = int(os.environ.get("ADMISSION_MODEL_MB", "800"))
+# 1回の推論（forward）の中間データの見積もり（MB）
+ADMISSION_INFERENCE_MB = int(os.environ.get("ADMISSION_INFERENCE_MB", "256"))
+# 受け付けを待つ最大の秒数
+ADMISSION_TIMEOUT = float(os.environ.get("ADMISSION_TIMEOUT", "300"))
+
+MB = 1024 * 1024
+# Grounding DINOのプロセッサのリサイズ後の最大サイズ（短辺800・長辺1333）
+PROCESSOR_SHORTEST_EDGE = 800
+PROCESSOR_LONGEST_EDGE = 1333
+
+
+class AdmissionTimeoutError(Exception):
+    """待ち時間の上限までに受け付けられなかった"""
+
+
+class AdmissionCancelledError(Exception):
+    """受け付けを待っている間にキャンセルされた"""
+
+
+def container_memory_limit():
+    """コンテナ（cgroup）のメモリ上限のバイト数。上限がなければ物理メモリの総量"""
+    total = psutil.virtual_memory().total
+    for path in (
+        "/sys/fs/cgroup/memory.max",  # cgroup v2
+        "/sys/fs/cgroup/memory/memory.limit_in_bytes",  # cgroup v1
+    ):
+        try:
+            with open(path) as f:
+                value = f.read().strip()
+        except OSError:
+            continue
+        if value.isdigit() and 0 < int(value) < total:
+            return int(value)
+    return total
+
+
+def default_memory_budget():
+    """予算のデフォルト値（バイト）"""
+    if ADMISSION_MEMORY_BUDGET_MB > 0:
+        return ADMISSION_MEMORY_BUDGET_MB * MB
+    return int(container_memory_limit() * ADMISSION_MEMORY_FRACTION)
+
+
+def _processor_pixels(width, height):
+    """プロセッサがリサイズした後の画素数"""
+    scale = PROCESSOR_SHORTEST_EDGE / max(1, min(width, height))
+    scale = min(scale, PROCESSOR_LONGEST_EDGE / max(1, width, height))
+    return int(width * scale) * int(height * scale)
+
+
+def estimate_execution_memory(
+    image_size,
+    tiled=False,
+    max_image_side=None,
+    tile_size=800,
+    max_batch=4,
+    inference_bytes=None,
+):
+    """
+    1回の実行に必要なメモリを見積もる（モデル自体は含まない）
+
+    Args:
+        image_size (tuple): 元画像の (幅, 高さ)
+        tiled (bool): タイル検出を使うか（縮小せずに読み込み、タイルをまとめて推論する）
+        max_image_side (int, optional): 読み込み時の最大辺（0・Noneなら縮小しない）
+        tile_size (int): タイルの辺の長さ
+        max_batch (int): 1回の推論でまとめるタイル数
+        inference_bytes (int, optional): 1回の推論の中間データ。省略時はADMISSION_INFERENCE_MB
+
+    Returns:
+        int: バイト数
+    """
+    width, height = image_size
+    if not tiled and max_image_side and max(width, height) > max_image_side:
+        scale = max_image_side / max(width, height)
+        width, height = int(width * scale), int(height * scale)
+
+    decoded = width * height * 3  # RGBの画像
+    if tiled and max(width, height) > tile_size:
+        batch = max_batch
+        pixels = _processor_pixels(tile_size, tile_size)
+    else:
+        batch = 1
+        pixels = _processor_pixels(width, height)
+    pixel_values = batch * pixels * 3 * 4  # float32のpixel_values
+    if inference_bytes is None:
+        inference_bytes = ADMISSION_INFERENCE_MB * MB
+    return decoded + pixel_values + batch * inference_bytes
+
+
+def model_memory():
+    """検出モデルのメモリ（ロード済みなら実際の値、未ロードなら見積もり）"""
+    footprint = get_detector_backend().memory_footprint()
+    return footprint if footprint > 0 else ADMISSION_MODEL_MB * MB
+
+
+class Ticket:
+    """受け付けを待つ1回の実行"""
+
+    def __init__(self, estimate):
+        self.id = uuid.uuid4().hex
+        self.estimate = estimate
+        self.created_at = time.monotonic()
+
+
+class AdmissionController:
+    """見積もりメモリの予算内で実行を到着順に受け付ける"""
+
+    def __init__(
+        self,
+        budget_bytes=None,
+        model_bytes=model_memory,
+        timeout=ADMISSION_TIMEOUT,
+        poll_interval=0.5,
+        monitor=None,
+    ):
+        """
+        Args:
+            budget_bytes (int, optional): モデルと実行に使えるメモリ。省略時はdefault_memory_budget()
+            model_bytes (callable): モデルのメモリのバイト数を返す関数
+            timeout (float): 受け付けを待つ最大の秒数
+            poll_interval (float): 空きメモリ・キャンセルを確認する間隔（秒）
+            monitor (ResourceMonitor, optional): 実際の空きメモリを参照するサンプラー
+        """
+        self.budget_bytes = budget_bytes or default_memory_budget()
+        self.model_bytes = model_bytes
+        self.timeout = timeout
+        self.poll_interval = poll_interval
+        self.monitor = monitor
+        self._waiting = []  # 到着順のTicket
+        self._running = {}  # ticket_id -> 見積もり
+        self._condition = threading.Condition()
+        self.admitted = 0
+        self.queued = 0  # 待たされた実行の数
+
+    def _fits(self, ticket):
+        """先頭のticketを今受け付けられるか（ロック保持中に呼ぶ）"""
+        if self._waiting[0] is not ticket:
+            return False
+        if not self._running:
+            return True
+        reserved = sum(self._running.values())
+        if reserved + ticket.estimate > self.budget_bytes - self.model_bytes():
+            return False
+        # 見積もりが外れて実際の空きが少ない場合も待つ
+        if self.monitor is not None and self.monitor.is_fresh():
+            recent = self.monitor.smoothed()
+            if recent is not None and recent["available_bytes"] < ticket.estimate:
+                return False
+        return True
+
+    def position(self, ticket):
+        """待ち行列での順番（1始まり。受け付け済みなら0）"""
+        with self._condition:
+            if ticket in self._waiting:
+                return self._waiting.index(ticket) + 1
+            return 0
+
+    @contextmanager
+    def admit(self, estimate, on_wait=None, should_stop=None, timeout=None):
+        """
+        予算に空きができるまで待ってから実行枠を確保する
+
+        Args:
+            estimate (int): 実行に必要なメモリの見積もり（バイト）
+            on_wait (callable, optional): 待つ間、順番が変わるたびに呼ばれる
+                on_wait(順番)。受け付けられると on_wait(0)
+            should_stop (callable, optional): Trueを返したら待つのをやめる
+            timeout (float, optional): 待つ最大の秒数。省略時はコンストラクタの値
+
+        Raises:
+            AdmissionTimeoutError: 待ち時間の上限を超えた
+            AdmissionCancelledError: 待っている間にキャンセルされた
+        """
+        timeout = self.timeout if timeout is None else timeout
+        ticket = Ticket(estimate)
+        deadline = time.monotonic() + timeout
+        last_position = None
+        with self._condition:
+            self._waiting.append(ticket)
+            try:
+                while not self._fits(ticket):
+                    position = self._waiting.index(ticket) + 1
+                    if last_position is None:
+                        self.queued += 1
+                        logger.info(
+                            f"メモリの予算を待機: {position}番目 "
+                            f"(見積もり {estimate / MB:.0f}MB)"
+                        )
+                    if position != last_position and on_wait is not None:
+                        on_wait(position)
+                    last_position = position
+                    if should_stop is not None and should_stop():
+                        raise AdmissionCancelledError(
+                            "受け付けを待つ間にキャンセルされました"
+                        )
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        raise AdmissionTimeoutError(
+                            f"{timeout:.0f}秒待っても実行できませんでした"
+                        )
+                    self._condition.wait(min(self.poll_interval, remaining))
+            finally:
+                self._waiting.remove(ticket)
+                # 先頭が抜けたら次の実行が受け付けられるかもしれない
+                self._condition.notify_all()
+            self._running[ticket.id] = estimate
+            self.admitted += 1
+        # 待たずに受け付けた場合も知らせる（共有していた実行が中断され、
+        # 順番を表示したまま改めて実行する場合など）
+        if on_wait is not None:
+            on_wait(0)
+
+        try:
+            yield ticket
+        finally:
+            with self._condition:
+                del self._running[ticket.id]
+                self._condition.notify_all()
+
+    def stats(self):
+        with self._condition:
+            return {
+                "budget_bytes": self.budget_bytes,
+                "model_bytes": self.model_bytes(),
+                "reserved_bytes": sum(self._running.values()),
+                "running": len(self._running),
+                "waiting": len(self._waiting),
+                "admitted": self.admitted,
+                "queued": self.queued,
+            }
+
+
+_admission_controller = None
+_admission_controller_lock = threading.Lock()
+
+
+def get_admission_controller():
+    """プロセス全体で共有するアドミッション制御を返す"""
+    global _admission_controller
+    if _admission_controller is None:
+        with _admission_controller_lock:
+            if _admission_controller is None:
+                _admission_controller = AdmissionController(
+                    monitor=get_resource_monitor()
+                )
+                logger.info(
+                    f"実行のメモリ予算: {_admission_controller.budget_bytes / MB:.0f}MB"
+                )
+    return _admission_controller
@@ -0,0 +1,139 @@
+"""
+プロセス内で共有するサイズ上限付きキャッシュ
+"""
+
+import sys
+import threading
+import time
+from collections import OrderedDict
+
+
+class BoundedCache:
+    """
+    スレッドセーフなLRUキャッシュ
+
+    エントリの合計バイト数がmax_bytesを、エントリ数がmax_entriesを超えると
+    最も古く使われたエントリから削除する。ttlを指定すると、保存からttl秒
+    経過したエントリは期限切れとして扱う。
+    """
+
+    def __init__(self, max_bytes, max_entries=None, ttl=None):
+        """
+        Args:
+            max_bytes (int): 保持するエントリの合計バイト数の上限
+            max_entries (int, optional): 保持するエントリ数の上限
+            ttl (float, optional): エントリの有効期間（秒）。Noneで無期限
+        """
+        self.max_bytes = max_bytes
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries = OrderedDict()  # key -> (value, size, expires_at)
+        self._total_bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key, default=None):
+        """キーに対応する値を返す（見つからない場合はdefault）"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if (
+                entry is not None
+                and entry[2] is not None
+                and entry[2] < time.monotonic()
+            ):
+                # 期限切れのエントリは削除してミスとして扱う
+                self._total_bytes -= self._entries.pop(key)[1]
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return default
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key, value, size=None):
+        """
+        値を保存する
+
+        Args:
+            key: キャッシュキー
+            value: 保存する値
+            size (int, optional): 値のバイト数。省略時はsys.getsizeofで見積もる
+
+        Returns:
+            bool: 保存された場合True（単体で上限を超える値は保存しない）
+        """
+        if size is None:
+            size = sys.getsizeof(value)
+        if size > self.max_bytes:
+            return False
+
+        expires_at = time.monotonic() + self.ttl if self.ttl is not None else None
+        with self._lock:
+            if key in self._entries:
+                self._total_bytes -= self._entries.pop(key)[1]
+            self._entries[key] = (value, size, expires_at)
+            self._total_bytes += size
+            self._evict()
+        return True
+
+    def pop(self, key, default=None):
+        """キーに対応するエントリを削除して値を返す"""
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None:
+                return default
+            self._total_bytes -= entry[1]
+            return entry[0]
+
+    def clear(self):
+        """すべてのエントリと統計を削除する"""
+        with self._lock:
+            self._entries.clear()
+            self._total_bytes = 0
+            self.hits = 0
+            self.misses = 0
+            self.evictions = 0
+
+    def keys(self):
+        """現在のキーのリストを返す（古い順）"""
+        with self._lock:
+            return list(self._entries.keys())
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._entries
+
+    def __len__(self):
+        with self._lock:
+            return len(self._entries)
+
+    @property
+    def total_bytes(self):
+        return self._total_bytes
+
+    def stats(self):
+        """ヒット率などの統計を返す"""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "bytes": self._total_bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_ratio": self.hits / lookups if lookups else 0.0,
+            }
+
+    def _evict(self):
+        """上限を超えている間、最も古いエントリを削除する（ロック保持中に呼ぶ）"""
+        while self._entries and (
+            self._total_bytes > self.max_bytes
+            or (self.max_entries is not None and len(self._entries) > self.max_entries)
+        ):
+            _, (_, size, _) = self._entries.popitem(last=False)
+            self._total_bytes -= size
+            self.evictions += 1
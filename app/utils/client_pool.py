@@ -0,0 +1,132 @@
+"""
+Anthropicクライアントのプール
+
+生成のたびにクライアントを作成するとHTTP接続（TLSハンドシェイク）も毎回
+やり直しになるため、APIキーごとにクライアントを再利用してkeep-alive接続を
+使い回す。プールのキーはAPIキーのハッシュで、平文のAPIキーは保持しない。
+"""
+
+import hashlib
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+
+import anthropic
+
+logger = logging.getLogger(__name__)
+
+# プールに保持するクライアント数の上限
+CLIENT_POOL_MAX_SIZE = int(os.environ.get("CLIENT_POOL_MAX_SIZE", "16"))
+# この秒数使われなかったクライアントは閉じる
+CLIENT_POOL_IDLE_TIMEOUT = float(os.environ.get("CLIENT_POOL_IDLE_TIMEOUT", "300"))
+
+
+def hash_api_key(api_key):
+    """プールのキーに使うAPIキーのハッシュを返す"""
+    return hashlib.sha256(api_key.encode("utf-8")).hexdigest()
+
+
+class AnthropicClientPool:
+    """APIキーのハッシュをキーにしたAnthropicクライアントのLRUプール"""
+
+    def __init__(
+        self,
+        max_size=CLIENT_POOL_MAX_SIZE,
+        idle_timeout=CLIENT_POOL_IDLE_TIMEOUT,
+        **client_options,
+    ):
+        """
+        Args:
+            max_size (int): 保持するクライアント数の上限
+            idle_timeout (float): 未使用のクライアントを閉じるまでの秒数
+            **client_options: anthropic.Anthropicに渡す追加の引数（base_urlなど）
+        """
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self.client_options = client_options
+        self._clients = OrderedDict()  # APIキーのハッシュ -> (client, 最終使用時刻)
+        self._lock = threading.Lock()
+        self.created = 0
+        self.reused = 0
+        self.evicted = 0
+
+    def get(self, api_key):
+        """APIキーに対応するクライアントを返す（なければ作成する）"""
+        key = hash_api_key(api_key)
+        now = time.monotonic()
+        to_close = []
+
+        with self._lock:
+            to_close.extend(self._pop_idle(now))
+            entry = self._clients.pop(key, None)
+            if entry is not None:
+                client = entry[0]
+                self.reused += 1
+            else:
+                client = anthropic.Anthropic(api_key=api_key, **self.client_options)
+                self.created += 1
+            self._clients[key] = (client, now)
+            while len(self._clients) > self.max_size:
+                _, (old_client, _) = self._clients.popitem(last=False)
+                to_close.append(old_client)
+                self.evicted += 1
+
+        self._close(to_close)
+        return client
+
+    def evict_idle(self):
+        """idle_timeoutを過ぎたクライアントを閉じ、閉じた数を返す"""
+        with self._lock:
+            to_close = self._pop_idle(time.monotonic())
+        self._close(to_close)
+        return len(to_close)
+
+    def _pop_idle(self, now):
+        """期限切れのクライアントをプールから取り出す（ロック保持中に呼ぶ）"""
+        expired = [
+            key
+            for key, (_, last_used) in self._clients.items()
+            if now - last_used > self.idle_timeout
+        ]
+        self.evicted += len(expired)
+        return [self._clients.pop(key)[0] for key in expired]
+
+    def _close(self, clients):
+        for client in clients:
+            try:
+                client.close()
+            except Exception as e:
+                logger.warning(f"クライアントのクローズに失敗: {e}")
+
+    def clear(self):
+        """すべてのクライアントを閉じる"""
+        with self._lock:
+            clients = [client for client, _ in self._clients.values()]
+            self._clients.clear()
+        self._close(clients)
+
+    def stats(self):
+        """プールの統計を返す"""
+        with self._lock:
+            return {
+                "size": len(self._clients),
+                "created": self.created,
+                "reused": self.reused,
+                "evicted": self.evicted,
+            }
+
+
+_client_pool = None
+_client_pool_lock = threading.Lock()
+
+
+def get_client_pool():
+    """プロセス全体で共有するクライアントプールを返す"""
+    global _client_pool
+    if _client_pool is None:
+        with _client_pool_lock:
+            if _client_pool is None:
+                _client_pool = AnthropicClientPool()
+    return _client_pool
@@ -1,15 +1,53 @@
 # 入力：画像1枚，生成されたコード（関数1つ）
 # 出力：正常か異常かの判定結果
 
-import builtins
+import ast
+import contextvars
 import logging
 import os
+import time
 
 import numpy as np
 import psutil
 import torch
 from PIL import Image
-from transformers import AutoModelForZeroShotObjectDetection, AutoProcessor
+from transformers import (
+    AutoModelForZeroShotObjectDetection,
+    AutoProcessor,
+    BatchFeature,
+)
+
+from .admission import (
+    ADMISSION_CONTROL,
+    AdmissionCancelledError,
+    AdmissionTimeoutError,
+    estimate_execution_memory,
+    get_admission_controller,
+)
+from .detection_cache import (
+    get_detection_cache,
+    get_detection_memory,
+    make_detection_key,
+)
+from .detector_backend import get_detector_backend
+from .image_cache import (
+    get_content_hash,
+    get_image_cache,
+    get_original_size,
+    set_original_size,
+)
+from .metrics import (
+    DETECT_SECONDS,
+    EXECUTION_SECONDS,
+    EXECUTIONS_TOTAL,
+    MODEL_LOAD_SECONDS,
+    MODEL_LOADS_TOTAL,
+)
+from .profiling import profile_execution
+from .resource_monitor import get_resource_monitor
+from .result_cache import get_result_cache, make_result_key
+from .single_flight import FlightCancelledError, SingleFlight, get_single_flight
+from .timing import log_timings, record_timeline, span
 
 # ロギングの設定
 logging.basicConfig(
@@ -17,13 +55,31 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# 実行中のプログラムのprint出力を集めるリスト。contextvarsで実行ごとに
+# 分けるため、同時に実行されるプログラムの出力は混ざらない
+_program_output = contextvars.ContextVar("program_output", default=None)
+# 実行中のプログラムのdetect()に渡すしきい値とタイル推論の有無（同上）
+_box_threshold = contextvars.ContextVar("box_threshold", default=0.3)
+_tiled_detection = contextvars.ContextVar("tiled_detection", default=False)
+
 
 def check_memory_usage():
-    """メモリ使用量をチェックし、警告を返す"""
+    """
+    メモリ使用量をチェックし、警告を返す
+
+    リソースのサンプラーが動作中は直近の平均を使い、動作していなければ
+    その場でpsutilから取得する。
+    """
     try:
-        memory = psutil.virtual_memory()
-        available_gb = memory.available / (1024**3)
-        percent_used = memory.percent
+        monitor = get_resource_monitor()
+        recent = monitor.smoothed() if monitor.is_fresh() else None
+        if recent is not None:
+            available_gb = recent["available_bytes"] / (1024**3)
+            percent_used = recent["memory_percent"]
+        else:
+            memory = psutil.virtual_memory()
+            available_gb = memory.available / (1024**3)
+            percent_used = memory.percent
 
         return {
             "available_gb": available_gb,
@@ -35,14 +91,87 @@ def check_memory_usage():
         return {"available_gb": 0, "percent_used": 100, "warning": True}
 
 
-def execute_code(code, image_path=None, box_threshold=0.3):
+# 読み込み時の画像の最大辺（プロセッサ内部のリサイズ上限に合わせる）。0で無効
+MAX_IMAGE_SIDE = int(os.environ.get("MAX_IMAGE_SIDE", "1333"))
+
+
+def load_image(image_path, max_side=MAX_IMAGE_SIDE, use_cache=True):
+    """
+    画像を読み込み、最大辺がmax_sideを超える場合は縮小してRGBで返す
+
+    JPEGはdraftモードでデコード時点から縮小するため、フルサイズのデコードと
+    RGB変換を避けられる。元のサイズは読み込んだ画像自身に保持し（get_original_size）、
+    検出結果は元画像の座標系で返す。
+
+    Args:
+        image_path (str): 画像ファイルのパス
+        max_side (int, optional): 最大辺のピクセル数。Noneまたは0で縮小しない
+        use_cache (bool, optional): ファイル内容のハッシュで共有キャッシュを使うか
+
+    Returns:
+        PIL.Image.Image: RGB画像
+    """
+    if use_cache:
+        return get_image_cache().get_image(image_path, max_side, _decode_image)
+    return _decode_image(image_path, max_side)
+
+
+def _decode_image(image_path, max_side):
+    """画像ファイルをデコードし、必要に応じて縮小したRGB画像を返す"""
+    image = Image.open(image_path)
+    original_size = image.size
+
+    if max_side and max(original_size) > max_side:
+        # JPEGの場合は1/2, 1/4, 1/8単位で縮小デコードされる（それ以外は何もしない）
+        image.draft("RGB", (max_side, max_side))
+        image = image.convert("RGB")
+        image.thumbnail((max_side, max_side), Image.Resampling.BILINEAR)
+        logger.info(f"画像を縮小して読み込みました: {original_size} -> {image.size}")
+    else:
+        image = image.convert("RGB")
+
+    set_original_size(image, original_size)
+    return image
+
+
+def execute_code(
+    code,
+    image_path=None,
+    box_threshold=0.3,
+    tiled=False,
+    max_image_side=MAX_IMAGE_SIDE,
+    session_id=None,
+    use_cache=True,
+    profile=None,
+    profile_path=None,
+    on_wait=None,
+    should_stop=None,
+):
     """
     生成されたコードを実行し、画像が条件を満たしているかどうかを判定する
 
+    (コード, 画像, しきい値, モデル) が同じ実行の結果はメモ化され、
+    再実行時はcached=Trueを付けた結果をそのまま返す。同じ実行が同時に
+    要求された場合は1回だけ実行し、結果を共有する。実行はメモリの予算に
+    空きができるまで到着順に待つ（admissionを参照）。
+
     Args:
         code (str): 実行するPythonコード
         image_path (str, optional): 画像ファイルのパス。指定されていない場合はデフォルト画像を使用
         box_threshold (float, optional): 物体検出のしきい値。デフォルトは0.3
+        tiled (bool, optional): 高解像度画像をタイルに分割して検出するか。デフォルトはFalse
+        max_image_side (int, optional): 読み込み時の最大辺。タイル検出時は縮小しない
+        session_id (str, optional): 結果をセッション単位で無効化するためのID
+        use_cache (bool, optional): 実行結果のメモ化を使うか。デフォルトはTrue
+        profile (str | list, optional): 実行をプロファイルする（"cprofile", "torch",
+            "all"）。指定した場合はキャッシュを使わずに実行し、結果のprofileに
+            上位の関数と保存したファイルを含める
+        profile_path (str, optional): プロファイルの保存先（拡張子なし）
+        on_wait (callable, optional): メモリの予算を待つ間、順番が変わるたびに
+            呼ばれる on_wait(順番)。受け付けられると on_wait(0)。同じ実行の
+            完了を待つ場合は、その実行の順番が知らされる
+        should_stop (callable, optional): 予算・同じ実行の完了を待つ間に
+            Trueを返したら実行しない
 
     Returns:
         dict: 実行結果のメッセージを含む辞書
@@ -69,52 +198,105 @@ def execute_code(code, image_path=None, box_threshold=0.3):
                     "デフォルト画像が見つかりません。画像パスを指定してください。"
                 )
 
-        # 画像の読み込み
-        logger.info(f"画像を読み込み中: {image_path}")
-        image = Image.open(image_path).convert("RGB")
-
-        # コードの整形
-        code = code.replace("```", "")  # 不要なバッククォートを削除
-        function_definitions = code.split("def ")  # 関数ごとに分割
-
-        if len(function_definitions) < 2:
-            raise ValueError("コード内に関数定義が見つかりません")
-
-        function_name = "execute_command"
-        final_function = "def " + function_definitions[1]
-
-        logger.info("コードを実行中...")
-        # 関数の実行，正常：０，異常：1
-        anomaly_score, output_text = execute_function_from_code(
-            final_function, function_name, image_path, image, box_threshold
+        if profile:
+            # プロファイルは実際の実行を計測するため、キャッシュも共有もしない
+            start = time.perf_counter()
+            result = _admitted_run(
+                code,
+                image_path,
+                box_threshold,
+                tiled,
+                max_image_side,
+                on_wait,
+                should_stop,
+                profile=profile,
+                profile_path=profile_path,
+            )
+            EXECUTION_SECONDS.observe(time.perf_counter() - start)
+            EXECUTIONS_TOTAL.inc(status=result["status"], cached="false")
+            return result
+
+        image_hash = get_image_cache().content_hash(image_path)
+        cache_options = {"tiled": tiled, "max_image_side": max_image_side}
+
+        # 同じ条件の実行結果があれば再利用する
+        if use_cache:
+            cached_result = get_result_cache().get(
+                make_result_key(
+                    code,
+                    image_hash,
+                    box_threshold,
+                    get_active_model_id(),
+                    **cache_options,
+                ),
+                session_id=session_id,
+            )
+            if cached_result is not None:
+                logger.info("キャッシュされた実行結果を使用します")
+                EXECUTIONS_TOTAL.inc(status=cached_result["status"], cached="true")
+                return cached_result
+
+        # 同じ実行が進行中であれば、完了を待って結果を共有する
+        flight_key = make_result_key(
+            code, image_hash, box_threshold, get_active_model_id(), **cache_options
         )
-
-        # anomaly_scoreがint型じゃなければエラー通知
-        if not isinstance(anomaly_score, (int)):
-            raise TypeError(
-                f"scoreはint型である必要があります。現在の型: {type(anomaly_score).__name__}"
+        # 受け付けの順番は待っているすべての呼び出しに知らせる。受け付けの
+        # キャンセル・タイムアウトは実行した呼び出しだけのものなので、
+        # 待っていた呼び出しは結果を共有せずに改めて実行する
+        flight = get_single_flight()
+        start = time.perf_counter()
+        result, _ = flight.do(
+            flight_key,
+            lambda: _admitted_run(
+                code,
+                image_path,
+                box_threshold,
+                tiled,
+                max_image_side,
+                lambda position: flight.progress(flight_key, position),
+                should_stop,
+            ),
+            retry_on=(AdmissionCancelledError, AdmissionTimeoutError),
+            on_progress=on_wait,
+            should_stop=should_stop,
+        )
+        EXECUTION_SECONDS.observe(time.perf_counter() - start)
+        EXECUTIONS_TOTAL.inc(status=result["status"], cached="false")
+
+        if use_cache:
+            # フォールバックで別のモデルがロードされた場合に備えて実行後のモデルIDで保存
+            get_result_cache().put(
+                make_result_key(
+                    code,
+                    image_hash,
+                    box_threshold,
+                    get_active_model_id(),
+                    **cache_options,
+                ),
+                result,
+                session_id=session_id,
             )
-
-        if anomaly_score == 0:
-            result = {
-                "message": "この画像は条件を満たしています",
-                "status": "success",
-                "score": anomaly_score,
-                "output_text": output_text,
-            }
-        else:
-            result = {
-                "message": "この画像は条件を満たしていません",
-                "status": "failure",
-                "score": anomaly_score,
-                "output_text": output_text,
-            }
-
-        logger.info(f"実行結果: {result}")
         return result
 
+    except AdmissionTimeoutError as e:
+        logger.warning(f"実行の受け付けがタイムアウト: {e}")
+        EXECUTIONS_TOTAL.inc(status="error", cached="false")
+        return {
+            "message": "混雑しているため実行できませんでした。時間をおいて再試行してください。",
+            "status": "error",
+            "error_type": "busy",
+        }
+    except (AdmissionCancelledError, FlightCancelledError):
+        logger.info("受け付けを待つ間に実行がキャンセルされました")
+        EXECUTIONS_TOTAL.inc(status="cancelled", cached="false")
+        return {
+            "message": "実行をキャンセルしました。",
+            "status": "error",
+            "error_type": "cancelled",
+        }
     except MemoryError as e:
         logger.error(f"メモリ不足エラー: {e}")
+        EXECUTIONS_TOTAL.inc(status="error", cached="false")
         return {
             "message": "メモリ不足のため処理を実行できません。画像サイズを小さくして再試行してください。",
             "status": "error",
@@ -122,6 +304,7 @@ def execute_code(code, image_path=None, box_threshold=0.3):
         }
     except Exception as e:
         logger.error(f"コード実行中にエラーが発生: {str(e)}")
+        EXECUTIONS_TOTAL.inc(status="error", cached="false")
         return {
             "message": "システムエラーが発生しました。時間をおいて再試行してください。",
             "status": "error",
@@ -129,37 +312,169 @@ def execute_code(code, image_path=None, box_threshold=0.3):
         }
 
 
+def _admitted_run(
+    code,
+    image_path,
+    box_threshold,
+    tiled,
+    max_image_side,
+    on_wait=None,
+    should_stop=None,
+    **kwargs,
+):
+    """メモリの予算に空きができるまで待ってから_run_codeを実行する"""
+    if not ADMISSION_CONTROL:
+        return _run_code(
+            code, image_path, box_threshold, tiled, max_image_side, **kwargs
+        )
+
+    estimate = estimate_image_memory(image_path, tiled, max_image_side)
+    with get_admission_controller().admit(
+        estimate, on_wait=on_wait, should_stop=should_stop
+    ):
+        return _run_code(
+            code, image_path, box_threshold, tiled, max_image_side, **kwargs
+        )
+
+
+def estimate_image_memory(image_path, tiled=False, max_image_side=MAX_IMAGE_SIDE):
+    """
+    画像ファイル1枚の実行に必要なメモリを見積もる（admissionで予算を確保する量）
+
+    ヘッダーだけ読んで画像サイズを調べるため、デコードはしない。
+
+    Returns:
+        int: 見積もり（バイト）
+    """
+    with Image.open(image_path) as image:
+        image_size = image.size
+    return estimate_execution_memory(
+        image_size,
+        tiled=tiled,
+        max_image_side=max_image_side,
+        tile_size=TILE_SIZE,
+        max_batch=TILE_MAX_BATCH,
+    )
+
+
+def _run_code(
+    code,
+    image_path,
+    box_threshold,
+    tiled,
+    max_image_side,
+    profile=None,
+    profile_path=None,
+):
+    """
+    画像を読み込んでコードを実行し、判定結果の辞書を返す
+
+    結果のtimingsには段階ごとの所要時間（timing.spanの記録）を含める。
+    profileを指定した場合は、結果のprofileにプロファイルの結果を含める。
+    """
+    with (
+        record_timeline() as timeline,
+        profile_execution(profile, profile_path) as profile_report,
+    ):
+        # 画像の読み込み
+        logger.info(f"画像を読み込み中: {image_path}")
+        with span("image_load"):
+            image = load_image(image_path, max_side=None if tiled else max_image_side)
+
+        # コードの整形
+        function_name = "execute_command"
+        final_function = extract_program(code, function_name)
+
+        logger.info("コードを実行中...")
+        # 関数の実行，正常：０，異常：1
+        with span("program"):
+            anomaly_score, output_text = execute_function_from_code(
+                final_function, function_name, image_path, image, box_threshold, tiled
+            )
+    timings = timeline.to_list()
+    log_timings(timings)
+
+    # anomaly_scoreがint型じゃなければエラー通知
+    if not isinstance(anomaly_score, (int)):
+        raise TypeError(
+            f"scoreはint型である必要があります。現在の型: {type(anomaly_score).__name__}"
+        )
+
+    if anomaly_score == 0:
+        result = {
+            "message": "この画像は条件を満たしています",
+            "status": "success",
+            "score": anomaly_score,
+            "output_text": output_text,
+            "timings": timings,
+        }
+    else:
+        result = {
+            "message": "この画像は条件を満たしていません",
+            "status": "failure",
+            "score": anomaly_score,
+            "output_text": output_text,
+            "timings": timings,
+        }
+
+    if profile:
+        result["profile"] = profile_report
+    logger.info(f"実行結果: {result}")
+    return result
+
+
+def extract_program(code, func_name="execute_command"):
+    """
+    実行するプログラムをコードから取り出す
+
+    最初の関数定義以降がそのまま実行できる場合（条件ごとの関数を組み合わせた
+    コードなど）は複数の関数定義をまとめて返し、そうでなければ従来どおり
+    最初の関数定義だけを返す。
+    """
+    code = code.replace("```", "")  # 不要なバッククォートを削除
+    function_definitions = code.split("def ")  # 関数ごとに分割
+
+    if len(function_definitions) < 2:
+        raise ValueError("コード内に関数定義が見つかりません")
+
+    program = "def " + "def ".join(function_definitions[1:])
+    try:
+        tree = ast.parse(program)
+    except SyntaxError:
+        tree = None
+    if tree is not None and any(
+        isinstance(node, ast.FunctionDef) and node.name == func_name
+        for node in tree.body
+    ):
+        return program
+
+    return "def " + function_definitions[1]
+
+
 # 生成されたコードの中から対象の関数を一つ実行する関数
-def execute_function_from_code(code, func_name, image_path, image, box_threshold=0.3):
+def execute_function_from_code(
+    code, func_name, image_path, image, box_threshold=0.3, tiled=False
+):
     """指定された関数をコードから実行し、異常スコアとテキスト出力を取得"""
 
-    namespace = {}
+    # 生成コード内の関数同士が呼び出せるよう、モジュールのグローバルの
+    # コピーを名前空間にする（モジュール自体のグローバルは汚さない）
+    namespace = dict(globals())
     # 出力をキャプチャするためのリスト
     output_lines = []
-
-    # 元のprint関数を保存
-    original_print = builtins.print
-
-    # print関数をオーバーライドして出力をキャプチャ
-    def capture_print(*args, **kwargs):
-        # 元のprint関数を呼び出す
-        original_print(*args, **kwargs)
-        # 出力をキャプチャ
-        output_text = " ".join(str(arg) for arg in args)
-        if "end" in kwargs:
-            output_text += kwargs["end"]
-        else:
-            output_text += "\n"
-        output_lines.append(output_text)
+    # 生成コードのprintは名前空間で差し替える（builtinsは他のスレッドと共有のため
+    # 差し替えない）。find()などモジュール内のprintも_program_printで記録される
+    namespace["print"] = _program_print
+    tokens = [
+        (_program_output, _program_output.set(output_lines)),
+        # box_thresholdとタイル推論の有無はこの実行のdetect()だけに渡す
+        (_box_threshold, _box_threshold.set(box_threshold)),
+        (_tiled_detection, _tiled_detection.set(tiled)),
+    ]
 
     try:
-        # builtinsのprint関数を置き換え
-        builtins.print = capture_print
-
         # `exec` の影響範囲を限定するため `namespace` を使用
-        # box_thresholdをグローバル変数として設定
-        globals()["_box_threshold"] = box_threshold
-        exec(code, globals(), namespace)
+        exec(code, namespace)
 
         # 実行されたコードの中から `func_name` に対応する関数を取得
         func = namespace.get(func_name)
@@ -176,12 +491,21 @@ def execute_function_from_code(code, func_name, image_path, image, box_threshold
             raise ValueError(f"関数 {func_name} が見つかりません。")
     except Exception as e:
         logger.error(f"関数 {func_name} の実行中にエラーが発生: {e}")
-        # キャプチャした出力を結合（エラー時も出力を返す）
-        output_text = "".join(output_lines)
         raise
     finally:
-        # 元のprint関数を復元
-        builtins.print = original_print
+        for var, token in reversed(tokens):
+            var.reset(token)
+
+
+def _program_print(*args, **kwargs):
+    """標準出力に書き、実行中のプログラムがあればその出力として記録するprint"""
+    print(*args, **kwargs)
+    output_lines = _program_output.get()
+    if output_lines is not None:
+        end = kwargs.get("end")
+        output_text = " ".join(str(arg) for arg in args)
+        output_text += "\n" if end is None else end
+        output_lines.append(output_text)
 
 
 def main():
@@ -350,7 +674,7 @@ class ImagePatch:
         # Use left , lower, right , upper for downstream tasks.
 
         self.original_image = image
-        size_x, size_y = image.size
+        size_x, size_y = get_original_size(image)
 
         if left is None and right is None and upper is None and lower is None:
             self.x1 = 0
@@ -409,9 +733,10 @@ class ImagePatch:
         # >>> image_patch = ImagePatch(image)
         # >>> kid_patches = image_patch. find ("kid")
         # >>> return kid_patches
-        print(f"Calling find function . Detect {object_name}.")
+        _program_print(f"Calling find function . Detect {object_name}.")
         # return a dict of patches
-        det_patches_dict = detect(self.original_image, object_name)
+        with span("find", detail=object_name):
+            det_patches_dict = detect(self.original_image, object_name)
         # print (f"Detection result : {' and '. join ([ str (d) + ' ' + object_name for d in det_patches ])}")
         return det_patches_dict
 
@@ -462,6 +787,63 @@ class ImagePatch:
         return True
 
 
+class _DryRunImagePatch(ImagePatch):
+    """物体検出を行わないImagePatch（生成コードの事前検証用）"""
+
+    def find(self, object_name: str):
+        # detect()と同じく、複数の物体名の場合は物体名ごとの辞書を返す
+        names = [name for name in object_name.replace(" ", "").split(".") if name]
+        if len(names) > 1:
+            return {name: [] for name in names}
+        return []
+
+    def expand_patch_with_surrounding(self):
+        patch = super().expand_patch_with_surrounding()
+        return _DryRunImagePatch(
+            patch.original_image, patch.left, patch.lower, patch.right, patch.upper
+        )
+
+
+def dry_run_code(code, func_name="execute_command"):
+    """
+    生成されたコードをモデルを使わずに試験実行する
+
+    find()が何も検出しないImagePatchと小さな空白画像で関数を実行し、
+    構文エラー・関数の未定義・実行時エラー・戻り値の型の誤りを検出する。
+
+    Args:
+        code (str): 検証するPythonコード
+        func_name (str, optional): 実行する関数名
+
+    Raises:
+        ValueError: コードが実行できない、または戻り値がint型でない場合
+    """
+    program = extract_program(code, func_name)
+    namespace = dict(globals())
+    namespace["ImagePatch"] = _DryRunImagePatch
+    # 生成コードのprintは出力しない（builtinsは他のスレッドと共有のため差し替えない）
+    namespace["print"] = lambda *args, **kwargs: None
+
+    try:
+        exec(program, namespace)
+    except Exception as e:
+        raise ValueError(f"コードを読み込めません: {type(e).__name__}: {e}")
+
+    func = namespace.get(func_name)
+    if not callable(func):
+        raise ValueError(f"関数 {func_name} が見つかりません。")
+
+    try:
+        result = func(None, Image.new("RGB", (64, 64)))
+    except Exception as e:
+        raise ValueError(f"試験実行でエラーが発生しました: {type(e).__name__}: {e}")
+
+    if not isinstance(result, int):
+        raise ValueError(
+            f"scoreはint型である必要があります。現在の型: {type(result).__name__}"
+        )
+
+
 def dist(patch_a, patch_b):
     xa = patch_a.horizontal_center
     ya = patch_a.vertical_center
@@ -495,7 +877,7 @@ def formatting_answer(answer) -> str:
 
     else:
         final_answer = str(answer)
-    print(f"Program output: {final_answer}")
+    _program_print(f"Program output: {final_answer}")
     return final_answer
 
 
@@ -629,11 +1011,25 @@ def delete_large_box(patch_list):
 # グローバルモデルキャッシュ
 _cached_model = None
 _cached_processor = None
+_cached_model_id = None
+
+# タイル分割推論の設定（高解像度画像で小さな欠陥を見逃さないため）
+TILE_SIZE = int(os.environ.get("DETECT_TILE_SIZE", "800"))
+TILE_OVERLAP = int(os.environ.get("DETECT_TILE_OVERLAP", "160"))
+# 1回のforwardでまとめて推論するタイル数の上限（ピークメモリを抑える）
+TILE_MAX_BATCH = int(os.environ.get("DETECT_TILE_MAX_BATCH", "4"))
+
+
+# ロードを試行するモデル（軽量な順）
+MODEL_CANDIDATES = [
+    "IDEA-Research/grounding-dino-tiny",
+    "IDEA-Research/grounding-dino-base",
+]
 
 
 def load_model_with_fallback():
     """軽量モデルから順番に試行してロード"""
-    models = ["IDEA-Research/grounding-dino-tiny", "IDEA-Research/grounding-dino-base"]
+    models = MODEL_CANDIDATES
 
     device = "cuda" if torch.cuda.is_available() else "cpu"
 
@@ -664,65 +1060,373 @@ def load_model_with_fallback():
     raise Exception("すべてのモデルのロードに失敗しました")
 
 
-def detect(image, obj_name):  # list(scoreの高い順にbboxを返す)
-    global _cached_model, _cached_processor
+def get_active_model_id():
+    """検出に使われるモデルIDを返す（未ロードの場合は最初に試行するモデル）"""
+    return get_detector_backend().model_id
 
-    device = "cuda" if torch.cuda.is_available() else "cpu"
 
-    try:
-        # モデルキャッシュを使用
-        if _cached_processor is None or _cached_model is None:
-            logger.info("Loading model for first time...")
-            _cached_processor, _cached_model, used_model_id = load_model_with_fallback()
-            logger.info(f"Model loaded and cached: {used_model_id}")
-        else:
-            logger.info("Using cached model")
+def get_cached_model():
+    """キャッシュ済みのモデルを返す（未ロードならロードしてキャッシュする）"""
+    global _cached_model, _cached_processor, _cached_model_id
+
+    if _cached_processor is None or _cached_model is None:
+        logger.info("Loading model for first time...")
+        start = time.perf_counter()
+        with span("model_load"):
+            _cached_processor, _cached_model, _cached_model_id = (
+                load_model_with_fallback()
+            )
+        MODEL_LOAD_SECONDS.observe(time.perf_counter() - start)
+        MODEL_LOADS_TOTAL.inc(model=_cached_model_id)
+        logger.info(f"Model loaded and cached: {_cached_model_id}")
+    else:
+        logger.info("Using cached model")
 
-        processor = _cached_processor
-        model = _cached_model
+    return _cached_processor, _cached_model
 
-        # orange. peach. のような複数のオブジェクト名を入力とする
-        if not obj_name.endswith("."):
-            obj_name += "."
-        logger.info(f"検出対象: {obj_name}")
 
-        inputs = processor(images=image, text=obj_name, return_tensors="pt").to(device)
-        with torch.no_grad():
-            outputs = model(**inputs)
+def prepare_inputs(processor, images, obj_name, content_hash=None):
+    """
+    画像とテキストをモデル入力に変換する
 
-        # thresholdの選択（グローバル変数から取得、なければデフォルト0.3）
-        box_threshold = globals().get("_box_threshold", 0.3)
-        logger.info(f"使用するしきい値: {box_threshold}")
-        if obj_name == "pushpin.":
-            box_threshold = max(box_threshold, 0.3)  # pushpinの場合は最低0.3を保持
+    content_hashを指定した場合（1枚の画像のみ）、画像側のpixel tensorは
+    共有キャッシュから再利用し、テキストだけをトークナイズする。
+    """
+    if content_hash is not None and len(images) == 1:
+        pixel_inputs = get_image_cache().get_pixel_inputs(
+            content_hash,
+            images[0].size,
+            _cached_model_id,
+            lambda: processor.image_processor(images=images, return_tensors="pt"),
+        )
+    else:
+        pixel_inputs = processor.image_processor(images=images, return_tensors="pt")
+
+    text_inputs = processor.tokenizer(
+        [obj_name] * len(images), padding=True, return_tensors="pt"
+    )
+    # キャッシュ内のtensorを書き換えないよう新しいBatchFeatureにまとめる
+    return BatchFeature(data={**pixel_inputs, **text_inputs})
+
+
+def run_detection_batch(
+    processor, model, images, obj_name, box_threshold, content_hash=None
+):
+    """複数の画像を1回のforwardでまとめて推論し、画像ごとの検出結果を返す"""
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+
+    with span("preprocess"):
+        inputs = prepare_inputs(processor, images, obj_name, content_hash).to(device)
+    with span("forward"), torch.no_grad():
+        outputs = model(**inputs)
 
-        results = processor.post_process_grounded_object_detection(
+    with span("postprocess"):
+        return processor.post_process_grounded_object_detection(
             outputs,
             inputs.input_ids,
             box_threshold=box_threshold,
             text_threshold=0.3,
-            target_sizes=[image.size[::-1]],
+            target_sizes=[image.size[::-1] for image in images],
         )
 
-        # 自動でリストから辞書に変換
-        if isinstance(results, list) and len(results) == 1:  # リストかつ要素が1つの場合
-            results = results[0]  # 辞書型に変換
-            logger.info(f"検出結果: {results}")
-        else:
-            raise ValueError("Results should be a list with one element.")
 
-        boxes_list = []
-        scores_list = []
-        labels_list = []
+def results_to_lists(results, offset=(0, 0)):
+    """post_processの結果をbox・score・labelのリストに変換する
+
+    offsetを指定するとboxを元画像の座標系に平行移動する（タイル推論用）
+    """
+    boxes_list = []
+    scores_list = []
+    labels_list = []
+
+    for score, label, box in zip(
+        results["scores"], results["labels"], results["boxes"], strict=False
+    ):
+        box = [round(i, 1) for i in box.tolist()]
+        x0, y0, x1, y1 = (int(coord) for coord in box)
+        boxes_list.append(
+            [x0 + offset[0], y0 + offset[1], x1 + offset[0], y1 + offset[1]]
+        )
+        scores_list.append(round(score.item(), 2))
+        labels_list.append(label)
+
+    return boxes_list, scores_list, labels_list
+
+
+def scale_boxes_to_original(boxes, image):
+    """縮小された画像上のboxを元画像の座標系に変換する"""
+    original_width, original_height = get_original_size(image)
+    width, height = image.size
+    if (original_width, original_height) == (width, height):
+        return boxes
+
+    x_scale = original_width / width
+    y_scale = original_height / height
+    return [
+        [
+            int(box[0] * x_scale),
+            int(box[1] * y_scale),
+            int(box[2] * x_scale),
+            int(box[3] * y_scale),
+        ]
+        for box in boxes
+    ]
+
+
+def compute_tiles(width, height, tile_size=TILE_SIZE, overlap=TILE_OVERLAP):
+    """画像を重なりのあるタイルに分割し、(left, upper, right, lower) のリストを返す"""
+    if overlap < 0 or overlap >= tile_size:
+        raise ValueError("overlapは0以上かつtile_size未満である必要があります")
+    stride = tile_size - overlap
+
+    def _starts(length):
+        if length <= tile_size:
+            return [0]
+        starts = list(range(0, length - tile_size, stride))
+        starts.append(length - tile_size)  # 最後のタイルは画像の端に揃える
+        return starts
+
+    return [
+        (left, upper, min(left + tile_size, width), min(upper + tile_size, height))
+        for upper in _starts(height)
+        for left in _starts(width)
+    ]
+
+
+def _touches_inner_edge(box, tile, image_size, margin=2):
+    """boxがタイル内側の境界（画像の端ではない辺）に接しているかを判定する"""
+    width, height = image_size
+    left, upper, right, lower = tile
+    return (
+        (left > 0 and box[0] <= left + margin)
+        or (upper > 0 and box[1] <= upper + margin)
+        or (right < width and box[2] >= right - margin)
+        or (lower < height and box[3] >= lower - margin)
+    )
+
+
+def merge_tile_detections(boxes, scores, labels, tile_ids, tiles, image_size):
+    """タイル境界で切れた検出結果を取り除く
+
+    タイルの内側の境界に接するboxは物体の一部しか写っていない可能性がある。
+    境界に接していない別のタイルの検出結果にほぼ含まれている場合は重複として
+    削除する。重なりより大きい物体のように、境界で切れたbox同士が互いに
+    含まれている場合は、同じラベルのものを1つのboxに結合する（scoreは最大値）。
+    残った重複はdetect()のNMSでまとめられる。
+    """
+
+    def covering(i):
+        # boxes[i]の大部分を含む、別のタイルのboxのインデックス
+        box = boxes[i]
+        area = max(box[2] - box[0], 1) * max(box[3] - box[1], 1)
+        result = []
+        for j, other in enumerate(boxes):
+            if tile_ids[j] == tile_ids[i]:
+                continue
+            w = max(0, min(box[2], other[2]) - max(box[0], other[0]))
+            h = max(0, min(box[3], other[3]) - max(box[1], other[1]))
+            if w * h / area > 0.7:
+                result.append(j)
+        return result
+
+    fragments = {
+        i
+        for i, box in enumerate(boxes)
+        if _touches_inner_edge(box, tiles[tile_ids[i]], image_size)
+    }
+    covers = {i: covering(i) for i in fragments}
+    dropped = {i for i in fragments if any(j not in fragments for j in covers[i])}
+
+    # 境界で切れたbox同士で含み合うものをまとめる（union-find）
+    parent = list(range(len(boxes)))
+
+    def find_root(i):
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    for i in fragments - dropped:
+        for j in covers[i]:
+            if j not in dropped and labels[j] == labels[i]:
+                parent[find_root(j)] = find_root(i)
+
+    groups = {}
+    for i in range(len(boxes)):
+        if i not in dropped:
+            groups.setdefault(find_root(i), []).append(i)
+
+    merged_boxes, merged_scores, merged_labels = [], [], []
+    for members in sorted(groups.values()):
+        best = max(members, key=lambda i: scores[i])
+        merged_boxes.append(
+            boxes[best]
+            if len(members) == 1
+            else [
+                min(boxes[i][0] for i in members),
+                min(boxes[i][1] for i in members),
+                max(boxes[i][2] for i in members),
+                max(boxes[i][3] for i in members),
+            ]
+        )
+        merged_scores.append(scores[best])
+        merged_labels.append(labels[best])
+    return merged_boxes, merged_scores, merged_labels
+
+
+def detect_tiles(
+    detect_batch,
+    image,
+    obj_name,
+    box_threshold,
+    tile_size=TILE_SIZE,
+    overlap=TILE_OVERLAP,
+    max_batch=TILE_MAX_BATCH,
+):
+    """高解像度画像をタイルに分割して推論し、元画像の座標系の検出結果を返す
+
+    タイルはmax_batch枚ずつまとめてforwardするため、ピークメモリは
+    max_batch枚分のタイルの推論に必要な量で頭打ちになる。
+
+    Args:
+        detect_batch (callable): detect_batch(images, obj_name, box_threshold) で
+            画像ごとの (boxes, scores, labels) を返す関数
+    """
+    tiles = compute_tiles(image.size[0], image.size[1], tile_size, overlap)
+    logger.info(f"タイル推論: {len(tiles)}タイル (size={tile_size}, overlap={overlap})")
 
-        for score, label, box in zip(
-            results["scores"], results["labels"], results["boxes"], strict=False
+    boxes_list = []
+    scores_list = []
+    labels_list = []
+    tile_ids = []
+
+    for start in range(0, len(tiles), max_batch):
+        chunk = tiles[start : start + max_batch]
+        crops = [image.crop(tile) for tile in chunk]
+        batch_results = detect_batch(crops, obj_name, box_threshold)
+        for offset, (tile, (boxes, scores, labels)) in enumerate(
+            zip(chunk, batch_results, strict=False)
         ):
-            box = [round(i, 1) for i in box.tolist()]
-            x0, y0, x1, y1 = (int(coord) for coord in box)
-            boxes_list.append([x0, y0, x1, y1])
-            scores_list.append(round(score.item(), 2))
-            labels_list.append(label)
+            dx, dy = tile[:2]
+            boxes_list.extend(
+                [x0 + dx, y0 + dy, x1 + dx, y1 + dy] for x0, y0, x1, y1 in boxes
+            )
+            scores_list.extend(scores)
+            labels_list.extend(labels)
+            tile_ids.extend([start + offset] * len(boxes))
+        # 次のバッチの前に中間結果を解放する
+        del crops, batch_results
+
+    return merge_tile_detections(
+        boxes_list, scores_list, labels_list, tile_ids, tiles, image.size
+    )
+
+
+def detect_raw(image, obj_name, box_threshold, tiled=False):
+    """検出器のバックエンドで推論し、NMS前の (boxes, scores, labels) を返す"""
+    backend = get_detector_backend()
+    backend.load()
+
+    # タイル推論は有効化されていて、画像がタイルより大きい場合のみ行う
+    if tiled and max(image.size) > TILE_SIZE:
+        return detect_tiles(backend.detect_batch, image, obj_name, box_threshold)
+
+    return backend.detect(image, obj_name, box_threshold)
+
+
+def detection_threshold(obj_name, box_threshold):
+    """検出対象に応じて実際に使うしきい値を返す"""
+    if obj_name == "pushpin.":
+        return max(box_threshold, 0.3)  # pushpinの場合は最低0.3を保持
+    return box_threshold
+
+
+# 同じ検出が同時に要求された場合（ウォームアップと実行など）に推論を共有する
+_detection_flight = SingleFlight()
+
+
+def cached_detect_raw(image, obj_name, box_threshold, tiled=False):
+    """
+    キャッシュを参照してNMS前の (boxes, scores, labels) を返す
+
+    メモリキャッシュ、ディスクキャッシュ（有効な場合）の順に探し、どちらにも
+    なければモデルで推論して両方に保存する。画像に内容ハッシュがない場合
+    （切り出した画像など読み込んだ画像そのものでない場合）はキャッシュを使わずに
+    推論する。
+
+    Args:
+        image (PIL.Image.Image): 検出対象の画像
+        obj_name (str): 検出対象（"apple." や "apple. banana." の形式）
+        box_threshold (float): 物体検出のしきい値
+        tiled (bool, optional): タイルに分割して検出するか
+    """
+    start = time.perf_counter()
+    content_hash = get_content_hash(image)
+    if content_hash is None:
+        detections = detect_raw(image, obj_name, box_threshold, tiled)
+        DETECT_SECONDS.observe(time.perf_counter() - start, source="model")
+        return detections
+
+    # 候補のモデルへのフォールバックでモデルIDが変わるため、読み込んでからキーを作る
+    backend = get_detector_backend()
+    backend.load()
+    cache_key = make_detection_key(
+        content_hash,
+        obj_name,
+        backend.model_id,
+        box_threshold,
+        image_size=image.size,
+        tiled=tiled,
+    )
+    memory = get_detection_memory()
+    cached = memory.get(cache_key)
+    if cached is not None:
+        logger.info("メモリ上の検出結果を使用します")
+        DETECT_SECONDS.observe(time.perf_counter() - start, source="memory")
+        return cached
+
+    source = "coalesced"  # 他のスレッドの推論を共有した場合
+
+    def compute():
+        nonlocal source
+        detection_cache = get_detection_cache()
+        detections = detection_cache.get(cache_key) if detection_cache else None
+        if detections is not None:
+            logger.info("キャッシュされた検出結果を使用します")
+            source = "disk"
+        else:
+            source = "model"
+            detections = detect_raw(image, obj_name, box_threshold, tiled)
+            if detection_cache is not None:
+                detection_cache.put(cache_key, *detections)
+        memory.put(cache_key, *detections)
+        return detections
+
+    detections, _ = _detection_flight.do(cache_key, compute)
+    DETECT_SECONDS.observe(time.perf_counter() - start, source=source)
+    return detections
+
+
+def detect(image, obj_name):  # list(scoreの高い順にbboxを返す)
+    global _cached_model, _cached_processor, _cached_model_id
+
+    try:
+        # orange. peach. のような複数のオブジェクト名を入力とする
+        if not obj_name.endswith("."):
+            obj_name += "."
+        logger.info(f"検出対象: {obj_name}")
+
+        # thresholdの選択（実行中のプログラムの設定から取得、なければデフォルト0.3）
+        box_threshold = detection_threshold(obj_name, _box_threshold.get())
+        logger.info(f"使用するしきい値: {box_threshold}")
+
+        # タイル推論の有無も実行中のプログラムの設定から取得
+        tiled = _tiled_detection.get()
+
+        # キャッシュにあればモデルを使わずに検出結果を再利用する
+        boxes_list, scores_list, labels_list = cached_detect_raw(
+            image, obj_name, box_threshold, tiled
+        )
 
         if boxes_list == []:
             return []
@@ -731,11 +1435,15 @@ def detect(image, obj_name):  # list(scoreの高い順にbboxを返す)
         if obj_name == "terminal.":
             boxes_list, scores_list, labels_list
         else:
-            boxes_list, scores_list, labels_list = nms(
-                boxes_list, scores_list, labels_list, 0.2
-            )
+            with span("nms"):
+                boxes_list, scores_list, labels_list = nms(
+                    boxes_list, scores_list, labels_list, 0.2
+                )
         logger.info(f"NMS後の結果: {boxes_list}, {scores_list}, {labels_list}")
 
+        # 縮小して読み込んだ画像の場合はboxを元画像の座標系に戻す
+        boxes_list = scale_boxes_to_original(boxes_list, image)
+
         # obj_nameに含まれる要素を.で区切りリストに変換し，空白を削除
         # obj_name = "oatmeal. banana chips. almonds"
         obj_name_list = obj_name.replace(" ", "").split(".")
@@ -792,6 +1500,8 @@ def detect(image, obj_name):  # list(scoreの高い順にbboxを返す)
         # キャッシュをクリアして再試行
         _cached_model = None
         _cached_processor = None
+        _cached_model_id = None
+        get_image_cache().pixels.clear()
         torch.cuda.empty_cache() if torch.cuda.is_available() else None
         return []
     except Exception as e:
@@ -1,10 +1,20 @@
+import hashlib
 import logging
 import os
+import re
+import threading
+import time
+from collections.abc import Callable
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from contextlib import contextmanager
 
 import anthropic
 
 # from google import genai
 # from google.genai import types
+from .client_pool import get_client_pool
+from .generation_cache import get_generation_cache, make_generation_key
+from .prompt_builder import FEWSHOT_TOP_K, get_fewshot_selector
 from .template_prompt import prompt
 
 # ロギングの設定
@@ -53,25 +63,29 @@ def main():
     # print(response.text)
 
 
-# プログラムの自動生成
-def generate_anomaly_detection_code(
-    normal_conditions: str, api_key: str
-) -> str:  # text: str >> code: str
-    """
-    ユーザー入力を使ってプログラムコードを生成する
+# 生成に使用するモデルと出力トークン数の上限
+MODEL_NAME = "claude-3-7-sonnet-20250219"
+MAX_TOKENS = 4000
+# 条件ごとの並列生成で同時に行うAPI呼び出しの上限
+PARALLEL_GENERATION_MAX_WORKERS = int(
+    os.environ.get("PARALLEL_GENERATION_MAX_WORKERS", "4")
+)
 
-    Args:
-        normal_conditions (str): ユーザーが入力した条件テキスト
-        api_key (str): Anthropic APIキー
+# 投機的生成で同時に要求する候補数
+SPECULATIVE_CANDIDATES = int(os.environ.get("SPECULATIVE_CANDIDATES", "3"))
 
-    Returns:
-        str: 生成されたプログラムコード
+_EXECUTE_COMMAND_DEF = re.compile(r"^def\s+execute_command\s*\(")
 
-    Raises:
-        ValueError: 入力が無効な場合
-        Exception: API呼び出しに失敗した場合
-    """
-    # 入力検証
+
+def combine_conditions(conditions: list) -> str:
+    """入力された条件のリストをプロンプト用の箇条書きにまとめる"""
+    return "\n".join(
+        [f"- {condition.strip()}" for condition in conditions if condition.strip()]
+    )
+
+
+def _validate_inputs(normal_conditions: str, api_key: str) -> None:
+    """生成の入力を検証する（無効な場合はValueError）"""
     if not isinstance(normal_conditions, str) or not normal_conditions.strip():
         raise ValueError("入力テキストが空です")
 
@@ -82,7 +96,10 @@ def generate_anomaly_detection_code(
     if len(normal_conditions.strip()) > 10000:
         raise ValueError("入力テキストが長すぎます（10000文字以内）")
 
-    final_condition = f"""
+
+def _build_condition(normal_conditions: str) -> str:
+    """プロンプト末尾の条件部分（リクエストごとに変わる部分）を返す"""
+    return f"""
     Create 1 python function.
     Do not output anything except execute_command()
         
@@ -90,71 +107,193 @@ def generate_anomaly_detection_code(
     Function:
     """
 
-    final_prompt = prompt + final_condition
 
+# 生成キャッシュのキーに使うプロンプトのバージョン（テンプレートと例の数のハッシュ）
+PROMPT_VERSION = hashlib.sha256(
+    (prompt + _build_condition("") + f"top_k={FEWSHOT_TOP_K}").encode("utf-8")
+).hexdigest()[:16]
+
+
+def build_messages(normal_conditions: str, top_k: int = FEWSHOT_TOP_K) -> list:
+    """
+    APIに送るmessagesを作成する
+
+    モジュールの説明をcache_control付きのブロックにし、条件に近いfew-shot例と
+    条件を後ろの別ブロックにする。説明部分はプロンプトキャッシュから読み込まれ、
+    例は上位top_k個に絞るため、入力トークンの処理が省ける。
+    top_kが0の場合はすべての例を含むテンプレート全体をキャッシュ対象にする。
+    """
+    if top_k <= 0:
+        blocks = [prompt, _build_condition(normal_conditions)]
+    else:
+        header, examples = get_fewshot_selector().build(normal_conditions, top_k)
+        blocks = [header, examples + _build_condition(normal_conditions)]
+
+    return [
+        {
+            "role": "user",
+            "content": [
+                {
+                    "type": "text",
+                    "text": blocks[0],
+                    "cache_control": {"type": "ephemeral"},
+                },
+                {"type": "text", "text": blocks[1]},
+            ],
+        }
+    ]
+
+
+def extract_usage(message) -> dict:
+    """レスポンスのusageからトークン数（キャッシュの読み書きを含む）を取り出す"""
+    usage = getattr(message, "usage", None)
+    result = {}
+    for field in (
+        "input_tokens",
+        "output_tokens",
+        "cache_creation_input_tokens",
+        "cache_read_input_tokens",
+    ):
+        value = getattr(usage, field, None)
+        result[field] = value if isinstance(value, int) else 0
+    return result
+
+
+def _log_usage(usage: dict) -> None:
+    output_tokens = usage["output_tokens"]
+    logger.info(
+        "トークン使用量: 入力=%d, 出力=%s, キャッシュ書き込み=%d, キャッシュ読み込み=%d",
+        usage["input_tokens"],
+        "不明（打ち切り）" if output_tokens is None else output_tokens,
+        usage["cache_creation_input_tokens"],
+        usage["cache_read_input_tokens"],
+    )
+
+
+def _add_usage(total: dict, usage: dict) -> None:
+    """usageをtotalに加算する（どちらかが不明(None)の項目は不明のままにする）"""
+    for field, value in usage.items():
+        if total[field] is None or value is None:
+            total[field] = None
+        else:
+            total[field] += value
+
+
+def extract_function(code: str) -> str:
+    """
+    生成されたテキストから最初の関数定義を取り出して検証する
+
+    Raises:
+        ValueError: 関数定義やexecute_commandが見つからない場合
+    """
+    if not code or not code.strip():
+        raise ValueError("生成されたコードが空です")
+
+    code = code.replace("```", "")  # 不要なバッククォートを削除
+    function_definitions = code.split("def ")  # 関数ごとに分割
+
+    if len(function_definitions) < 2:
+        raise ValueError("生成されたコードに関数定義が見つかりません")
+
+    final_function = "def " + function_definitions[1]
+
+    # 基本的なコード検証
+    if "execute_command" not in final_function:
+        raise ValueError("生成されたコードにexecute_command関数が見つかりません")
+
+    return final_function
+
+
+def find_complete_function(text: str, name: str = "execute_command") -> str | None:
+    """
+    ストリーミング中のテキストから、完結したname関数の定義を返す
+
+    関数定義の後に、defと同じかそれより浅いインデントの行（またはコードブロック
+    の終わり）が現れた時点で関数が完結したとみなす。まだ完結していない場合は
+    Noneを返す。
+    """
+    # 改行で終わっていない最後の行は書きかけのため判定に使わない
+    lines = text.split("\n")[:-1]
+
+    for start, line in enumerate(lines):
+        stripped = line.lstrip()
+        if not stripped.startswith("def "):
+            continue
+        if name not in stripped:
+            return None  # 最初の関数がnameでない場合は従来どおり全文で判定する
+
+        indent = len(line) - len(stripped)
+        has_body = False
+        for end in range(start + 1, len(lines)):
+            current = lines[end]
+            if not current.strip():
+                continue
+            current_indent = len(current) - len(current.lstrip())
+            if current.lstrip().startswith("```") or current_indent <= indent:
+                if not has_body:
+                    return None
+                return "\n".join(lines[start:end]).rstrip() + "\n"
+            has_body = True
+        return None
+
+    return None
+
+
+def _save_generated_code(final_function: str) -> None:
+    """生成されたコードをファイルに保存する（失敗しても生成は成功扱い）"""
     try:
-        # Anthropic APIを使用してコード生成
-        client = anthropic.Anthropic(
-            api_key=api_key,
-        )
+        save_dir = os.path.join(os.path.dirname(os.path.dirname(__file__)), "generated")
+        os.makedirs(save_dir, exist_ok=True)
 
-        message = client.messages.create(
-            max_tokens=4000,
-            messages=[{"role": "user", "content": final_prompt}],
-            model="claude-3-7-sonnet-20250219",
-        )
+        with open(
+            os.path.join(save_dir, "generated_code.py"), "w", encoding="utf-8"
+        ) as o:
+            o.write(final_function)
 
-        if not message.content or len(message.content) == 0:
-            raise ValueError("APIからの応答が空です")
+        # アプリのルートディレクトリにも保存
+        with open(
+            os.path.join(
+                os.path.dirname(os.path.dirname(__file__)), "generated_code.py"
+            ),
+            "w",
+            encoding="utf-8",
+        ) as o:
+            o.write(final_function)
+    except OSError as e:
+        logger.warning(f"ファイル保存に失敗しましたが、コード生成は成功しました: {e}")
 
-        code = message.content[0].text
 
-        if not code or not code.strip():
-            raise ValueError("生成されたコードが空です")
+def _generation_key(normal_conditions: str) -> str:
+    return make_generation_key(normal_conditions, MODEL_NAME, PROMPT_VERSION)
 
-        # 生成されたコードをログに出力（デバッグ用）
-        logger.info(f"生成されたコード: {code[:100]}...")
 
-        code = code.replace("```", "")  # 不要なバッククォートを削除
-        function_definitions = code.split("def ")  # 関数ごとに分割
+def _get_cached_code(normal_conditions: str) -> str | None:
+    """生成キャッシュからコードを取得する（無効・未登録の場合はNone）"""
+    cache = get_generation_cache()
+    if cache is None:
+        return None
+    code = cache.get(_generation_key(normal_conditions))
+    if code is not None:
+        logger.info("生成キャッシュにヒットしたためAPI呼び出しを省略")
+    return code
 
-        if len(function_definitions) < 2:
-            raise ValueError("生成されたコードに関数定義が見つかりません")
 
-        final_function = "def " + function_definitions[1]
+def _put_cached_code(normal_conditions: str, final_function: str) -> None:
+    """検証済みのコードを生成キャッシュに保存する"""
+    cache = get_generation_cache()
+    if cache is not None:
+        cache.put(_generation_key(normal_conditions), final_function)
 
-        # 基本的なコード検証
-        if "execute_command" not in final_function:
-            raise ValueError("生成されたコードにexecute_command関数が見つかりません")
 
-        # 生成されたコードをファイルに保存
-        try:
-            save_dir = os.path.join(
-                os.path.dirname(os.path.dirname(__file__)), "generated"
-            )
-            os.makedirs(save_dir, exist_ok=True)
-
-            with open(
-                os.path.join(save_dir, "generated_code.py"), "w", encoding="utf-8"
-            ) as o:
-                o.write(final_function)
-
-            # アプリのルートディレクトリにも保存
-            with open(
-                os.path.join(
-                    os.path.dirname(os.path.dirname(__file__)), "generated_code.py"
-                ),
-                "w",
-                encoding="utf-8",
-            ) as o:
-                o.write(final_function)
-        except OSError as e:
-            logger.warning(
-                f"ファイル保存に失敗しましたが、コード生成は成功しました: {e}"
-            )
+def _empty_usage() -> dict:
+    return extract_usage(None)
 
-        return final_function
 
+@contextmanager
+def _api_error_handling():
+    """API呼び出しの例外をユーザー向けの例外に変換する"""
+    try:
+        yield
     except anthropic.APIConnectionError as e:
         logger.error(f"API接続エラー: {str(e)}")
         raise ConnectionError(
@@ -176,5 +315,414 @@ def generate_anomaly_detection_code(
         raise Exception("コード生成中に予期しないエラーが発生しました。")
 
 
+def _generate_function(
+    normal_conditions: str, api_key: str, use_cache: bool = True
+) -> tuple[str, dict]:
+    """
+    生成キャッシュまたはAPIから検証済みの関数を取得する（ファイルには保存しない）
+
+    Returns:
+        tuple: (生成された関数, トークン使用量の辞書)
+    """
+    _validate_inputs(normal_conditions, api_key)
+
+    cached_code = _get_cached_code(normal_conditions) if use_cache else None
+    if cached_code is not None:
+        return cached_code, _empty_usage()
+
+    with _api_error_handling():
+        # Anthropic APIを使用してコード生成（クライアントと接続はプールから再利用）
+        client = get_client_pool().get(api_key)
+
+        start_time = time.perf_counter()
+        message = client.messages.create(
+            max_tokens=MAX_TOKENS,
+            messages=build_messages(normal_conditions),
+            model=MODEL_NAME,
+        )
+        logger.info(f"API応答時間: {time.perf_counter() - start_time:.2f}秒")
+        usage = extract_usage(message)
+        _log_usage(usage)
+
+        if not message.content or len(message.content) == 0:
+            raise ValueError("APIからの応答が空です")
+
+        code = message.content[0].text
+
+        # 生成されたコードをログに出力（デバッグ用）
+        logger.info(f"生成されたコード: {(code or '')[:100]}...")
+
+        final_function = extract_function(code)
+        _put_cached_code(normal_conditions, final_function)
+        return final_function, usage
+
+
+# プログラムの自動生成
+def generate_anomaly_detection_code(
+    normal_conditions: str,
+    api_key: str,
+    return_usage: bool = False,
+    use_cache: bool = True,
+) -> str:  # text: str >> code: str
+    """
+    ユーザー入力を使ってプログラムコードを生成する
+
+    Args:
+        normal_conditions (str): ユーザーが入力した条件テキスト
+        api_key (str): Anthropic APIキー
+        return_usage (bool, optional): Trueの場合はトークン使用量も返す
+        use_cache (bool, optional): Falseの場合は生成キャッシュを使わずに再生成する
+
+    Returns:
+        str: 生成されたプログラムコード
+            （return_usage=Trueの場合は (コード, トークン使用量の辞書)）
+
+    Raises:
+        ValueError: 入力が無効な場合
+        Exception: API呼び出しに失敗した場合
+    """
+    final_function, usage = _generate_function(normal_conditions, api_key, use_cache)
+    _save_generated_code(final_function)
+    if return_usage:
+        return final_function, usage
+    return final_function
+
+
+def compose_condition_functions(functions: list) -> str:
+    """
+    条件ごとに生成したexecute_commandをまとめて1つのプログラムにする
+
+    各関数をcheck_condition_Nに改名し、それらの異常スコアを合計する
+    execute_commandを末尾に追加する。
+
+    Args:
+        functions (list): 条件ごとに生成されたexecute_command関数のコード
+
+    Returns:
+        str: 組み合わせたプログラムコード
+    """
+    parts = []
+    calls = []
+    for i, function in enumerate(functions, start=1):
+        name = f"check_condition_{i}"
+        parts.append(
+            _EXECUTE_COMMAND_DEF.sub(f"def {name}(", function.strip(), count=1)
+        )
+        calls.append(f"    anomaly_score += {name}(image_path, image)")
+
+    parts.append(
+        "def execute_command(image_path, image):\n"
+        "    anomaly_score = 0\n" + "\n".join(calls) + "\n    return anomaly_score"
+    )
+    return "\n\n\n".join(parts) + "\n"
+
+
+def generate_per_condition_code(
+    conditions: list,
+    api_key: str,
+    return_usage: bool = False,
+    use_cache: bool = True,
+    max_workers: int = PARALLEL_GENERATION_MAX_WORKERS,
+    should_stop: Callable[[], bool] | None = None,
+) -> str:
+    """
+    条件ごとに関数を並列生成し、1つのexecute_commandにまとめる
+
+    条件ごとに生成キャッシュを使うため、一部の条件を変更した場合は
+    変更した条件だけがAPIで再生成される。キャンセルされた場合、
+    まだAPIを呼び出していない条件は生成しない。
+
+    Args:
+        conditions (list): ユーザーが入力した条件のリスト
+        api_key (str): Anthropic APIキー
+        return_usage (bool, optional): Trueの場合は合計のトークン使用量も返す
+        use_cache (bool, optional): Falseの場合は生成キャッシュを使わずに再生成する
+        max_workers (int, optional): 同時に行うAPI呼び出しの上限
+        should_stop (callable, optional): Trueを返すと残りの条件の生成を中止する関数
+
+    Returns:
+        str: 組み合わせたプログラムコード
+            （return_usage=Trueの場合は (コード, トークン使用量の辞書)）
+
+    Raises:
+        ValueError: 入力が無効な場合
+        Exception: API呼び出しに失敗した場合
+    """
+    condition_texts = [
+        combine_conditions([condition])
+        for condition in conditions
+        if isinstance(condition, str) and condition.strip()
+    ]
+    if not condition_texts:
+        raise ValueError("入力テキストが空です")
+    for condition_text in condition_texts:
+        _validate_inputs(condition_text, api_key)
+
+    def generate(text):
+        if should_stop is not None and should_stop():
+            raise ValueError("コード生成がキャンセルされました")
+        return _generate_function(text, api_key, use_cache)
+
+    start_time = time.perf_counter()
+    workers = max(1, min(max_workers, len(condition_texts)))
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        results = list(executor.map(generate, condition_texts))
+    if should_stop is not None and should_stop():
+        raise ValueError("コード生成がキャンセルされました")
+    logger.info(
+        f"条件ごとの並列生成: {len(condition_texts)}件, "
+        f"{time.perf_counter() - start_time:.2f}秒"
+    )
+
+    final_function = compose_condition_functions([code for code, _ in results])
+    usage = _empty_usage()
+    for _, condition_usage in results:
+        _add_usage(usage, condition_usage)
+
+    _save_generated_code(final_function)
+    if return_usage:
+        return final_function, usage
+    return final_function
+
+
+def _stream_response(
+    client,
+    normal_conditions: str,
+    on_text: Callable[[str], None] | None = None,
+    should_stop: Callable[[], bool] | None = None,
+) -> tuple[str | None, dict]:
+    """
+    ストリーミングで応答を受信し、execute_commandが完結した時点で打ち切る
+
+    should_stopがTrueを返した場合は受信を中止し、コードとしてNoneを返す。
+
+    出力トークン数は最後のmessage_deltaで届くため、途中で打ち切った場合は
+    課金される出力トークン数がわからない。その場合output_tokensはNoneになる。
+
+    Returns:
+        tuple: (受信したコード, トークン使用量の辞書)
+    """
+    start_time = time.perf_counter()
+    chunks = []
+    complete_function = None
+    stopped = False
+    with client.messages.stream(
+        max_tokens=MAX_TOKENS,
+        messages=build_messages(normal_conditions),
+        model=MODEL_NAME,
+    ) as stream:
+        for text in stream.text_stream:
+            if should_stop is not None and should_stop():
+                # withを抜けるとレスポンスが閉じられ、残りの生成は受信しない
+                stopped = True
+                break
+            chunks.append(text)
+            received = "".join(chunks)
+            if on_text is not None:
+                on_text(received)
+            if "\n" in text:
+                complete_function = find_complete_function(received)
+                if complete_function is not None:
+                    logger.info("execute_commandが完結したためストリームを終了")
+                    break
+        # 途中で止めた場合も、message_startで受け取った入力側のusageは取得できる
+        try:
+            snapshot = getattr(stream, "current_message_snapshot", None)
+        except AssertionError:  # イベントを1つも受信していない場合
+            snapshot = None
+        usage = extract_usage(snapshot)
+        if stopped or complete_function is not None:
+            # スナップショットの値はmessage_startの仮の値で、実際より少ない
+            usage["output_tokens"] = None
+
+    logger.info(
+        f"API応答時間（ストリーミング）: {time.perf_counter() - start_time:.2f}秒"
+    )
+    _log_usage(usage)
+    if stopped:
+        return None, usage
+    return complete_function or "".join(chunks), usage
+
+
+def generate_anomaly_detection_code_stream(
+    normal_conditions: str,
+    api_key: str,
+    on_text: Callable[[str], None] | None = None,
+    return_usage: bool = False,
+    use_cache: bool = True,
+    should_stop: Callable[[], bool] | None = None,
+) -> str:
+    """
+    ストリーミングでプログラムコードを生成する
+
+    受信したテキストをon_textに逐次渡し、最初のexecute_command関数が
+    完結した時点でストリームを閉じる。後続の不要な出力を待たないため、
+    使えるコードが得られるまでの時間と出力トークンを削減できる。
+
+    Args:
+        normal_conditions (str): ユーザーが入力した条件テキスト
+        api_key (str): Anthropic APIキー
+        on_text (callable, optional): これまでに受信したテキスト全体を受け取る関数
+        return_usage (bool, optional): Trueの場合はトークン使用量も返す
+        use_cache (bool, optional): Falseの場合は生成キャッシュを使わずに再生成する
+        should_stop (callable, optional): Trueを返すと受信を中止する関数（キャンセル用）
+
+    Returns:
+        str: 生成されたプログラムコード
+            （return_usage=Trueの場合は (コード, トークン使用量の辞書)。ストリームを
+            打ち切った場合、課金される出力トークン数は不明のためoutput_tokensはNone）
+
+    Raises:
+        ValueError: 入力が無効な場合、またはキャンセルされた場合
+        Exception: API呼び出しに失敗した場合
+    """
+    _validate_inputs(normal_conditions, api_key)
+
+    cached_code = _get_cached_code(normal_conditions) if use_cache else None
+    if cached_code is not None:
+        if on_text is not None:
+            on_text(cached_code)
+        _save_generated_code(cached_code)
+        return (cached_code, _empty_usage()) if return_usage else cached_code
+
+    with _api_error_handling():
+        client = get_client_pool().get(api_key)
+        code, usage = _stream_response(
+            client, normal_conditions, on_text=on_text, should_stop=should_stop
+        )
+        if code is None:
+            raise ValueError("コード生成がキャンセルされました")
+
+        if not code:
+            raise ValueError("APIからの応答が空です")
+
+        logger.info(f"生成されたコード: {code[:100]}...")
+
+        final_function = extract_function(code)
+        _save_generated_code(final_function)
+        _put_cached_code(normal_conditions, final_function)
+        if return_usage:
+            return final_function, usage
+        return final_function
+
+
+def _validate_with_dry_run(code: str) -> None:
+    """生成コードをモデルなしで試験実行して検証する（失敗時はValueError）"""
+    from .code_executor import dry_run_code
+
+    dry_run_code(code)
+
+
+def generate_speculative_code(
+    normal_conditions: str,
+    api_key: str,
+    candidates: int = SPECULATIVE_CANDIDATES,
+    return_usage: bool = False,
+    use_cache: bool = True,
+    validator: Callable[[str], None] | None = None,
+    should_stop: Callable[[], bool] | None = None,
+) -> str:
+    """
+    複数の候補を同時に生成し、最初に検証を通過したコードを返す
+
+    候補はそれぞれストリーミングで受信し、到着した順に構文・execute_command・
+    試験実行で検証する。有効な候補が得られた時点で残りのストリームを打ち切る。
+    API利用量は増えるが、失敗時に逐次再試行するより待ち時間のばらつきが小さい。
+
+    Args:
+        normal_conditions (str): ユーザーが入力した条件テキスト
+        api_key (str): Anthropic APIキー
+        candidates (int, optional): 同時に要求する候補数
+        return_usage (bool, optional): Trueの場合は受信した候補の合計トークン使用量も返す
+        use_cache (bool, optional): Falseの場合は生成キャッシュを使わずに再生成する
+        validator (callable, optional): コードを検証する関数（無効な場合はValueError）。
+            指定しない場合は試験実行で検証する
+        should_stop (callable, optional): Trueを返すとすべての候補の受信を中止する関数
+
+    Returns:
+        str: 生成されたプログラムコード
+            （return_usage=Trueの場合は (コード, トークン使用量の辞書)。ストリームを
+            打ち切った場合、課金される出力トークン数は不明のためoutput_tokensはNone）
+
+    Raises:
+        ValueError: 入力が無効な場合、またはすべての候補が検証に失敗した場合
+        Exception: API呼び出しに失敗した場合
+    """
+    _validate_inputs(normal_conditions, api_key)
+    validator = validator or _validate_with_dry_run
+
+    cached_code = _get_cached_code(normal_conditions) if use_cache else None
+    if cached_code is not None:
+        _save_generated_code(cached_code)
+        return (cached_code, _empty_usage()) if return_usage else cached_code
+
+    client = get_client_pool().get(api_key)
+    found = threading.Event()
+
+    def stop_candidate():
+        return found.is_set() or (should_stop is not None and should_stop())
+
+    usage = _empty_usage()
+    usage_lock = threading.Lock()
+
+    def run_candidate(index):
+        with _api_error_handling():
+            code, candidate_usage = _stream_response(
+                client, normal_conditions, should_stop=stop_candidate
+            )
+            with usage_lock:
+                _add_usage(usage, candidate_usage)
+            if code is None:
+                return None  # 他の候補が先に採用された
+            final_function = extract_function(code)
+            validator(final_function)
+            logger.info(f"候補{index + 1}が検証を通過しました")
+            return final_function
+
+    start_time = time.perf_counter()
+    executor = ThreadPoolExecutor(max_workers=max(1, candidates))
+    pending = {executor.submit(run_candidate, i) for i in range(max(1, candidates))}
+    final_function = None
+    errors = []
+    try:
+        while pending and final_function is None:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                try:
+                    result = future.result()
+                except Exception as e:
+                    logger.warning(f"候補の生成・検証に失敗: {e}")
+                    errors.append(e)
+                    continue
+                if result is not None and final_function is None:
+                    final_function = result
+    finally:
+        # 残りの候補は次のチャンク受信時にストリームを閉じて終了する
+        found.set()
+        executor.shutdown(wait=False, cancel_futures=True)
+
+    if final_function is None:
+        if should_stop is not None and should_stop():
+            raise ValueError("コード生成がキャンセルされました")
+        # すべて失敗した場合は最後のエラーをそのまま伝える（接続エラーなど）
+        if errors and not isinstance(errors[-1], ValueError):
+            raise errors[-1]
+        raise ValueError(
+            "有効なコードが生成されませんでした: "
+            + "; ".join(str(e) for e in errors[-3:])
+        )
+
+    logger.info(
+        f"投機的生成: 候補{candidates}件, "
+        f"{time.perf_counter() - start_time:.2f}秒で有効なコードを取得"
+    )
+    _save_generated_code(final_function)
+    _put_cached_code(normal_conditions, final_function)
+    if return_usage:
+        with usage_lock:
+            return final_function, dict(usage)
+    return final_function
+
+
 if __name__ == "__main__":
     main()
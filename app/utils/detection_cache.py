@@ -0,0 +1,167 @@
+"""
+detect() の検出結果（box・score・label）のキャッシュ
+
+画像の内容のハッシュ・正規化したクエリ・モデルID・しきい値をキーに、
+モデルの推論結果をコンパクトなバイナリ形式で保存する。
+- プロセス内のメモリキャッシュ（常に有効）
+- ディスクキャッシュ（DETECTION_CACHE_DIR を設定した場合のみ有効）
+"""
+
+import hashlib
+import json
+import os
+import re
+import struct
+import threading
+
+import numpy as np
+
+from .cache import BoundedCache
+from .disk_cache import DiskCache
+
+# キャッシュの保存先（未設定の場合は無効）
+DETECTION_CACHE_DIR = os.environ.get("DETECTION_CACHE_DIR", "")
+DETECTION_CACHE_MAX_BYTES = int(
+    os.environ.get("DETECTION_CACHE_MAX_BYTES", str(512 * 1024 * 1024))
+)
+# プロセス内で保持する検出結果の合計バイト数の上限
+DETECTION_MEMORY_MAX_BYTES = int(
+    os.environ.get("DETECTION_MEMORY_MAX_BYTES", str(16 * 1024 * 1024))
+)
+
+# バイナリ形式: ヘッダ(件数) + box(float32 x4) + score(float32) + ラベル(UTF-8, \0区切り)
+_HEADER = struct.Struct("<I")
+
+
+def normalize_query(obj_name):
+    """クエリを正規化する（大文字小文字・空白・区切りの揺れを吸収）"""
+    names = [re.sub(r"\s+", " ", name).strip() for name in obj_name.lower().split(".")]
+    return ". ".join(name for name in names if name) + "."
+
+
+def make_detection_key(image_hash, query, model_id, box_threshold, **options):
+    """
+    検出結果のキャッシュキーを作成する
+
+    Args:
+        image_hash (str): 画像ファイルの内容のハッシュ
+        query (str): 検出対象（detect()のobj_name）
+        model_id (str): 使用するモデルID
+        box_threshold (float): 物体検出のしきい値
+        **options: 結果に影響するその他の条件（画像サイズ・タイル検出など）
+    """
+    payload = {
+        "image": image_hash,
+        "query": normalize_query(query),
+        "model": model_id,
+        "threshold": round(float(box_threshold), 6),
+        "options": options,
+    }
+    encoded = json.dumps(payload, sort_keys=True, default=str)
+    return hashlib.sha256(encoded.encode("utf-8")).hexdigest()
+
+
+def pack_detections(boxes, scores, labels):
+    """検出結果をバイト列に変換する"""
+    count = len(boxes)
+    box_array = np.asarray(boxes, dtype=np.float32).reshape(count, 4)
+    score_array = np.asarray(scores, dtype=np.float32).reshape(count)
+    label_bytes = "\0".join(str(label) for label in labels).encode("utf-8")
+    return (
+        _HEADER.pack(count) + box_array.tobytes() + score_array.tobytes() + label_bytes
+    )
+
+
+def unpack_detections(data):
+    """pack_detectionsで作成したバイト列を (boxes, scores, labels) に戻す"""
+    (count,) = _HEADER.unpack_from(data)
+    offset = _HEADER.size
+    box_array = np.frombuffer(data, dtype=np.float32, count=count * 4, offset=offset)
+    offset += count * 4 * 4
+    score_array = np.frombuffer(data, dtype=np.float32, count=count, offset=offset)
+    offset += count * 4
+
+    boxes = [[int(v) for v in box] for box in box_array.reshape(count, 4)]
+    scores = [round(float(score), 2) for score in score_array]
+    labels = data[offset:].decode("utf-8").split("\0") if count else []
+    return boxes, scores, labels
+
+
+class DetectionCache:
+    """検出結果をディスクに保存するキャッシュ"""
+
+    def __init__(self, directory, max_bytes=DETECTION_CACHE_MAX_BYTES):
+        self._store = DiskCache(directory, max_bytes, filename="detections.sqlite3")
+
+    def get(self, key):
+        """キャッシュされた (boxes, scores, labels) を返す（見つからない場合はNone）"""
+        data = self._store.get(key)
+        if data is None:
+            return None
+        return unpack_detections(data)
+
+    def put(self, key, boxes, scores, labels):
+        """検出結果を保存する"""
+        return self._store.put(key, pack_detections(boxes, scores, labels))
+
+    def clear(self):
+        self._store.clear()
+
+    def stats(self):
+        return self._store.stats()
+
+
+class MemoryDetectionCache:
+    """検出結果をプロセス内に保持するキャッシュ（DetectionCacheと同じインターフェース）"""
+
+    def __init__(self, max_bytes=DETECTION_MEMORY_MAX_BYTES):
+        self._store = BoundedCache(max_bytes)
+
+    def get(self, key):
+        """キャッシュされた (boxes, scores, labels) を返す（見つからない場合はNone）"""
+        data = self._store.get(key)
+        if data is None:
+            return None
+        return unpack_detections(data)
+
+    def put(self, key, boxes, scores, labels):
+        """検出結果を保存する（呼び出し側での変更の影響を受けないようバイト列で保持）"""
+        data = pack_detections(boxes, scores, labels)
+        return self._store.put(key, data, size=len(data))
+
+    def __contains__(self, key):
+        return key in self._store
+
+    def clear(self):
+        self._store.clear()
+
+    def stats(self):
+        return self._store.stats()
+
+
+_detection_memory = None
+_detection_memory_lock = threading.Lock()
+
+
+def get_detection_memory():
+    """プロセスで共有する検出結果のメモリキャッシュを返す"""
+    global _detection_memory
+    if _detection_memory is None:
+        with _detection_memory_lock:
+            if _detection_memory is None:
+                _detection_memory = MemoryDetectionCache()
+    return _detection_memory
+
+
+_detection_cache = None
+_detection_cache_lock = threading.Lock()
+
+
+def get_detection_cache():
+    """プロセスで共有する検出結果キャッシュを返す（無効な場合はNone）"""
+    global _detection_cache
+    if _detection_cache is None and DETECTION_CACHE_DIR:
+        with _detection_cache_lock:
+            if _detection_cache is None:
+                _detection_cache = DetectionCache(DETECTION_CACHE_DIR)
+    return _detection_cache
@@ -0,0 +1,157 @@
+"""
+コード生成中の物体検出のウォームアップ
+
+LLMがコードを生成している間、検出モデルは使われていない。条件で [ ] に
+囲まれた物体名から生成コードが find() に渡しそうなクエリを推測し、
+生成中にモデルのロード・画像の読み込みとpixel tensorの作成・検出を済ませて
+キャッシュしておく。推測が当たれば、生成後の最初の find() はキャッシュから
+結果を返す。
+
+ウォームアップも実行と同じくメモリの予算（admission）を確保する。ただし
+推測による前倒しのため予算を待つことはせず、空きがない・待っている実行が
+ある場合は行わない。
+"""
+
+import contextlib
+import logging
+import os
+import re
+import time
+
+from .admission import (
+    ADMISSION_CONTROL,
+    AdmissionTimeoutError,
+    get_admission_controller,
+)
+from .code_executor import (
+    MAX_IMAGE_SIDE,
+    cached_detect_raw,
+    detection_threshold,
+    estimate_image_memory,
+    load_image,
+)
+from .detector_backend import get_detector_backend
+
+logger = logging.getLogger(__name__)
+
+# ウォームアップを行うか（"0"で無効）
+DETECTION_WARMUP = os.environ.get("DETECTION_WARMUP", "1") != "0"
+# 1回のウォームアップで検出するクエリ数の上限
+WARMUP_MAX_QUERIES = int(os.environ.get("WARMUP_MAX_QUERIES", "6"))
+# find()で一度に検出できる物体数の上限（テンプレートの説明と同じ）
+MAX_OBJECTS_PER_QUERY = 3
+
+_BRACKETED = re.compile(r"\[([^\[\]]+)\]")
+
+
+def singularize(name):
+    """物体名の最後の単語を単数形にする（テンプレートの例と同じ形にそろえる）"""
+    words = name.split(" ")
+    last = words[-1]
+    if len(last) > 3 and last.isascii():
+        if last.endswith("ies"):
+            last = last[:-3] + "y"
+        elif last.endswith(("ches", "shes", "sses", "xes")):
+            last = last[:-2]
+        elif last.endswith("s") and not last.endswith("ss"):
+            last = last[:-1]
+    return " ".join(words[:-1] + [last])
+
+
+def extract_object_names(normal_conditions):
+    """
+    条件の行ごとに [ ] で囲まれた物体名を抽出する
+
+    Args:
+        normal_conditions (str): 正常条件（1行に1つの条件）
+
+    Returns:
+        list: 行ごとの物体名のリスト（小文字・単数形、出現順で重複なし）
+    """
+    names_per_line = []
+    for line in normal_conditions.splitlines():
+        names = []
+        for match in _BRACKETED.findall(line):
+            name = singularize(re.sub(r"\s+", " ", match).strip().lower())
+            if name and name not in names:
+                names.append(name)
+        if names:
+            names_per_line.append(names)
+    return names_per_line
+
+
+def candidate_queries(normal_conditions, max_queries=WARMUP_MAX_QUERIES):
+    """
+    生成コードが find() に渡しそうなクエリを推測する
+
+    複数の物体を含む条件では、テンプレートの例と同様に出現順でまとめた
+    クエリ（"push bottle. foaming net"）を優先し、続けて物体ごとのクエリを返す。
+    """
+    queries = []
+    for names in extract_object_names(normal_conditions):
+        if 1 < len(names) <= MAX_OBJECTS_PER_QUERY:
+            queries.append(". ".join(names))
+        queries.extend(names)
+
+    unique = list(dict.fromkeys(queries))
+    return unique[:max_queries]
+
+
+def warm_detection(
+    normal_conditions,
+    image_path,
+    box_threshold=0.3,
+    tiled=False,
+    max_image_side=MAX_IMAGE_SIDE,
+    should_stop=None,
+):
+    """
+    検出モデル・画像・推測したクエリの検出結果をキャッシュに用意する
+
+    Args:
+        normal_conditions (str): 正常条件
+        image_path (str): 実行に使う画像ファイルのパス
+        box_threshold (float, optional): 実行時と同じ物体検出のしきい値
+        tiled (bool, optional): 実行時と同じタイル検出の有無
+        max_image_side (int, optional): 実行時と同じ読み込み時の最大辺
+        should_stop (callable, optional): Trueを返したら残りのクエリを検出しない
+
+    Returns:
+        dict: 検出したクエリと所要時間。予算に空きがなく行わなかった場合は
+            skipped=True
+    """
+    start = time.perf_counter()
+    reservation = contextlib.nullcontext()
+    if ADMISSION_CONTROL:
+        # 待っている実行より先に予算を使わないよう、待たずに確保できる場合のみ行う
+        estimate = estimate_image_memory(image_path, tiled, max_image_side)
+        reservation = get_admission_controller().admit(estimate, timeout=0)
+
+    try:
+        with reservation:
+            queries = candidate_queries(normal_conditions)
+
+            backend = get_detector_backend()
+            backend.load()
+            # 実行時（_run_code）と同じ条件で読み込み、同じキャッシュのエントリを使う
+            image = load_image(image_path, max_side=None if tiled else max_image_side)
+            if not tiled:
+                backend.prepare(image)
+
+            warmed = []
+            for query in queries:
+                if should_stop is not None and should_stop():
+                    logger.info("ウォームアップを中断しました")
+                    break
+                obj_name = query + "."
+                cached_detect_raw(
+                    image, obj_name, detection_threshold(obj_name, box_threshold), tiled
+                )
+                warmed.append(query)
+    except AdmissionTimeoutError:
+        logger.info("メモリの予算に空きがないためウォームアップを行いません")
+        return {"queries": [], "seconds": time.perf_counter() - start, "skipped": True}
+
+    seconds = time.perf_counter() - start
+    logger.info(f"検出のウォームアップ完了: {warmed}, {seconds:.2f}秒")
+    return {"queries": warmed, "seconds": seconds}
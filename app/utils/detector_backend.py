@@ -0,0 +1,266 @@
+"""
+物体検出のバックエンド
+
+detect() が使う検出器を差し替えられるようにする。
+- GroundingDinoBackend: Hugging FaceのGrounding DINO（デフォルト）
+- SyntheticBackend: 指定したboxを返す決定的な検出器。遅延を設定でき、
+  モデルの重みをダウンロードせずに実行・スケジューラ・キャッシュの
+  テストやベンチマークができる
+
+DETECTOR_BACKEND=synthetic を設定するとプロセス全体で合成の検出器を使う。
+"""
+
+import logging
+import os
+import random
+import threading
+import time
+from contextlib import contextmanager
+from typing import Protocol
+
+from .image_cache import get_content_hash
+
+logger = logging.getLogger(__name__)
+
+# 使用するバックエンド（"grounding-dino" または "synthetic"）
+DETECTOR_BACKEND = os.environ.get("DETECTOR_BACKEND", "grounding-dino")
+# 合成の検出器の1回の推論の遅延（秒）
+SYNTHETIC_LATENCY = float(os.environ.get("SYNTHETIC_LATENCY", "0"))
+
+
+class DetectorBackend(Protocol):
+    """
+    検出器のバックエンドのインターフェース
+
+    検出結果はNMS前の (boxes, scores, labels) で、boxは渡した画像の座標系の
+    [x0, y0, x1, y1]（int）、scoreは小数第2位までのfloat。
+    """
+
+    model_id: str
+
+    def load(self) -> None:
+        """モデルを読み込む（読み込み済みなら何もしない）"""
+
+    def prepare(self, image) -> None:
+        """画像側の前処理を済ませてキャッシュする（不要なバックエンドは何もしない）"""
+
+    def detect(self, image, obj_name: str, box_threshold: float) -> tuple:
+        """1枚の画像から obj_name（"apple." や "apple. banana."）を検出する"""
+
+    def detect_batch(self, images, obj_name: str, box_threshold: float) -> list:
+        """複数の画像をまとめて検出し、画像ごとの結果を返す"""
+
+    def memory_footprint(self) -> int:
+        """読み込んだモデルが使うメモリのバイト数（未読み込みなら0）"""
+
+
+def split_query(obj_name):
+    """ "apple. push bottle." を ["apple", "push bottle"] に分ける"""
+    return [name.strip().lower() for name in obj_name.split(".") if name.strip()]
+
+
+class GroundingDinoBackend:
+    """Hugging FaceのGrounding DINOによる検出（code_executorのモデルキャッシュを使う）"""
+
+    @property
+    def model_id(self):
+        from . import code_executor
+
+        return code_executor._cached_model_id or code_executor.MODEL_CANDIDATES[0]
+
+    def load(self):
+        from . import code_executor
+
+        code_executor.get_cached_model()
+
+    def prepare(self, image):
+        from . import code_executor
+
+        processor, _ = code_executor.get_cached_model()
+        code_executor.prepare_inputs(
+            processor, [image], "object.", get_content_hash(image)
+        )
+
+    def detect(self, image, obj_name, box_threshold):
+        from . import code_executor
+
+        processor, model = code_executor.get_cached_model()
+        results = code_executor.run_detection_batch(
+            processor,
+            model,
+            [image],
+            obj_name,
+            box_threshold,
+            content_hash=get_content_hash(image),
+        )
+
+        # 自動でリストから辞書に変換
+        if isinstance(results, list) and len(results) == 1:
+            results = results[0]
+            logger.info(f"検出結果: {results}")
+        else:
+            raise ValueError("Results should be a list with one element.")
+
+        return code_executor.results_to_lists(results)
+
+    def detect_batch(self, images, obj_name, box_threshold):
+        from . import code_executor
+
+        processor, model = code_executor.get_cached_model()
+        return [
+            code_executor.results_to_lists(results)
+            for results in code_executor.run_detection_batch(
+                processor, model, images, obj_name, box_threshold
+            )
+        ]
+
+    def memory_footprint(self):
+        from . import code_executor
+
+        model = code_executor._cached_model
+        if model is None:
+            return 0
+        return sum(
+            tensor.nelement() * tensor.element_size()
+            for tensor in (*model.parameters(), *model.buffers())
+        )
+
+
+class SyntheticBackend:
+    """
+    決まった検出結果を返す合成の検出器
+
+    scriptに物体名ごとの検出結果を指定する。指定のない物体名には、物体名・
+    画像サイズ・seedから決まる擬似乱数のboxを返すため、同じ入力には常に
+    同じ結果を返す。いずれもscoreがbox_threshold未満の検出は返さない。
+    """
+
+    def __init__(
+        self,
+        script=None,
+        latency=SYNTHETIC_LATENCY,
+        per_image_latency=0.0,
+        load_latency=0.0,
+        boxes_per_object=2,
+        seed=0,
+        footprint_bytes=0,
+        model_id="synthetic",
+    ):
+        """
+        Args:
+            script (dict, optional): 物体名 -> [(box, score), ...]。boxは [x0, y0, x1, y1]
+            latency (float, optional): 1回の推論（detect・detect_batch）ごとの遅延（秒）
+            per_image_latency (float, optional): 画像1枚ごとに加える遅延（秒）
+            load_latency (float, optional): 初回のload()の遅延（秒）
+            boxes_per_object (int, optional): scriptにない物体名に返すboxの数
+            seed (int, optional): scriptにない物体名のboxを決める乱数のシード
+            footprint_bytes (int, optional): memory_footprint()が返す値
+            model_id (str, optional): キャッシュキーに使うモデルID
+        """
+        self.script = {name.lower(): list(d) for name, d in (script or {}).items()}
+        self.latency = latency
+        self.per_image_latency = per_image_latency
+        self.load_latency = load_latency
+        self.boxes_per_object = boxes_per_object
+        self.seed = seed
+        self.footprint_bytes = footprint_bytes
+        self.model_id = model_id
+        self.loaded = False
+        self.calls = []  # (obj_name, 画像の枚数)
+        self._lock = threading.Lock()
+
+    def load(self):
+        with self._lock:
+            if self.loaded:
+                return
+            time.sleep(self.load_latency)
+            self.loaded = True
+
+    def prepare(self, image):
+        pass
+
+    def _detections_for(self, name, image_size):
+        if name in self.script:
+            return self.script[name]
+        width, height = image_size
+        rng = random.Random(f"{self.seed}:{name}:{width}x{height}")
+        detections = []
+        for _ in range(self.boxes_per_object):
+            box_width = rng.randint(1, max(1, width // 4))
+            box_height = rng.randint(1, max(1, height // 4))
+            x0 = rng.randint(0, max(0, width - box_width))
+            y0 = rng.randint(0, max(0, height - box_height))
+            score = round(rng.uniform(0.35, 0.95), 2)
+            detections.append(([x0, y0, x0 + box_width, y0 + box_height], score))
+        return detections
+
+    def _detect_one(self, image, obj_name, box_threshold):
+        boxes, scores, labels = [], [], []
+        for name in split_query(obj_name):
+            for box, score in self._detections_for(name, image.size):
+                if score >= box_threshold:
+                    boxes.append([int(v) for v in box])
+                    scores.append(round(float(score), 2))
+                    labels.append(name)
+        return boxes, scores, labels
+
+    def detect(self, image, obj_name, box_threshold):
+        return self.detect_batch([image], obj_name, box_threshold)[0]
+
+    def detect_batch(self, images, obj_name, box_threshold):
+        self.load()
+        with self._lock:
+            self.calls.append((obj_name, len(images)))
+        time.sleep(self.latency + self.per_image_latency * len(images))
+        return [self._detect_one(image, obj_name, box_threshold) for image in images]
+
+    def memory_footprint(self):
+        return self.footprint_bytes if self.loaded else 0
+
+
+def create_backend(name=DETECTOR_BACKEND):
+    """名前に対応するバックエンドを作成する"""
+    if name == "synthetic":
+        return SyntheticBackend()
+    if name in ("grounding-dino", "hf"):
+        return GroundingDinoBackend()
+    raise ValueError(f"不明な検出器のバックエンドです: {name}")
+
+
+_detector_backend = None
+_detector_backend_lock = threading.Lock()
+
+
+def get_detector_backend():
+    """プロセス全体で使う検出器のバックエンドを返す"""
+    global _detector_backend
+    if _detector_backend is None:
+        with _detector_backend_lock:
+            if _detector_backend is None:
+                _detector_backend = create_backend()
+                logger.info(f"検出器のバックエンド: {type(_detector_backend).__name__}")
+    return _detector_backend
+
+
+def set_detector_backend(backend):
+    """
+    検出器のバックエンドを差し替える
+
+    Returns:
+        DetectorBackend | None: それまで使われていたバックエンド
+    """
+    global _detector_backend
+    with _detector_backend_lock:
+        previous = _detector_backend
+        _detector_backend = backend
+    return previous
+
+
+@contextmanager
+def use_detector_backend(backend):
+    """ブロックの間だけ検出器のバックエンドを差し替える（テスト・ベンチマーク用）"""
+    previous = set_detector_backend(backend)
+    try:
+        yield backend
+    finally:
+        set_detector_backend(previous)
@@ -0,0 +1,159 @@
+"""
+複数プロセスで共有できるディスク上のキャッシュ
+
+SQLite（WALモード）に値をバイト列で保存する。同じディレクトリを参照する
+ワーカー間で読み書きを共有でき、合計サイズが上限を超えると最終アクセスが
+古いエントリから削除する（LRU）。
+"""
+
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class DiskCache:
+    """SQLiteを使ったサイズ上限付きのディスクキャッシュ"""
+
+    def __init__(self, directory, max_bytes, filename="cache.sqlite3"):
+        """
+        Args:
+            directory (str): キャッシュを保存するディレクトリ
+            max_bytes (int): 保存する値の合計バイト数の上限
+            filename (str, optional): SQLiteファイル名
+        """
+        os.makedirs(directory, exist_ok=True)
+        self.path = os.path.join(directory, filename)
+        self.max_bytes = max_bytes
+        self._local = threading.local()
+        self._stats_lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.writes = 0
+        self.evictions = 0
+
+        with self._connect() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS entries ("
+                " key TEXT PRIMARY KEY,"
+                " value BLOB NOT NULL,"
+                " size INTEGER NOT NULL,"
+                " last_access REAL NOT NULL)"
+            )
+            conn.execute(
+                "CREATE INDEX IF NOT EXISTS entries_last_access"
+                " ON entries (last_access)"
+            )
+
+    def _connect(self):
+        """スレッドごとのSQLite接続を返す"""
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            # 他プロセスが書き込み中の場合は最大30秒待つ
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def get(self, key):
+        """キーに対応するバイト列を返す（見つからない場合はNone）"""
+        try:
+            conn = self._connect()
+            row = conn.execute(
+                "SELECT value FROM entries WHERE key = ?", (key,)
+            ).fetchone()
+            if row is not None:
+                conn.execute(
+                    "UPDATE entries SET last_access = ? WHERE key = ?",
+                    (time.time(), key),
+                )
+        except sqlite3.Error as e:
+            logger.warning(f"ディスクキャッシュの読み込みに失敗: {e}")
+            row = None
+
+        with self._stats_lock:
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+        return bytes(row[0])
+
+    def put(self, key, value):
+        """バイト列を保存し、上限を超えた分を古い順に削除する"""
+        size = len(value)
+        if size > self.max_bytes:
+            return False
+
+        try:
+            conn = self._connect()
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                conn.execute(
+                    "INSERT OR REPLACE INTO entries (key, value, size, last_access)"
+                    " VALUES (?, ?, ?, ?)",
+                    (key, sqlite3.Binary(value), size, time.time()),
+                )
+                evicted = self._evict(conn)
+                conn.execute("COMMIT")
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+        except sqlite3.Error as e:
+            logger.warning(f"ディスクキャッシュへの書き込みに失敗: {e}")
+            return False
+
+        with self._stats_lock:
+            self.writes += 1
+            self.evictions += evicted
+        return True
+
+    def _evict(self, conn):
+        """合計サイズが上限以下になるまで最終アクセスが古いものから削除する"""
+        total = conn.execute("SELECT COALESCE(SUM(size), 0) FROM entries").fetchone()[0]
+        evicted = 0
+        while total > self.max_bytes:
+            rows = conn.execute(
+                "SELECT key, size FROM entries ORDER BY last_access LIMIT 32"
+            ).fetchall()
+            if not rows:
+                break
+            for key, size in rows:
+                if total <= self.max_bytes:
+                    break
+                conn.execute("DELETE FROM entries WHERE key = ?", (key,))
+                total -= size
+                evicted += 1
+        return evicted
+
+    def clear(self):
+        """すべてのエントリと統計を削除する"""
+        self._connect().execute("DELETE FROM entries")
+        with self._stats_lock:
+            self.hits = 0
+            self.misses = 0
+            self.writes = 0
+            self.evictions = 0
+
+    def stats(self):
+        """ヒット率などの統計を返す（ヒット・ミスはこのプロセスでの回数）"""
+        entries, total = (
+            self._connect()
+            .execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM entries")
+            .fetchone()
+        )
+        with self._stats_lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": entries,
+                "bytes": total,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "writes": self.writes,
+                "evictions": self.evictions,
+                "hit_ratio": self.hits / lookups if lookups else 0.0,
+            }
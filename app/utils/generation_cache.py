@@ -0,0 +1,110 @@
+"""
+生成されたプログラムのディスクキャッシュ
+
+同じ正常条件からのコード生成は毎回数秒のLLM呼び出しになるため、
+正規化した条件・モデル・プロンプトのバージョンをキーに、検証済みの
+関数をディスクに保存してセッションやプロセスをまたいで再利用する。
+"""
+
+import hashlib
+import json
+import os
+import re
+import tempfile
+import threading
+import time
+import unicodedata
+
+from .disk_cache import DiskCache
+
+# キャッシュの保存先（空文字を設定すると無効）
+GENERATION_CACHE_DIR = os.environ.get(
+    "GENERATION_CACHE_DIR",
+    os.path.join(tempfile.gettempdir(), "streamlit_ad_app", "generation_cache"),
+)
+GENERATION_CACHE_MAX_BYTES = int(
+    os.environ.get("GENERATION_CACHE_MAX_BYTES", str(64 * 1024 * 1024))
+)
+
+# 行頭の箇条書き記号（"- ", "・", "1." など）
+_BULLET = re.compile(r"^\s*(?:[-*+・•]\s*|\d+[.)]\s+)")
+
+
+def normalize_conditions(normal_conditions):
+    """
+    条件テキストを正規化した条件のリストにする
+
+    全角・半角の揺れ（NFKC）、箇条書き記号、空白、空行、重複、並び順の違いを吸収する。
+
+    Args:
+        normal_conditions (str): 改行区切りの条件テキスト
+
+    Returns:
+        list: 正規化してソートした条件
+    """
+    conditions = set()
+    for line in unicodedata.normalize("NFKC", normal_conditions).splitlines():
+        condition = re.sub(r"\s+", " ", _BULLET.sub("", line)).strip()
+        if condition:
+            conditions.add(condition)
+    return sorted(conditions)
+
+
+def make_generation_key(normal_conditions, model_id, prompt_version):
+    """
+    生成結果のキャッシュキーを作成する
+
+    Args:
+        normal_conditions (str): 改行区切りの条件テキスト
+        model_id (str): 生成に使用するモデル
+        prompt_version (str): プロンプトテンプレートのバージョン（ハッシュ）
+    """
+    payload = {
+        "conditions": normalize_conditions(normal_conditions),
+        "model": model_id,
+        "prompt": prompt_version,
+    }
+    encoded = json.dumps(payload, sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(encoded.encode("utf-8")).hexdigest()
+
+
+class GenerationCache:
+    """生成された関数をディスクに保存するキャッシュ"""
+
+    def __init__(self, directory, max_bytes=GENERATION_CACHE_MAX_BYTES):
+        self._store = DiskCache(directory, max_bytes, filename="generations.sqlite3")
+
+    def get(self, key):
+        """キャッシュされたコードを返す（見つからない場合はNone）"""
+        data = self._store.get(key)
+        if data is None:
+            return None
+        try:
+            return json.loads(data.decode("utf-8"))["code"]
+        except (ValueError, KeyError):
+            return None
+
+    def put(self, key, code):
+        """検証済みのコードを保存する"""
+        data = json.dumps({"code": code, "created": time.time()}, ensure_ascii=False)
+        return self._store.put(key, data.encode("utf-8"))
+
+    def clear(self):
+        self._store.clear()
+
+    def stats(self):
+        return self._store.stats()
+
+
+_generation_cache = None
+_generation_cache_lock = threading.Lock()
+
+
+def get_generation_cache():
+    """プロセスで共有する生成キャッシュを返す（無効な場合はNone）"""
+    global _generation_cache
+    if _generation_cache is None and GENERATION_CACHE_DIR:
+        with _generation_cache_lock:
+            if _generation_cache is None:
+                _generation_cache = GenerationCache(GENERATION_CACHE_DIR)
+    return _generation_cache
@@ -0,0 +1,207 @@
+"""
+ファイル内容のハッシュをキーにしたデコード済み画像のキャッシュ
+
+同じ画像の再デコードを避けるため、プロセス全体（全セッション）で共有する。
+- デコード済みのRGB配列（読み込み時の最大辺ごと）
+- プレビュー用のサムネイル
+- アクティブなモデルのプロセッサが作成したpixel tensor
+"""
+
+import hashlib
+import logging
+import os
+import threading
+
+import numpy as np
+from PIL import Image
+
+from .cache import BoundedCache
+
+logger = logging.getLogger(__name__)
+
+# デコード済み画像とサムネイルの合計バイト数の上限
+IMAGE_CACHE_MAX_BYTES = int(
+    os.environ.get("IMAGE_CACHE_MAX_BYTES", str(256 * 1024 * 1024))
+)
+# プロセッサ出力（pixel tensor）の合計バイト数の上限
+PIXEL_CACHE_MAX_BYTES = int(
+    os.environ.get("PIXEL_CACHE_MAX_BYTES", str(256 * 1024 * 1024))
+)
+# プレビュー用サムネイルの最大辺
+PREVIEW_MAX_SIDE = 400
+
+
+def file_content_hash(path, chunk_size=1024 * 1024):
+    """ファイル内容のSHA-256ハッシュを返す"""
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def set_content_hash(image, content_hash):
+    """
+    読み込んだ画像オブジェクト自身に内容ハッシュを記録する
+
+    image.infoはcrop()・resize()・copy()で派生画像にもコピーされるため、
+    PILが引き継がない属性に保持する。派生画像はハッシュを持たない。
+    """
+    image._content_hash = content_hash
+
+
+def get_content_hash(image):
+    """読み込んだ画像の内容ハッシュを返す（派生画像や記録のない画像はNone）"""
+    return getattr(image, "_content_hash", None)
+
+
+def set_original_size(image, original_size):
+    """
+    縮小して読み込んだ画像オブジェクト自身に元のサイズ (width, height) を記録する
+
+    内容ハッシュと同じく派生画像には引き継がれないため、切り出しや縮小をした
+    画像では画像そのもののサイズが元のサイズになる。
+    """
+    image._original_size = tuple(original_size)
+
+
+def get_original_size(image):
+    """縮小して読み込まれた画像の元のサイズ (width, height) を返す"""
+    return getattr(image, "_original_size", image.size)
+
+
+def _tensor_nbytes(inputs):
+    """プロセッサ出力に含まれるtensorの合計バイト数を返す"""
+    total = 0
+    for value in inputs.values():
+        if hasattr(value, "element_size") and hasattr(value, "nelement"):
+            total += value.element_size() * value.nelement()
+    return total
+
+
+class DecodedImageCache:
+    """デコード済み画像・サムネイル・pixel tensorのキャッシュ"""
+
+    def __init__(
+        self,
+        max_bytes=IMAGE_CACHE_MAX_BYTES,
+        pixel_max_bytes=PIXEL_CACHE_MAX_BYTES,
+    ):
+        """
+        Args:
+            max_bytes (int): デコード済み画像とサムネイルのバイト数上限
+            pixel_max_bytes (int): pixel tensorのバイト数上限
+        """
+        self.images = BoundedCache(max_bytes)
+        self.pixels = BoundedCache(pixel_max_bytes)
+        # (path, mtime, size) -> ハッシュ。同じファイルの再ハッシュを避ける
+        self._hash_memo = {}
+        self._lock = threading.Lock()
+
+    def content_hash(self, path):
+        """ファイル内容のハッシュを返す（更新されていなければ前回の値を再利用）"""
+        stat = os.stat(path)
+        memo_key = (os.path.abspath(path), stat.st_mtime_ns, stat.st_size)
+        with self._lock:
+            cached = self._hash_memo.get(memo_key)
+        if cached is not None:
+            return cached
+
+        content_hash = file_content_hash(path)
+        with self._lock:
+            if len(self._hash_memo) > 1024:
+                self._hash_memo.clear()
+            self._hash_memo[memo_key] = content_hash
+        return content_hash
+
+    def get_image(self, path, max_side, decode):
+        """
+        デコード済みのRGB画像を返す
+
+        Args:
+            path (str): 画像ファイルのパス
+            max_side (int | None): 読み込み時の最大辺
+            decode (callable): キャッシュミス時に呼ぶ decode(path, max_side) -> PIL.Image
+
+        Returns:
+            PIL.Image.Image: RGB画像。内容ハッシュ（get_content_hash）と
+            元のサイズ（get_original_size）を持つ
+        """
+        content_hash = self.content_hash(path)
+        key = ("rgb", content_hash, max_side or 0)
+
+        entry = self.images.get(key)
+        if entry is None:
+            image = decode(path, max_side)
+            array = np.asarray(image)
+            original_size = get_original_size(image)
+            entry = (array, original_size)
+            self.images.put(key, entry, size=array.nbytes)
+        else:
+            logger.info(f"デコード済み画像のキャッシュを使用: {content_hash[:12]}")
+
+        array, original_size = entry
+        # fromarrayは新しい画像を作成するため、呼び出し側で変更してもキャッシュは汚れない
+        image = Image.fromarray(array)
+        set_original_size(image, original_size)
+        set_content_hash(image, content_hash)
+        return image
+
+    def get_preview(self, path, max_side=PREVIEW_MAX_SIDE):
+        """プレビュー用のサムネイル画像を返す"""
+        content_hash = self.content_hash(path)
+        key = ("preview", content_hash, max_side)
+
+        preview = self.images.get(key)
+        if preview is None:
+            with Image.open(path) as image:
+                image.draft("RGB", (max_side, max_side))
+                preview = image.convert("RGB")
+            preview.thumbnail((max_side, max_side))
+            self.images.put(
+                key, preview, size=preview.width * preview.height * len("RGB")
+            )
+        return preview
+
+    def get_pixel_inputs(self, content_hash, image_size, model_id, compute):
+        """
+        プロセッサが作成したpixel tensor（pixel_values, pixel_mask）を返す
+
+        Args:
+            content_hash (str): 画像ファイルのハッシュ
+            image_size (tuple): プロセッサに渡す画像のサイズ
+            model_id (str): アクティブなモデルID
+            compute (callable): キャッシュミス時に呼ぶ関数（プロセッサ出力を返す）
+        """
+        key = ("pixels", content_hash, tuple(image_size), model_id)
+
+        pixel_inputs = self.pixels.get(key)
+        if pixel_inputs is None:
+            pixel_inputs = compute()
+            self.pixels.put(key, pixel_inputs, size=_tensor_nbytes(pixel_inputs))
+        return pixel_inputs
+
+    def clear(self):
+        """すべてのキャッシュを削除する"""
+        self.images.clear()
+        self.pixels.clear()
+        with self._lock:
+            self._hash_memo.clear()
+
+    def stats(self):
+        """キャッシュの統計を返す"""
+        return {"images": self.images.stats(), "pixels": self.pixels.stats()}
+
+
+_image_cache = None
+_image_cache_lock = threading.Lock()
+
+
+def get_image_cache():
+    """プロセス全体で共有する画像キャッシュを返す"""
+    global _image_cache
+    if _image_cache is None:
+        with _image_cache_lock:
+            if _image_cache is None:
+                _image_cache = DecodedImageCache()
+    return _image_cache
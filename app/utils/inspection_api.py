@@ -0,0 +1,310 @@
+"""
+検査のHTTP API（ヘッドレス）
+
+ラインのコントローラなどからStreamlitの画面を介さずに検査するためのAPI。
+生成済みのプログラムを登録し、画像（1枚、またはmultipartで複数枚）を送ると
+execute_codeと同じ形式の結果をJSONで返す。
+
+- 検出モデル・各種キャッシュはexecute_codeと共有する。API_PORT を設定すると
+  Streamlitのプロセス内でも起動し、画面と同じロード済みのモデルを使う
+- 同時に実行する検査数と待ち行列の長さに上限があり、超えた要求は503を返す
+- 登録したプログラムはサーバー上で実行されるため、/programs 以下の要求には
+  API_TOKEN と同じトークンを Authorization: Bearer <トークン> で付ける必要がある。
+  API_TOKEN が未設定の場合はこれらの要求をすべて拒否し、サーバーも起動しない
+
+単体で起動する場合（リポジトリのルートで）:
+    API_TOKEN=... uvicorn app.utils.inspection_api:app --port 8000
+"""
+
+import hashlib
+import hmac
+import logging
+import os
+import tempfile
+import threading
+from contextlib import contextmanager
+
+from fastapi import Depends, FastAPI, File, Form, Header, HTTPException, UploadFile
+from fastapi.responses import Response
+from pydantic import BaseModel
+
+from .cache import BoundedCache
+from .code_executor import dry_run_code, execute_code
+from .metrics import CONTENT_TYPE, REGISTRY, Gauge, render_metrics
+
+logger = logging.getLogger(__name__)
+
+# APIを公開するポート（Streamlitのプロセス内で起動する場合。未設定なら起動しない）
+API_PORT = os.environ.get("API_PORT", "")
+# 外部に公開する場合のみ 0.0.0.0 などを設定する
+API_HOST = os.environ.get("API_HOST", "127.0.0.1")
+# /programs 以下の要求に必要なトークン（未設定ならすべて拒否する）
+API_TOKEN = os.environ.get("API_TOKEN", "")
+# 同時に実行する検査数
+API_MAX_CONCURRENCY = int(os.environ.get("API_MAX_CONCURRENCY", "2"))
+# 実行を待つことができる検査数（超えた要求は503）
+API_MAX_QUEUE = int(os.environ.get("API_MAX_QUEUE", "16"))
+# 1枚の画像の最大バイト数
+API_MAX_UPLOAD_BYTES = int(
+    os.environ.get("API_MAX_UPLOAD_BYTES", str(20 * 1024 * 1024))
+)
+# 保持する登録済みプログラムの数
+API_MAX_PROGRAMS = int(os.environ.get("API_MAX_PROGRAMS", "256"))
+
+ALLOWED_EXTENSIONS = (".png", ".jpg", ".jpeg")
+
+
+class QueueFullError(Exception):
+    """待ち行列が上限に達している"""
+
+
+class InspectionQueue:
+    """同時実行数と待ち行列の長さに上限のある実行枠"""
+
+    def __init__(self, max_concurrency=API_MAX_CONCURRENCY, max_queue=API_MAX_QUEUE):
+        """
+        Args:
+            max_concurrency (int): 同時に実行する検査数
+            max_queue (int): 実行を待つことができる検査数
+        """
+        self.max_concurrency = max_concurrency
+        self.max_queue = max_queue
+        self._slots = threading.Semaphore(max_concurrency)
+        self._lock = threading.Lock()
+        self.running = 0
+        self.waiting = 0
+        self.rejected = 0
+
+    @contextmanager
+    def slot(self):
+        """
+        実行枠を確保する（空きがなければ待ち、待ち行列も満杯ならQueueFullError）
+        """
+        with self._lock:
+            if self.running + self.waiting >= self.max_concurrency + self.max_queue:
+                self.rejected += 1
+                raise QueueFullError("検査の待ち行列が満杯です")
+            self.waiting += 1
+        self._slots.acquire()
+        with self._lock:
+            self.waiting -= 1
+            self.running += 1
+        try:
+            yield
+        finally:
+            with self._lock:
+                self.running -= 1
+            self._slots.release()
+
+    def stats(self):
+        with self._lock:
+            return {
+                "running": self.running,
+                "waiting": self.waiting,
+                "rejected": self.rejected,
+            }
+
+
+class ProgramRequest(BaseModel):
+    code: str
+
+
+def program_id_for(code):
+    """プログラムのID（コードの内容のハッシュ）"""
+    return hashlib.sha256(code.encode("utf-8")).hexdigest()[:16]
+
+
+def _save_upload(upload, directory):
+    """アップロードされた画像を検証して一時ディレクトリに保存する"""
+    filename = os.path.basename(upload.filename or "image.png")
+    extension = os.path.splitext(filename)[1].lower()
+    if extension not in ALLOWED_EXTENSIONS:
+        raise HTTPException(
+            status_code=415, detail=f"対応していない画像形式です: {filename}"
+        )
+    data = upload.file.read(API_MAX_UPLOAD_BYTES + 1)
+    if len(data) > API_MAX_UPLOAD_BYTES:
+        raise HTTPException(status_code=413, detail=f"画像が大きすぎます: {filename}")
+
+    fd, path = tempfile.mkstemp(suffix=extension, dir=directory)
+    with os.fdopen(fd, "wb") as f:
+        f.write(data)
+    return filename, path
+
+
+def _token_checker(token):
+    """Authorizationヘッダーのトークンを検証するFastAPIの依存関係を作成する"""
+
+    def check_token(authorization: str = Header("")):
+        if not token:
+            raise HTTPException(
+                status_code=401, detail="API_TOKENが設定されていないため利用できません"
+            )
+        scheme, _, value = authorization.partition(" ")
+        if scheme.lower() != "bearer" or not hmac.compare_digest(
+            value.encode("utf-8"), token.encode("utf-8")
+        ):
+            raise HTTPException(
+                status_code=401,
+                detail="トークンが正しくありません",
+                headers={"WWW-Authenticate": "Bearer"},
+            )
+
+    return check_token
+
+
+def create_app(
+    max_concurrency=API_MAX_CONCURRENCY, max_queue=API_MAX_QUEUE, token=API_TOKEN
+):
+    """
+    検査APIのFastAPIアプリを作成する
+
+    Args:
+        max_concurrency (int, optional): 同時に実行する検査数
+        max_queue (int, optional): 実行を待つことができる検査数
+        token (str, optional): /programs 以下の要求に必要なトークン
+
+    Returns:
+        FastAPI: アプリ。app.state.queue と app.state.programs を持つ
+    """
+    app = FastAPI(title="streamlit-ad-app inspection API")
+    queue = InspectionQueue(max_concurrency, max_queue)
+    programs = BoundedCache(max_bytes=64 * 1024 * 1024, max_entries=API_MAX_PROGRAMS)
+    app.state.queue = queue
+    app.state.programs = programs
+    authorized = [Depends(_token_checker(token))]
+
+    def get_program(program_id):
+        code = programs.get(program_id)
+        if code is None:
+            raise HTTPException(
+                status_code=404, detail=f"プログラムが見つかりません: {program_id}"
+            )
+        return code
+
+    def inspect_files(program_id, images, box_threshold, tiled):
+        code = get_program(program_id)
+        results = []
+        with tempfile.TemporaryDirectory(prefix="inspection_api_") as directory:
+            saved = [_save_upload(image, directory) for image in images]
+            try:
+                with queue.slot():
+                    for filename, path in saved:
+                        result = execute_code(
+                            code,
+                            path,
+                            box_threshold,
+                            tiled=tiled,
+                            session_id=f"api:{program_id}",
+                        )
+                        results.append({"filename": filename, **result})
+            except QueueFullError as e:
+                raise HTTPException(
+                    status_code=503, detail=str(e), headers={"Retry-After": "1"}
+                ) from e
+        return results
+
+    @app.get("/health")
+    def health():
+        return {"status": "ok", "queue": queue.stats()}
+
+    @app.post("/programs", status_code=201, dependencies=authorized)
+    def register_program(request: ProgramRequest):
+        """生成済みのプログラムを検証して登録する"""
+        try:
+            dry_run_code(request.code)
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e)) from e
+        program_id = program_id_for(request.code)
+        programs.put(program_id, request.code, size=len(request.code))
+        logger.info(f"プログラムを登録: {program_id}")
+        return {"program_id": program_id}
+
+    @app.get("/programs/{program_id}", dependencies=authorized)
+    def read_program(program_id: str):
+        return {"program_id": program_id, "code": get_program(program_id)}
+
+    @app.delete("/programs/{program_id}", status_code=204, dependencies=authorized)
+    def delete_program(program_id: str):
+        if programs.pop(program_id) is None:
+            raise HTTPException(
+                status_code=404, detail=f"プログラムが見つかりません: {program_id}"
+            )
+        return Response(status_code=204)
+
+    @app.post("/programs/{program_id}/inspect", dependencies=authorized)
+    def inspect(
+        program_id: str,
+        image: UploadFile = File(...),
+        box_threshold: float = Form(0.3, ge=0.0, le=1.0),
+        tiled: bool = Form(False),
+    ):
+        """画像1枚を検査してexecute_codeの結果を返す"""
+        return inspect_files(program_id, [image], box_threshold, tiled)[0]
+
+    @app.post("/programs/{program_id}/inspect/batch", dependencies=authorized)
+    def inspect_batch(
+        program_id: str,
+        images: list[UploadFile] = File(...),
+        box_threshold: float = Form(0.3, ge=0.0, le=1.0),
+        tiled: bool = Form(False),
+    ):
+        """複数の画像を検査し、送られた順に結果を返す"""
+        return {"results": inspect_files(program_id, images, box_threshold, tiled)}
+
+    @app.get("/metrics")
+    def metrics():
+        return Response(render_metrics(), media_type=CONTENT_TYPE)
+
+    return app
+
+
+def _collect_queue():
+    """共有のアプリの待ち行列の長さをメトリクスにする"""
+    stats = app.state.queue.stats()
+    depth = Gauge("ad_api_queue", "検査APIの実行中・待機中の要求数", ["state"])
+    depth.set(stats["running"], state="running")
+    depth.set(stats["waiting"], state="waiting")
+    rejected = Gauge("ad_api_rejected", "待ち行列が満杯で拒否した要求数")
+    rejected.set(stats["rejected"])
+    return [depth, rejected]
+
+
+app = create_app()
+REGISTRY.add_collector(_collect_queue)
+
+_api_server = None
+_api_server_lock = threading.Lock()
+
+
+def start_api_server(port=None, host=API_HOST):
+    """
+    検査APIをデーモンスレッドで起動する（プロセスで1回だけ）
+
+    Streamlitのプロセス内で起動すると、画面からの実行と同じモデルを共有する。
+
+    Returns:
+        uvicorn.Server | None: 起動したサーバー（ポート・トークンが未設定の場合はNone）
+    """
+    global _api_server
+    port = port or API_PORT
+    if not port:
+        return None
+    if not API_TOKEN:
+        logger.warning("API_TOKENが設定されていないため検査APIを起動しません")
+        return None
+    if _api_server is None:
+        with _api_server_lock:
+            if _api_server is None:
+                import uvicorn
+
+                config = uvicorn.Config(
+                    app, host=host, port=int(port), log_level="warning"
+                )
+                server = uvicorn.Server(config)
+                threading.Thread(
+                    target=server.run, name="inspection-api", daemon=True
+                ).start()
+                logger.info(f"検査APIを公開: http://{host}:{port}")
+                _api_server = server
+    return _api_server
@@ -0,0 +1,259 @@
+"""
+コード生成・実行のバックグラウンドジョブ
+
+Streamlitのスクリプトスレッドで生成や実行をそのまま行うと、終わるまで
+そのセッションの他の操作がすべて待たされる。処理をスレッドプールで実行し、
+状態と結果を分離されたセッションのIDごとに保持する。画面側は状態を
+ポーリングして進捗を表示し、キャンセルを要求できる。
+
+スレッドプールはジョブの種類ごとに分けるため、時間のかかる生成ジョブが
+並んでも実行ジョブは待たされない。実行ジョブの同時実行数はメモリの予算
+（admission）で制御されるため、プールは大きめにしている。
+"""
+
+import logging
+import os
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+# 種類ごとに同時に実行するジョブ数の上限（プロセス全体）
+JOB_MAX_WORKERS = int(os.environ.get("JOB_MAX_WORKERS", "4"))
+# 実行ジョブの上限（実際に同時に実行される数はメモリの予算で決まる）
+JOB_EXECUTE_WORKERS = int(os.environ.get("JOB_EXECUTE_WORKERS", "16"))
+# 終了したジョブを保持する秒数
+JOB_RETENTION = float(os.environ.get("JOB_RETENTION", "3600"))
+
+# ジョブの状態
+PENDING = "pending"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+CANCELLED = "cancelled"
+FINISHED_STATUSES = (DONE, FAILED, CANCELLED)
+
+
+class Job:
+    """1回の生成・実行ジョブの状態"""
+
+    def __init__(self, session_id, kind):
+        self.id = uuid.uuid4().hex
+        self.session_id = session_id
+        self.kind = kind
+        self.status = PENDING
+        self.progress = ""  # 途中経過（生成中のコードなど）
+        self.result = None
+        self.error = None
+        self.acknowledged = False  # 画面に結果を反映済みか
+        self.created_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        self.future = None
+        self._cancel_event = threading.Event()
+
+    def cancelled(self):
+        """キャンセルが要求されたか（処理側のshould_stopとして使う）"""
+        return self._cancel_event.is_set()
+
+    def set_progress(self, text):
+        """途中経過を更新する"""
+        self.progress = text
+
+    @property
+    def done(self):
+        return self.status in FINISHED_STATUSES
+
+    def queued_for(self):
+        """登録から開始（未開始の場合は現在）までの秒数"""
+        return (self.started_at or time.time()) - self.created_at
+
+    def elapsed(self):
+        """開始からの経過秒数（未開始の場合は0）"""
+        if self.started_at is None:
+            return 0.0
+        return (self.finished_at or time.time()) - self.started_at
+
+
+class JobManager:
+    """セッションごとのジョブを種類ごとのスレッドプールで実行・管理する"""
+
+    def __init__(
+        self, max_workers=JOB_MAX_WORKERS, retention=JOB_RETENTION, kind_workers=None
+    ):
+        """
+        Args:
+            max_workers (int): 種類ごとに同時に実行するジョブ数の上限
+            retention (float): 終了したジョブを保持する秒数
+            kind_workers (dict, optional): 種類 -> 上限。指定のない種類はmax_workers。
+                省略時は実行ジョブのみ JOB_EXECUTE_WORKERS
+        """
+        self.retention = retention
+        self.max_workers = max_workers
+        self.kind_workers = (
+            {"execute": JOB_EXECUTE_WORKERS} if kind_workers is None else kind_workers
+        )
+        self._executors = {}  # kind -> ThreadPoolExecutor
+        self._jobs = {}  # job_id -> Job
+        self._lock = threading.Lock()
+
+    def _executor_for(self, kind):
+        """種類ごとのスレッドプールを返す（ロック保持中に呼ぶ）"""
+        executor = self._executors.get(kind)
+        if executor is None:
+            executor = ThreadPoolExecutor(
+                max_workers=self.kind_workers.get(kind, self.max_workers),
+                thread_name_prefix=f"job-{kind}",
+            )
+            self._executors[kind] = executor
+        return executor
+
+    def submit(self, session_id, kind, func, *args, **kwargs):
+        """
+        ジョブを登録して実行を開始する
+
+        同じセッション・種類の未完了のジョブはキャンセルする。
+
+        Args:
+            session_id (str): 分離されたセッションのID
+            kind (str): ジョブの種類（"generate", "execute"など）
+            func (callable): func(job, *args, **kwargs) の形で呼び出す処理
+
+        Returns:
+            Job: 登録したジョブ
+        """
+        for previous in self.session_jobs(session_id, kind):
+            if not previous.done:
+                self.cancel(previous.id)
+
+        job = Job(session_id, kind)
+        with self._lock:
+            self._prune()
+            self._jobs[job.id] = job
+            executor = self._executor_for(kind)
+        job.future = executor.submit(self._run, job, func, args, kwargs)
+        logger.info(f"ジョブを登録: {kind} ({job.id[:8]})")
+        return job
+
+    def _run(self, job, func, args, kwargs):
+        if job.cancelled():
+            self._finish(job, CANCELLED)
+            return
+        job.status = RUNNING
+        job.started_at = time.time()
+        try:
+            result = func(job, *args, **kwargs)
+        except Exception as e:
+            job.error = e
+            if job.cancelled():
+                self._finish(job, CANCELLED)
+            else:
+                logger.error(f"ジョブが失敗しました: {job.kind} ({job.id[:8]}): {e}")
+                self._finish(job, FAILED)
+            return
+        if job.cancelled():
+            # 中断できない処理は完了まで実行されるが、結果は使わない
+            self._finish(job, CANCELLED)
+        else:
+            job.result = result
+            self._finish(job, DONE)
+
+    def _finish(self, job, status):
+        job.finished_at = time.time()
+        job.status = status
+        logger.info(
+            f"ジョブが終了: {job.kind} ({job.id[:8]}) {status}, {job.elapsed():.2f}秒"
+        )
+
+    def get(self, job_id):
+        """IDに対応するジョブを返す（見つからない場合はNone）"""
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def session_jobs(self, session_id, kind=None):
+        """セッションのジョブを登録順に返す"""
+        with self._lock:
+            return [
+                job
+                for job in self._jobs.values()
+                if job.session_id == session_id and (kind is None or job.kind == kind)
+            ]
+
+    def latest(self, session_id, kind):
+        """セッションで最後に登録された種類kindのジョブを返す"""
+        jobs = self.session_jobs(session_id, kind)
+        return jobs[-1] if jobs else None
+
+    def cancel(self, job_id):
+        """ジョブのキャンセルを要求する（対象がない・終了済みの場合はFalse）"""
+        job = self.get(job_id)
+        if job is None or job.done:
+            return False
+        job._cancel_event.set()
+        if job.future is not None and job.future.cancel():
+            # まだ開始していないジョブはその場でキャンセル済みにする
+            self._finish(job, CANCELLED)
+        return True
+
+    def acknowledge(self, job_id):
+        """ジョブの結果を画面に反映済みにする"""
+        job = self.get(job_id)
+        if job is not None:
+            job.acknowledged = True
+
+    def clear_session(self, session_id):
+        """セッションのジョブをキャンセルして削除する"""
+        for job in self.session_jobs(session_id):
+            self.cancel(job.id)
+        with self._lock:
+            for job_id in [
+                job_id
+                for job_id, job in self._jobs.items()
+                if job.session_id == session_id
+            ]:
+                del self._jobs[job_id]
+
+    def _prune(self):
+        """保持期間を過ぎた終了済みのジョブを削除する（ロック保持中に呼ぶ）"""
+        now = time.time()
+        expired = [
+            job_id
+            for job_id, job in self._jobs.items()
+            if job.done and now - job.finished_at > self.retention
+        ]
+        for job_id in expired:
+            del self._jobs[job_id]
+
+    def stats(self):
+        """状態ごとのジョブ数を返す"""
+        with self._lock:
+            counts = dict.fromkeys((PENDING, RUNNING, *FINISHED_STATUSES), 0)
+            for job in self._jobs.values():
+                counts[job.status] += 1
+            return counts
+
+    def shutdown(self, wait=True):
+        """すべてのジョブをキャンセルしてスレッドプールを停止する"""
+        with self._lock:
+            jobs = list(self._jobs.values())
+            executors = list(self._executors.values())
+        for job in jobs:
+            self.cancel(job.id)
+        for executor in executors:
+            executor.shutdown(wait=wait, cancel_futures=True)
+
+
+_job_manager = None
+_job_manager_lock = threading.Lock()
+
+
+def get_job_manager():
+    """プロセス全体で共有するジョブマネージャを返す"""
+    global _job_manager
+    if _job_manager is None:
+        with _job_manager_lock:
+            if _job_manager is None:
+                _job_manager = JobManager()
+    return _job_manager
@@ -0,0 +1,369 @@
+"""
+Prometheus形式のメトリクス
+
+検出・実行・モデルロードのカウンタとヒストグラムをプロセス内に集計し、
+キャッシュのヒット率・RSS・ジョブのキュー長などの現在値と合わせて
+Prometheusのテキスト形式で出力する。METRICS_PORT を設定すると、
+Streamlitとは別のポートでFastAPI（uvicorn）の /metrics を公開する。
+"""
+
+import logging
+import math
+import os
+import threading
+
+import psutil
+
+logger = logging.getLogger(__name__)
+
+# メトリクスを公開するポート（未設定の場合はサーバーを起動しない）
+METRICS_PORT = os.environ.get("METRICS_PORT", "")
+# 外部に公開する場合のみ 0.0.0.0 などを設定する
+METRICS_HOST = os.environ.get("METRICS_HOST", "127.0.0.1")
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# 検出（キャッシュヒットを含む）と実行の所要時間のバケット（秒）
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+# モデルのロードは数秒から数分かかる
+MODEL_LOAD_BUCKETS = (1, 2.5, 5, 10, 30, 60, 120, 300)
+
+
+def _format_labels(names, values):
+    if not names:
+        return ""
+    pairs = []
+    for name, value in zip(names, values, strict=True):
+        escaped = (
+            str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+        )
+        pairs.append(f'{name}="{escaped}"')
+    return "{" + ",".join(pairs) + "}"
+
+
+def _format_value(value):
+    if value == math.inf:
+        return "+Inf"
+    return repr(float(value))
+
+
+class _Metric:
+    """ラベルの値ごとに値を持つメトリクスの共通部分"""
+
+    kind = ""
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}  # ラベルの値のタプル -> 値
+        self._lock = threading.Lock()
+
+    def _key(self, labels):
+        if set(labels) != set(self.labelnames):
+            raise ValueError(
+                f"{self.name} のラベルは {self.labelnames} である必要があります"
+            )
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def clear(self):
+        with self._lock:
+            self._values.clear()
+
+    def render(self):
+        lines = [
+            f"# HELP {self.name} {self.documentation}",
+            f"# TYPE {self.name} {self.kind}",
+        ]
+        with self._lock:
+            items = sorted(self._values.items())
+            lines.extend(self._render_samples(items))
+        return lines
+
+    def _render_samples(self, items):
+        return [
+            f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}"
+            for key, value in items
+        ]
+
+
+class Counter(_Metric):
+    """増加のみするカウンタ"""
+
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels):
+        with self._lock:
+            return self._values.get(self._key(labels), 0)
+
+
+class Gauge(_Metric):
+    """任意に増減する現在値"""
+
+    kind = "gauge"
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+
+class Histogram(_Metric):
+    """累積バケットで値の分布を集計する"""
+
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets)) + (math.inf,)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            counts, total = self._values.get(key, ([0] * len(self.buckets), 0.0))
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+            self._values[key] = (counts, total + value)
+
+    def count(self, **labels):
+        with self._lock:
+            entry = self._values.get(self._key(labels))
+        return entry[0][-1] if entry else 0
+
+    def _render_samples(self, items):
+        lines = []
+        for key, (counts, total) in items:
+            for bound, count in zip(self.buckets, counts, strict=True):
+                labels = _format_labels(
+                    (*self.labelnames, "le"), (*key, _format_value(bound))
+                )
+                lines.append(f"{self.name}_bucket{labels} {count}")
+            labels = _format_labels(self.labelnames, key)
+            lines.append(f"{self.name}_sum{labels} {_format_value(total)}")
+            lines.append(f"{self.name}_count{labels} {counts[-1]}")
+        return lines
+
+
+def percentile(values, q):
+    """最近傍順位法でq（0〜100）パーセンタイルを返す（空の場合は0.0）"""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    rank = max(1, math.ceil(q / 100 * len(ordered)))
+    return ordered[rank - 1]
+
+
+class MetricsRegistry:
+    """メトリクスと、出力時に現在値を集める関数（コレクタ）の登録先"""
+
+    def __init__(self):
+        self._metrics = []
+        self._collectors = []
+        self._lock = threading.Lock()
+
+    def register(self, metric):
+        with self._lock:
+            self._metrics.append(metric)
+        return metric
+
+    def add_collector(self, collector):
+        """出力のたびに呼ばれ、追加のメトリクスのリストを返す関数を登録する"""
+        with self._lock:
+            self._collectors.append(collector)
+
+    def render(self):
+        """すべてのメトリクスをPrometheusのテキスト形式で返す"""
+        with self._lock:
+            metrics = list(self._metrics)
+            collectors = list(self._collectors)
+        for collector in collectors:
+            try:
+                metrics.extend(collector())
+            except Exception as e:
+                logger.warning(f"メトリクスの収集に失敗しました: {e}")
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+    def clear(self):
+        """登録済みのメトリクスの値をリセットする"""
+        with self._lock:
+            metrics = list(self._metrics)
+        for metric in metrics:
+            metric.clear()
+
+
+REGISTRY = MetricsRegistry()
+
+DETECT_SECONDS = REGISTRY.register(
+    Histogram(
+        "ad_detect_seconds",
+        "detect()の所要時間（source: model, memory, disk, coalesced）",
+        ["source"],
+    )
+)
+EXECUTIONS_TOTAL = REGISTRY.register(
+    Counter(
+        "ad_executions_total",
+        "execute_codeの実行回数（status: success, failure, error, cancelled）",
+        ["status", "cached"],
+    )
+)
+EXECUTION_SECONDS = REGISTRY.register(
+    Histogram("ad_execution_seconds", "キャッシュを使わない実行の所要時間")
+)
+MODEL_LOADS_TOTAL = REGISTRY.register(
+    Counter("ad_model_loads_total", "検出モデルのロード回数", ["model"])
+)
+MODEL_LOAD_SECONDS = REGISTRY.register(
+    Histogram(
+        "ad_model_load_seconds",
+        "検出モデルのロードの所要時間",
+        buckets=MODEL_LOAD_BUCKETS,
+    )
+)
+
+
+def _collect_process():
+    rss = Gauge("ad_process_resident_memory_bytes", "プロセスのRSS")
+    rss.set(psutil.Process().memory_info().rss)
+    memory = Gauge("ad_system_memory_used_ratio", "システム全体のメモリ使用率")
+    memory.set(psutil.virtual_memory().percent / 100)
+    return [rss, memory]
+
+
+def _collect_caches():
+    from .detection_cache import get_detection_cache, get_detection_memory
+    from .generation_cache import get_generation_cache
+    from .image_cache import get_image_cache
+    from .result_cache import get_result_cache
+
+    image_stats = get_image_cache().stats()
+    caches = {
+        "image": image_stats["images"],
+        "pixels": image_stats["pixels"],
+        "result": get_result_cache().stats(),
+        "detection_memory": get_detection_memory().stats(),
+    }
+    for name, cache in (
+        ("detection_disk", get_detection_cache()),
+        ("generation", get_generation_cache()),
+    ):
+        if cache is not None:
+            caches[name] = cache.stats()
+
+    hit_ratio = Gauge("ad_cache_hit_ratio", "キャッシュのヒット率", ["cache"])
+    entries = Gauge("ad_cache_entries", "キャッシュのエントリ数", ["cache"])
+    size = Gauge("ad_cache_bytes", "キャッシュの合計バイト数", ["cache"])
+    for name, stats in caches.items():
+        lookups = stats.get("hits", 0) + stats.get("misses", 0)
+        hit_ratio.set(stats["hits"] / lookups if lookups else 0.0, cache=name)
+        entries.set(stats.get("entries", 0), cache=name)
+        size.set(stats.get("bytes", 0), cache=name)
+    return [hit_ratio, entries, size]
+
+
+def _collect_queues():
+    from .admission import get_admission_controller
+    from .job_manager import get_job_manager
+    from .single_flight import get_single_flight
+
+    jobs = Gauge("ad_jobs", "状態ごとのジョブ数", ["status"])
+    for status, count in get_job_manager().stats().items():
+        jobs.set(count, status=status)
+
+    flight_stats = get_single_flight().stats()
+    in_flight = Gauge("ad_executions_in_flight", "実行中の（共有元の）実行数")
+    in_flight.set(flight_stats["in_flight"])
+    coalesced = Counter(
+        "ad_executions_coalesced_total", "進行中の同じ実行の結果を共有した回数"
+    )
+    coalesced.inc(flight_stats["coalesced"])
+
+    admission_stats = get_admission_controller().stats()
+    admission = Gauge(
+        "ad_admission_executions",
+        "メモリの予算で受け付けた・待っている実行数",
+        ["state"],
+    )
+    admission.set(admission_stats["running"], state="running")
+    admission.set(admission_stats["waiting"], state="waiting")
+    reserved = Gauge(
+        "ad_admission_reserved_bytes", "受け付けた実行のメモリの見積もりの合計"
+    )
+    reserved.set(admission_stats["reserved_bytes"])
+    budget = Gauge("ad_admission_budget_bytes", "モデルと実行に使えるメモリの予算")
+    budget.set(admission_stats["budget_bytes"])
+    return [jobs, in_flight, coalesced, admission, reserved, budget]
+
+
+REGISTRY.add_collector(_collect_process)
+REGISTRY.add_collector(_collect_caches)
+REGISTRY.add_collector(_collect_queues)
+
+
+def render_metrics():
+    """共有レジストリのメトリクスをPrometheusのテキスト形式で返す"""
+    return REGISTRY.render()
+
+
+def create_metrics_app():
+    """/metrics を提供するFastAPIアプリを作成する"""
+    from fastapi import FastAPI
+    from fastapi.responses import Response
+
+    app = FastAPI(title="streamlit-ad-app metrics", docs_url=None, redoc_url=None)
+
+    @app.get("/metrics")
+    def metrics():
+        return Response(render_metrics(), media_type=CONTENT_TYPE)
+
+    return app
+
+
+_metrics_server = None
+_metrics_server_lock = threading.Lock()
+
+
+def start_metrics_server(port=None, host=METRICS_HOST):
+    """
+    メトリクスのサーバーをデーモンスレッドで起動する
+
+    Streamlitの再実行で何度呼ばれても、起動するのはプロセスで1回だけ。
+
+    Args:
+        port (int, optional): 公開するポート。省略時はMETRICS_PORT
+        host (str, optional): バインドするアドレス
+
+    Returns:
+        uvicorn.Server | None: 起動したサーバー（ポートが未設定の場合はNone）
+    """
+    global _metrics_server
+    port = port or METRICS_PORT
+    if not port:
+        return None
+    if _metrics_server is None:
+        with _metrics_server_lock:
+            if _metrics_server is None:
+                import uvicorn
+
+                config = uvicorn.Config(
+                    create_metrics_app(),
+                    host=host,
+                    port=int(port),
+                    log_level="warning",
+                )
+                server = uvicorn.Server(config)
+                threading.Thread(
+                    target=server.run, name="metrics-server", daemon=True
+                ).start()
+                logger.info(f"メトリクスを公開: http://{host}:{port}/metrics")
+                _metrics_server = server
+    return _metrics_server
@@ -0,0 +1,196 @@
+"""
+実行のプロファイリング（オプトイン）
+
+execute_codeにprofileを指定した場合だけ、実行をcProfileとtorchのプロファイラで
+計測し、プロファイルをファイルに保存して所要時間の多い関数の上位N件を返す。
+指定しない場合はプロファイラを一切設定しないため、通常の実行に負荷はかからない。
+
+- cprofile: Pythonの関数ごとの所要時間（<path>.prof、snakevizなどで開ける）
+- torch: PyTorchの演算子ごとの所要時間（<path>.trace.json、chrome://tracingで開ける）
+"""
+
+import cProfile
+import logging
+import os
+import pstats
+import threading
+from contextlib import ExitStack, contextmanager
+
+logger = logging.getLogger(__name__)
+
+# 結果に含める上位の関数・演算子の数
+PROFILE_TOP_N = int(os.environ.get("PROFILE_TOP_N", "15"))
+
+PROFILERS = ("cprofile", "torch")
+
+# torchのプロファイラは同時に1つしか有効にできないため、プロファイル付きの
+# 実行は1つずつ行う（重なった実行はプロファイルせずに実行する）
+_profile_lock = threading.Lock()
+
+
+def normalize_profilers(profile):
+    """
+    profileの指定をプロファイラ名のタプルにする
+
+    Args:
+        profile (str | list | bool | None): "cprofile", "torch", "all"、
+            それらのリスト、またはTrue（cprofileのみ）
+
+    Returns:
+        tuple: 使うプロファイラ名（指定なしなら空）
+    """
+    if not profile:
+        return ()
+    if profile is True:
+        return ("cprofile",)
+    names = [profile] if isinstance(profile, str) else list(profile)
+    if "all" in names:
+        return PROFILERS
+    unknown = [name for name in names if name not in PROFILERS]
+    if unknown:
+        raise ValueError(f"不明なプロファイラです: {unknown}")
+    return tuple(name for name in PROFILERS if name in names)
+
+
+def cprofile_hotspots(profiler, top_n=PROFILE_TOP_N):
+    """
+    cProfileの結果から累積時間の多い関数を返す
+
+    Returns:
+        list: {"function", "calls", "tottime_ms", "cumtime_ms"} の辞書のリスト
+    """
+    stats = pstats.Stats(profiler)
+    rows = []
+    for (filename, line, name), (_, calls, tottime, cumtime, _) in stats.stats.items():
+        # プロファイラ自身の呼び出しは除く
+        if name == "disable" and "lsprof" in filename:
+            continue
+        location = f"{os.path.basename(filename)}:{line}" if line else filename
+        rows.append(
+            {
+                "function": f"{name} ({location})",
+                "calls": calls,
+                "tottime_ms": round(tottime * 1000, 2),
+                "cumtime_ms": round(cumtime * 1000, 2),
+            }
+        )
+    rows.sort(key=lambda row: row["cumtime_ms"], reverse=True)
+    return rows[:top_n]
+
+
+def torch_hotspots(profiler, top_n=PROFILE_TOP_N):
+    """
+    torchのプロファイラの結果から自身のCPU時間の多い演算子を返す
+
+    Returns:
+        list: {"function", "calls", "self_cpu_ms", "cpu_total_ms"} の辞書のリスト
+    """
+    events = sorted(
+        profiler.key_averages(),
+        key=lambda event: event.self_cpu_time_total,
+        reverse=True,
+    )
+    return [
+        {
+            "function": event.key,
+            "calls": event.count,
+            "self_cpu_ms": round(event.self_cpu_time_total / 1000, 2),
+            "cpu_total_ms": round(event.cpu_time_total / 1000, 2),
+        }
+        for event in events[:top_n]
+    ]
+
+
+def _start_torch_profiler():
+    import torch
+    from torch.profiler import ProfilerActivity, profile
+
+    activities = [ProfilerActivity.CPU]
+    if torch.cuda.is_available():
+        activities.append(ProfilerActivity.CUDA)
+    profiler = profile(activities=activities)
+    profiler.__enter__()
+    return profiler
+
+
+@contextmanager
+def profile_execution(profile, output_path=None, top_n=PROFILE_TOP_N):
+    """
+    ブロックの実行をプロファイルする
+
+    ブロックを抜けると、yieldした辞書に保存したファイル（"files"）と
+    上位の関数・演算子（"hotspots"）が入る。
+
+    Args:
+        profile: 使うプロファイラ（normalize_profilersを参照）
+        output_path (str, optional): 保存先のパス（拡張子なし）。省略時は保存しない
+        top_n (int, optional): 返す上位の件数
+
+    Yields:
+        dict: プロファイルの結果
+    """
+    profilers = normalize_profilers(profile)
+    report = {"profilers": list(profilers), "files": {}, "hotspots": {}}
+    if not profilers:
+        yield report
+        return
+    if not _profile_lock.acquire(blocking=False):
+        report["error"] = "他の実行をプロファイル中のため、プロファイルしませんでした"
+        logger.warning(report["error"])
+        yield report
+        return
+
+    cprofiler = None
+    torch_profiler = None
+    try:
+        with ExitStack() as stack:
+            if "torch" in profilers:
+                torch_profiler = _start_torch_profiler()
+                stack.callback(torch_profiler.__exit__, None, None, None)
+            if "cprofile" in profilers:
+                cprofiler = cProfile.Profile()
+                cprofiler.enable()
+                stack.callback(cprofiler.disable)
+            yield report
+    finally:
+        # 例外で終了した場合も、そこまでのプロファイルを保存する
+        try:
+            _collect(report, cprofiler, torch_profiler, output_path, top_n)
+        except Exception as e:
+            logger.warning(f"プロファイルの保存に失敗しました: {e}")
+            report["error"] = f"プロファイルの保存に失敗しました: {e}"
+        finally:
+            _profile_lock.release()
+
+
+def _collect(report, cprofiler, torch_profiler, output_path, top_n):
+    if cprofiler is not None:
+        report["hotspots"]["cprofile"] = cprofile_hotspots(cprofiler, top_n)
+        if output_path:
+            path = f"{output_path}.prof"
+            cprofiler.dump_stats(path)
+            report["files"]["cprofile"] = path
+    if torch_profiler is not None:
+        report["hotspots"]["torch"] = torch_hotspots(torch_profiler, top_n)
+        if output_path:
+            path = f"{output_path}.trace.json"
+            torch_profiler.export_chrome_trace(path)
+            report["files"]["torch"] = path
+    if report["files"]:
+        logger.info(f"プロファイルを保存: {report['files']}")
+
+
+def format_hotspots(rows):
+    """上位の関数・演算子をテキストの表にする（画面表示用）"""
+    if not rows:
+        return ""
+    columns = [key for key in rows[0] if key != "function"]
+    width = max(len(row["function"]) for row in rows)
+    width = min(max(width, len("function")), 70)
+    lines = ["function".ljust(width) + "".join(f"{key:>14}" for key in columns)]
+    for row in rows:
+        name = row["function"]
+        if len(name) > width:
+            name = "…" + name[-(width - 1) :]
+        lines.append(name.ljust(width) + "".join(f"{row[key]:>14}" for key in columns))
+    return "\n".join(lines)
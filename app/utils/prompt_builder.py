@@ -0,0 +1,196 @@
+"""
+生成プロンプトのfew-shot例の選択
+
+テンプレートプロンプトはモジュールの説明と13個のexecute_commandの例からなる。
+条件と関係の薄い例まで毎回送ると入力トークンが増えるため、例の
+Normal_conditionとの類似度（TF-IDFのコサイン類似度）で上位k個を選び、
+モジュールの説明と組み合わせてプロンプトを作る。
+"""
+
+import math
+import os
+import re
+import threading
+import unicodedata
+from collections import Counter
+
+from .template_prompt import prompt
+
+# プロンプトに含める例の数（0の場合はすべての例を含める）
+FEWSHOT_TOP_K = int(os.environ.get("FEWSHOT_TOP_K", "4"))
+
+_EXAMPLES_MARKER = "Some examples:\n"
+_EXAMPLE_START = re.compile(r"^Normal_condition\d+:", re.MULTILINE)
+
+# 日本語の条件と英語の例を比較できるよう、よく使われる表現を共通の概念に寄せる
+_CONCEPTS = {
+    "<left>": ["left", "左"],
+    "<right>": ["right", "右"],
+    "<above>": ["above", "over", "top", "上"],
+    "<below>": ["below", "under", "underneath", "beneath", "bottom", "下"],
+    "<between>": ["between", "coordinate", "coordinates", "間", "座標", "範囲"],
+    "<inside>": ["inside", "within", "中", "内"],
+    "<color>": [
+        "color",
+        "colour",
+        "white",
+        "black",
+        "red",
+        "blue",
+        "green",
+        "yellow",
+        "色",
+        "白",
+        "黒",
+        "赤",
+        "青",
+        "緑",
+        "黄",
+    ],
+    "<count>": [
+        "one",
+        "two",
+        "three",
+        "four",
+        "five",
+        "six",
+        "seven",
+        "eight",
+        "nine",
+        "ten",
+        "number",
+        "個",
+        "つ",
+        "本",
+        "枚",
+        "匹",
+        "台",
+        "数",
+    ],
+    "<if>": ["if", "when", "場合", "なら", "ならば", "とき"],
+    "<type>": ["type", "kind", "種類"],
+}
+_WORD_TO_CONCEPT = {
+    word: concept
+    for concept, words in _CONCEPTS.items()
+    for word in words
+    if word.isascii()
+}
+_CJK_CONCEPTS = [
+    (word, concept)
+    for concept, words in _CONCEPTS.items()
+    for word in words
+    if not word.isascii()
+]
+
+
+def tokenize(text):
+    """
+    類似度の計算に使うトークンのリストを返す
+
+    英単語（末尾のsを除いた形）、数字、日英共通の概念トークンを抽出する。
+    """
+    text = unicodedata.normalize("NFKC", text).lower()
+    tokens = []
+    for word in re.findall(r"[a-z]+|\d+", text):
+        if word.isdigit():
+            tokens.append("<count>")
+            continue
+        if word in _WORD_TO_CONCEPT:
+            tokens.append(_WORD_TO_CONCEPT[word])
+        if len(word) > 3 and word.endswith("s"):
+            word = word[:-1]
+        tokens.append(word)
+    for word, concept in _CJK_CONCEPTS:
+        tokens.extend([concept] * text.count(word))
+    return tokens
+
+
+def split_template(template=prompt):
+    """
+    テンプレートをモジュールの説明部分と例のリストに分ける
+
+    Returns:
+        tuple: (説明部分, [(Normal_conditionの文, 例全体のテキスト), ...])
+    """
+    index = template.index(_EXAMPLES_MARKER) + len(_EXAMPLES_MARKER)
+    header, body = template[:index], template[index:]
+    starts = [match.start() for match in _EXAMPLE_START.finditer(body)]
+    examples = []
+    for start, end in zip(starts, starts[1:] + [len(body)], strict=True):
+        block = body[start:end]
+        condition = block.split("\n", 1)[0].split(":", 1)[1].strip()
+        examples.append((condition, block))
+    return header, examples
+
+
+class FewShotSelector:
+    """Normal_conditionのTF-IDFで条件に近い例を選ぶ"""
+
+    def __init__(self, template=prompt):
+        self.header, self.examples = split_template(template)
+        documents = [Counter(tokenize(condition)) for condition, _ in self.examples]
+        document_frequency = Counter()
+        for document in documents:
+            document_frequency.update(document.keys())
+        count = len(documents)
+        self.idf = {
+            token: math.log((1 + count) / (1 + frequency)) + 1
+            for token, frequency in document_frequency.items()
+        }
+        self.vectors = [self._vectorize(document) for document in documents]
+
+    def _vectorize(self, counts):
+        vector = {
+            token: tf * self.idf[token]
+            for token, tf in counts.items()
+            if token in self.idf
+        }
+        norm = math.sqrt(sum(value * value for value in vector.values()))
+        return {token: value / norm for token, value in vector.items()} if norm else {}
+
+    def scores(self, normal_conditions):
+        """各例と条件のコサイン類似度を返す"""
+        query = self._vectorize(Counter(tokenize(normal_conditions)))
+        return [
+            sum(value * vector.get(token, 0.0) for token, value in query.items())
+            for vector in self.vectors
+        ]
+
+    def select(self, normal_conditions, k=FEWSHOT_TOP_K):
+        """
+        条件に近い上位k個の例のインデックスを、テンプレートでの順番で返す
+
+        kが0以下または例の数以上の場合、あるいはどの例とも類似しない場合は
+        すべての例を返す。
+        """
+        if k <= 0 or k >= len(self.examples):
+            return list(range(len(self.examples)))
+        scores = self.scores(normal_conditions)
+        if max(scores) <= 0:
+            return list(range(len(self.examples)))
+        ranked = sorted(range(len(scores)), key=lambda i: (-scores[i], i))
+        return sorted(ranked[:k])
+
+    def build(self, normal_conditions, k=FEWSHOT_TOP_K):
+        """
+        (モジュールの説明, 選んだ例) のテキストを返す
+
+        説明部分は条件によらず同じため、プロンプトキャッシュの対象にできる。
+        """
+        selected = self.select(normal_conditions, k)
+        return self.header, "".join(self.examples[i][1] for i in selected)
+
+
+_fewshot_selector = None
+_fewshot_selector_lock = threading.Lock()
+
+
+def get_fewshot_selector():
+    """テンプレートプロンプトから作成したセレクタを返す"""
+    global _fewshot_selector
+    if _fewshot_selector is None:
+        with _fewshot_selector_lock:
+            if _fewshot_selector is None:
+                _fewshot_selector = FewShotSelector()
+    return _fewshot_selector
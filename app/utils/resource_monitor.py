@@ -0,0 +1,184 @@
+"""
+リソース使用量のバックグラウンドサンプリング
+
+システムのメモリ使用率・利用可能メモリ・プロセスのRSS・CPU使用率を
+バックグラウンドのスレッドで一定間隔で記録し、直近の履歴をリングバッファに
+保持する。check_memory_usage()など要求のたびにメモリを確認していた処理は、
+サンプラーの動作中は記録済みの値（直近の平均）を読むだけになる。
+"""
+
+import logging
+import os
+import threading
+import time
+from collections import deque
+
+import psutil
+
+logger = logging.getLogger(__name__)
+
+# サンプリングの間隔（秒）
+RESOURCE_SAMPLE_INTERVAL = float(os.environ.get("RESOURCE_SAMPLE_INTERVAL", "1.0"))
+# 保持するサンプル数（デフォルトは1秒間隔で5分）
+RESOURCE_HISTORY_SIZE = int(os.environ.get("RESOURCE_HISTORY_SIZE", "300"))
+# 平滑化に使う直近の期間（秒）
+RESOURCE_SMOOTHING_WINDOW = float(os.environ.get("RESOURCE_SMOOTHING_WINDOW", "5.0"))
+
+# 平均を取る項目
+_NUMERIC_FIELDS = (
+    "memory_percent",
+    "available_bytes",
+    "rss_bytes",
+    "cpu_percent",
+    "process_cpu_percent",
+)
+
+
+class ResourceMonitor:
+    """メモリ・CPUの使用量を定期的に記録するサンプラー"""
+
+    def __init__(
+        self, interval=RESOURCE_SAMPLE_INTERVAL, history_size=RESOURCE_HISTORY_SIZE
+    ):
+        """
+        Args:
+            interval (float): サンプリングの間隔（秒）
+            history_size (int): 保持するサンプル数
+        """
+        self.interval = interval
+        self._samples = deque(maxlen=history_size)
+        self._lock = threading.Lock()
+        self._stop_event = threading.Event()
+        self._thread = None
+        self._process = psutil.Process()
+
+    @property
+    def running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self):
+        """サンプリングのスレッドを開始する（動作中なら何もしない）"""
+        with self._lock:
+            if self.running:
+                return
+            self._stop_event.clear()
+            # cpu_percentは前回の呼び出しからの使用率を返すため、基準を取っておく
+            psutil.cpu_percent(interval=None)
+            self._process.cpu_percent(interval=None)
+            self._thread = threading.Thread(
+                target=self._run, name="resource-monitor", daemon=True
+            )
+            self._thread.start()
+        logger.info(f"リソースのサンプリングを開始: {self.interval}秒間隔")
+
+    def stop(self, timeout=None):
+        """サンプリングのスレッドを停止する"""
+        self._stop_event.set()
+        thread = self._thread
+        if thread is not None:
+            thread.join(timeout)
+
+    def _run(self):
+        while not self._stop_event.is_set():
+            try:
+                self.sample()
+            except Exception as e:
+                logger.warning(f"リソース使用量の取得に失敗: {e}")
+            self._stop_event.wait(self.interval)
+
+    def sample(self):
+        """
+        現在の使用量を1回記録する
+
+        Returns:
+            dict: time, memory_percent, available_bytes, rss_bytes,
+                cpu_percent（システム全体）, process_cpu_percent（このプロセス）
+        """
+        memory = psutil.virtual_memory()
+        record = {
+            "time": time.time(),
+            "memory_percent": memory.percent,
+            "available_bytes": memory.available,
+            "rss_bytes": self._process.memory_info().rss,
+            "cpu_percent": psutil.cpu_percent(interval=None),
+            "process_cpu_percent": self._process.cpu_percent(interval=None),
+        }
+        with self._lock:
+            self._samples.append(record)
+        return record
+
+    def latest(self):
+        """最新のサンプル（まだなければNone）"""
+        with self._lock:
+            return dict(self._samples[-1]) if self._samples else None
+
+    def history(self, seconds=None):
+        """
+        記録済みのサンプルを古い順に返す
+
+        Args:
+            seconds (float, optional): 直近この秒数のサンプルのみ返す
+        """
+        with self._lock:
+            samples = [dict(record) for record in self._samples]
+        if seconds is not None:
+            since = time.time() - seconds
+            samples = [record for record in samples if record["time"] >= since]
+        return samples
+
+    def smoothed(self, window=RESOURCE_SMOOTHING_WINDOW):
+        """
+        直近windowの秒数のサンプルの平均を返す
+
+        Returns:
+            dict | None: 各項目の平均と最新のサンプルの時刻（サンプルがなければNone）
+        """
+        samples = self.history(window) or [self.latest()]
+        if samples[0] is None:
+            return None
+        averaged = {
+            field: sum(record[field] for record in samples) / len(samples)
+            for field in _NUMERIC_FIELDS
+        }
+        averaged["time"] = samples[-1]["time"]
+        return averaged
+
+    def is_fresh(self):
+        """最新のサンプルが十分新しいか（サンプラーが止まっていないか）"""
+        record = self.latest()
+        return (
+            self.running
+            and record is not None
+            and time.time() - record["time"] <= max(3 * self.interval, 1.0)
+        )
+
+    def clear(self):
+        with self._lock:
+            self._samples.clear()
+
+
+_resource_monitor = None
+_resource_monitor_lock = threading.Lock()
+
+
+def get_resource_monitor():
+    """プロセス全体で共有するサンプラーを返す（開始はstart_resource_monitor）"""
+    global _resource_monitor
+    if _resource_monitor is None:
+        with _resource_monitor_lock:
+            if _resource_monitor is None:
+                _resource_monitor = ResourceMonitor()
+    return _resource_monitor
+
+
+def start_resource_monitor():
+    """
+    共有のサンプラーを開始する
+
+    Streamlitの再実行で何度呼ばれても、スレッドはプロセスで1つだけ。
+    RESOURCE_SAMPLE_INTERVAL が0以下の場合は開始しない。
+    """
+    monitor = get_resource_monitor()
+    if monitor.interval > 0:
+        monitor.start()
+    return monitor
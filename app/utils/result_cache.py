@@ -0,0 +1,137 @@
+"""
+execute_code の実行結果のメモ化
+
+(コード, 画像, しきい値, モデル) が同じ実行は結果も同じになるため、
+ハッシュをキーに結果の辞書（output_textを含む）を保持し、再実行を省略する。
+"""
+
+import copy
+import hashlib
+import json
+import os
+import threading
+
+from .cache import BoundedCache
+
+# 結果の有効期間（秒）
+RESULT_CACHE_TTL = float(os.environ.get("RESULT_CACHE_TTL", "600"))
+# 保持する結果の件数とバイト数の上限
+RESULT_CACHE_MAX_ENTRIES = int(os.environ.get("RESULT_CACHE_MAX_ENTRIES", "256"))
+RESULT_CACHE_MAX_BYTES = int(
+    os.environ.get("RESULT_CACHE_MAX_BYTES", str(16 * 1024 * 1024))
+)
+
+
+def make_result_key(code, image_hash, box_threshold, model_id, **options):
+    """
+    実行結果のキャッシュキーを作成する
+
+    Args:
+        code (str): 実行するコード
+        image_hash (str): 画像ファイルの内容のハッシュ
+        box_threshold (float): 物体検出のしきい値
+        model_id (str): 使用するモデルID
+        **options: 結果に影響するその他の実行オプション（タイル検出など）
+
+    Returns:
+        str: キャッシュキー
+    """
+    payload = {
+        "code": hashlib.sha256(code.encode("utf-8")).hexdigest(),
+        "image": image_hash,
+        "threshold": round(float(box_threshold), 6),
+        "model": model_id,
+        "options": options,
+    }
+    encoded = json.dumps(payload, sort_keys=True, default=str)
+    return hashlib.sha256(encoded.encode("utf-8")).hexdigest()
+
+
+class ExecutionResultCache:
+    """TTLとサイズ上限付きの実行結果キャッシュ（セッション単位で無効化可能）"""
+
+    def __init__(
+        self,
+        ttl=RESULT_CACHE_TTL,
+        max_entries=RESULT_CACHE_MAX_ENTRIES,
+        max_bytes=RESULT_CACHE_MAX_BYTES,
+    ):
+        self._cache = BoundedCache(max_bytes, max_entries=max_entries, ttl=ttl)
+        self._session_keys = {}  # session_id -> 保存・参照したキーの集合
+        self._lock = threading.Lock()
+
+    def get(self, key, session_id=None):
+        """
+        キャッシュされた結果のコピーを返す（cached=Trueを付与）
+
+        session_idを指定すると、そのセッションが参照した結果として記録し、
+        invalidate_sessionの対象にする。
+        """
+        result = self._cache.get(key)
+        if result is None:
+            return None
+        self._track(key, session_id)
+        result = copy.deepcopy(result)
+        result["cached"] = True
+        return result
+
+    def put(self, key, result, session_id=None):
+        """結果を保存する（session_idを指定するとセッション単位で無効化できる）"""
+        size = len(json.dumps(result, ensure_ascii=False, default=str).encode())
+        stored = self._cache.put(key, copy.deepcopy(result), size=size)
+        if stored:
+            self._track(key, session_id)
+        # 保存で追い出された結果の記録も消し、セッションの記録が増え続けないようにする
+        self._prune_sessions()
+        return stored
+
+    def _track(self, key, session_id):
+        if session_id is None:
+            return
+        with self._lock:
+            self._session_keys.setdefault(session_id, set()).add(key)
+
+    def _prune_sessions(self):
+        """キャッシュにない（追い出し・期限切れの）キーをセッションの記録から除く"""
+        live = set(self._cache.keys())
+        with self._lock:
+            for session_id in list(self._session_keys):
+                keys = self._session_keys[session_id] & live
+                if keys:
+                    self._session_keys[session_id] = keys
+                else:
+                    del self._session_keys[session_id]
+
+    def invalidate_session(self, session_id):
+        """セッションが保存・参照した結果をすべて削除し、削除した件数を返す"""
+        with self._lock:
+            keys = self._session_keys.pop(session_id, set())
+        removed = 0
+        for key in keys:
+            if self._cache.pop(key) is not None:
+                removed += 1
+        return removed
+
+    def clear(self):
+        """すべての結果を削除する"""
+        self._cache.clear()
+        with self._lock:
+            self._session_keys.clear()
+
+    def stats(self):
+        """キャッシュの統計を返す"""
+        return self._cache.stats()
+
+
+_result_cache = None
+_result_cache_lock = threading.Lock()
+
+
+def get_result_cache():
+    """プロセス全体で共有する実行結果キャッシュを返す"""
+    global _result_cache
+    if _result_cache is None:
+        with _result_cache_lock:
+            if _result_cache is None:
+                _result_cache = ExecutionResultCache()
+    return _result_cache
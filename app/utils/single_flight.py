@@ -0,0 +1,170 @@
+"""
+同一リクエストの実行の共有（single-flight）
+
+ダブルクリックや同じセッションの複数タブから、同じコード・同じ画像・
+同じしきい値の実行が同時に届くと、共有のモデルで同じ推論が並列に走る。
+キーが同じ処理が実行中の場合は新たに実行せず、その完了を待って結果を共有する。
+
+待っている呼び出しには、実行中の処理が progress() で知らせる途中経過
+（受け付けの順番など）を伝える。実行した呼び出し自身のキャンセルのように
+結果を共有すべきでない例外（retry_on）で終わった場合、待っていた呼び出しは
+その例外を受け取らず、改めて1つが代表して実行する。
+"""
+
+import copy
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+
+class FlightCancelledError(Exception):
+    """他の呼び出しの実行を待つ間にキャンセルされた"""
+
+
+class _Call:
+    """実行中の処理1件"""
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+        self.error = None
+        self.listeners = []  # 途中経過を知らせる関数
+        self.progress = None  # 最後に知らせた途中経過
+
+
+class SingleFlight:
+    """キーごとに同時実行を1つにまとめる"""
+
+    def __init__(self):
+        self._calls = {}  # key -> _Call
+        self._lock = threading.Lock()
+        self.executed = 0
+        self.coalesced = 0
+
+    def do(
+        self,
+        key,
+        func,
+        retry_on=(),
+        on_progress=None,
+        should_stop=None,
+        poll_interval=0.1,
+    ):
+        """
+        キーが同じ処理が実行中であればその結果を待ち、なければfuncを実行する
+
+        Args:
+            key (str): 同一の処理とみなすキー
+            func (callable): 引数なしで呼び出す処理
+            retry_on (tuple, optional): 実行した呼び出しだけのものとして扱う例外の型。
+                待っていた呼び出しには送出せず、改めて実行する
+            on_progress (callable, optional): 実行中の処理がprogress()で知らせる
+                途中経過を受け取る on_progress(値)
+            should_stop (callable, optional): 他の呼び出しの実行を待つ間に
+                Trueを返したら待つのをやめる
+            poll_interval (float, optional): should_stopを確認する間隔（秒）
+
+        Returns:
+            tuple: (結果, 他の実行の結果を共有したか)。共有した結果はコピーを返す
+
+        Raises:
+            FlightCancelledError: 他の呼び出しの実行を待つ間にキャンセルされた
+            Exception: funcが送出した例外（待っていた呼び出しにも同じ例外を送出する）
+        """
+        while True:
+            with self._lock:
+                call = self._calls.get(key)
+                if call is not None:
+                    self.coalesced += 1
+                    leader = False
+                else:
+                    call = _Call()
+                    self._calls[key] = call
+                    self.executed += 1
+                    leader = True
+                if on_progress is not None:
+                    call.listeners.append(on_progress)
+                progress = call.progress
+
+            if leader:
+                break
+
+            logger.info("同一の実行が進行中のため完了を待って結果を共有します")
+            if on_progress is not None and progress is not None:
+                on_progress(progress)
+            while not call.event.wait(poll_interval if should_stop else None):
+                if should_stop():
+                    with self._lock:
+                        if on_progress in call.listeners:
+                            call.listeners.remove(on_progress)
+                    raise FlightCancelledError(
+                        "実行の完了を待つ間にキャンセルされました"
+                    )
+            if isinstance(call.error, retry_on):
+                logger.info(f"共有していた実行が中断されたため再実行します: {key}")
+                continue
+            if call.error is not None:
+                raise call.error
+            return copy.deepcopy(call.result), True
+
+        try:
+            call.result = func()
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.event.set()
+        return call.result, False
+
+    def progress(self, key, value):
+        """
+        実行中の処理の途中経過を、同じキーで待っているすべての呼び出しに知らせる
+
+        Args:
+            key (str): do()に渡したキー
+            value: on_progressに渡す値
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            if call is None:
+                return
+            call.progress = value
+            listeners = list(call.listeners)
+        for listener in listeners:
+            listener(value)
+
+    def in_flight(self):
+        """実行中の処理の数を返す"""
+        with self._lock:
+            return len(self._calls)
+
+    def stats(self):
+        """実行・共有した回数を返す"""
+        with self._lock:
+            return {
+                "in_flight": len(self._calls),
+                "executed": self.executed,
+                "coalesced": self.coalesced,
+            }
+
+    def reset_stats(self):
+        with self._lock:
+            self.executed = 0
+            self.coalesced = 0
+
+
+_single_flight = None
+_single_flight_lock = threading.Lock()
+
+
+def get_single_flight():
+    """execute_codeで共有するsingle-flightを返す"""
+    global _single_flight
+    if _single_flight is None:
+        with _single_flight_lock:
+            if _single_flight is None:
+                _single_flight = SingleFlight()
+    return _single_flight
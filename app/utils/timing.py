@@ -0,0 +1,97 @@
+"""
+実行の段階ごとの所要時間の計測
+
+execute_codeの1回の実行の間、画像の読み込み・モデルのロード・前処理・
+推論・後処理・NMS・find()・ユーザープログラムなどの区間（span）を記録する。
+記録はcontextvarsで実行中のスレッドに紐づけるため、同時に実行される
+別のセッションの区間は混ざらない。計測中でない場合span()は何もしない。
+"""
+
+import contextvars
+import logging
+import time
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+_current_timeline = contextvars.ContextVar("timeline", default=None)
+
+
+class Timeline:
+    """1回の実行で記録した区間のリスト"""
+
+    def __init__(self):
+        self.spans = []
+        self._origin = time.perf_counter()
+        self._depth = 0
+
+    def to_list(self):
+        """
+        記録した区間を開始順に返す
+
+        Returns:
+            list: {"name", "start_ms", "ms", "depth"} と任意の "detail" を持つ辞書のリスト
+        """
+        return [dict(record) for record in self.spans]
+
+
+@contextmanager
+def record_timeline():
+    """ブロック内の区間を記録するTimelineを作成する"""
+    timeline = Timeline()
+    token = _current_timeline.set(timeline)
+    try:
+        yield timeline
+    finally:
+        _current_timeline.reset(token)
+
+
+@contextmanager
+def span(name, detail=None):
+    """
+    ブロックの所要時間を現在のTimelineに記録する
+
+    Args:
+        name (str): 区間の名前（"forward", "find"など）
+        detail (str, optional): 検出クエリなどの補足
+    """
+    timeline = _current_timeline.get()
+    if timeline is None:
+        yield
+        return
+
+    start = time.perf_counter()
+    depth = timeline._depth
+    # 開始順に並ぶよう、開始時に追加して終了時に所要時間を埋める
+    record = {
+        "name": name,
+        "start_ms": round((start - timeline._origin) * 1000, 2),
+        "ms": None,
+        "depth": depth,
+    }
+    if detail is not None:
+        record["detail"] = detail
+    timeline.spans.append(record)
+    timeline._depth += 1
+    try:
+        yield
+    finally:
+        timeline._depth = depth
+        record["ms"] = round((time.perf_counter() - start) * 1000, 2)
+
+
+def format_timings(spans):
+    """区間を階層をインデントで表したテキストにする（ログ・画面表示用）"""
+    lines = []
+    for record in spans:
+        label = "  " * record["depth"] + record["name"]
+        if "detail" in record:
+            label += f" ({record['detail']})"
+        lines.append(f"{label:<40} {record['ms']:>9.1f} ms")
+    return "\n".join(lines)
+
+
+def log_timings(spans):
+    """区間の一覧をログに出力する"""
+    if spans:
+        logger.info("実行の所要時間:\n" + format_timings(spans))
@@ -0,0 +1,378 @@
+#!/usr/bin/env python3
+"""
+検出・実行のホットパスのベンチマーク
+
+nms・delete_overlaps・ImagePatchの作成・detect()の後処理・execute_codeの
+実行全体を、合成の検出器（SyntheticBackend）で計測する。ケースごとに
+ウォームアップしてから繰り返し計測し、1回あたりの所要時間の統計
+（min / median / mean / p95 / stdev）を表示する。
+
+--real-model を指定すると、Grounding DINOを使うケース（モデルのロード・
+推論を含む検出・実行全体）も計測する（モデルのダウンロードが必要）。
+
+--output で結果をJSONに保存し、保存済みの結果（デフォルトはリポジトリの
+benchmarks/baseline.json）と中央値を比較する。--threshold（%）を超えて
+遅くなったケースがあれば終了コード1を返す。所要時間は環境に依存するため、
+別の環境で比較する場合はその環境で取った結果を --baseline に指定する。
+
+使い方:
+    python benchmarks/bench_hot_paths.py
+    python benchmarks/bench_hot_paths.py --baseline bench.json --threshold 20
+    python benchmarks/bench_hot_paths.py --output benchmarks/baseline.json  # 更新
+    python benchmarks/bench_hot_paths.py --real-model --filter execute --no-baseline
+"""
+
+import argparse
+import contextlib
+import io
+import json
+import logging
+import platform
+import random
+import statistics
+import sys
+import time
+from pathlib import Path
+
+from PIL import Image
+
+# プロジェクトルートをPythonパスに追加
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from app.utils.code_executor import (  # noqa: E402
+    ImagePatch,
+    delete_overlaps,
+    detect,
+    execute_code,
+    load_image,
+    nms,
+)
+from app.utils.detection_cache import get_detection_memory  # noqa: E402
+from app.utils.detector_backend import (  # noqa: E402
+    GroundingDinoBackend,
+    SyntheticBackend,
+    use_detector_backend,
+)
+from app.utils.image_cache import get_image_cache  # noqa: E402
+from app.utils.metrics import percentile  # noqa: E402
+from app.utils.result_cache import get_result_cache  # noqa: E402
+
+# 比較するデフォルトの結果（--outputで更新する）
+DEFAULT_BASELINE = Path(__file__).resolve().parent / "baseline.json"
+
+SAMPLE_IMAGE = str(
+    Path(__file__).resolve().parent.parent / "app" / "utils" / "apple_strawberry.png"
+)
+
+# 実行全体のケースで使うプログラム（find()を2回呼ぶ一般的な形）
+SAMPLE_PROGRAM = """
+def execute_command(image_path, image):
+    image_patch = ImagePatch(image)
+    apple_patches = image_patch.find("apple")
+    strawberry_patches = image_patch.find("strawberry")
+    print(f"apple: {len(apple_patches)}, strawberry: {len(strawberry_patches)}")
+    if len(apple_patches) == 2:
+        return 0
+    return 1
+"""
+
+
+def random_detections(count, size=(1024, 768), labels=("apple",), seed=0):
+    """重なりを含むランダムな検出結果 (boxes, scores, labels) を作成する"""
+    rng = random.Random(seed)
+    width, height = size
+    boxes, scores, names = [], [], []
+    for i in range(count):
+        box_width = rng.randint(20, width // 4)
+        box_height = rng.randint(20, height // 4)
+        x0 = rng.randint(0, width - box_width)
+        y0 = rng.randint(0, height - box_height)
+        boxes.append([x0, y0, x0 + box_width, y0 + box_height])
+        scores.append(round(rng.uniform(0.3, 0.95), 2))
+        names.append(labels[i % len(labels)])
+    return boxes, scores, names
+
+
+def measure(func, warmup=3, repeat=20, number=1, setup=None):
+    """
+    ウォームアップ後に繰り返し計測し、1回あたりの所要時間の統計を返す
+
+    Args:
+        func (callable): 計測する関数（引数なし）
+        warmup (int): 計測前に実行する回数
+        repeat (int): 計測するサンプル数
+        number (int): 1サンプルで実行する回数（短い処理の計測誤差を減らす）
+        setup (callable, optional): サンプルごとに計測外で呼ぶ関数（キャッシュのクリアなど）
+
+    Returns:
+        dict: min / median / mean / p95 / stdev（ミリ秒）とサンプル数
+    """
+    for _ in range(warmup):
+        if setup is not None:
+            setup()
+        func()
+
+    samples = []
+    for _ in range(repeat):
+        if setup is not None:
+            setup()
+        start = time.perf_counter()
+        for _ in range(number):
+            func()
+        samples.append((time.perf_counter() - start) * 1000 / number)
+
+    return {
+        "min_ms": round(min(samples), 4),
+        "median_ms": round(statistics.median(samples), 4),
+        "mean_ms": round(statistics.mean(samples), 4),
+        "p95_ms": round(percentile(samples, 95), 4),
+        "stdev_ms": round(statistics.stdev(samples), 4) if len(samples) > 1 else 0.0,
+        "repeat": repeat,
+        "number": number,
+    }
+
+
+def clear_caches():
+    """画像・実行結果・検出結果のキャッシュをクリアする"""
+    get_image_cache().clear()
+    get_result_cache().clear()
+    get_detection_memory().clear()
+
+
+def stub_cases():
+    """
+    合成の検出器で計測するケース
+
+    Returns:
+        list: (名前, 関数, measureのオプション) のリスト
+    """
+    cases = []
+
+    for count in (50, 300):
+        boxes, scores, labels = random_detections(count, labels=("apple", "banana"))
+        cases.append(
+            (
+                f"nms[{count}]",
+                lambda b=boxes, s=scores, lb=labels: nms(b, s, lb, 0.2),
+                {"number": 20 if count <= 50 else 5},
+            )
+        )
+
+    image = Image.new("RGB", (1024, 768))
+    patch_boxes, patch_scores, _ = random_detections(60)
+    patches = [
+        ImagePatch(image, box[0], box[3], box[2], box[1], score)
+        for box, score in zip(patch_boxes, patch_scores, strict=True)
+    ]
+    # delete_overlapsは引数のリストから要素を削除するため毎回コピーを渡す
+    cases.append(
+        (
+            "delete_overlaps[30x30]",
+            lambda: delete_overlaps(list(patches[:30]), list(patches[30:])),
+            {"number": 10},
+        )
+    )
+    cases.append(
+        (
+            "ImagePatch[100]",
+            lambda: [
+                ImagePatch(image, box[0], box[3], box[2], box[1], score)
+                for box, score in zip(
+                    patch_boxes + patch_boxes[:40],
+                    patch_scores + patch_scores[:40],
+                    strict=True,
+                )
+            ],
+            {"number": 20},
+        )
+    )
+
+    # content_hashのない画像はキャッシュを通らないため、毎回検出器の結果から
+    # NMS・座標の変換・ImagePatchの作成までを行う
+    detect_image = Image.new("RGB", (1024, 768))
+    cases.append(("detect[1 object]", lambda: detect(detect_image, "apple"), {}))
+    cases.append(
+        (
+            "detect[2 objects]",
+            lambda: detect(detect_image, "apple. strawberry"),
+            {},
+        )
+    )
+
+    cases.append(
+        (
+            "execute_code[cold]",
+            lambda: execute_code(SAMPLE_PROGRAM, SAMPLE_IMAGE, use_cache=False),
+            {"setup": clear_caches},
+        )
+    )
+    # 検出結果がメモリにある場合（同じ画像・条件の再実行）
+    cases.append(
+        (
+            "execute_code[warm detections]",
+            lambda: execute_code(SAMPLE_PROGRAM, SAMPLE_IMAGE, use_cache=False),
+            {},
+        )
+    )
+    cases.append(
+        (
+            "execute_code[cached result]",
+            lambda: execute_code(SAMPLE_PROGRAM, SAMPLE_IMAGE),
+            {"number": 20},
+        )
+    )
+    return cases
+
+
+def real_model_cases():
+    """Grounding DINOで計測するケース（初回のロードはウォームアップに含まれる）"""
+    image = load_image(SAMPLE_IMAGE, use_cache=False)
+    return [
+        ("real:detect[1 object]", lambda: detect(image, "apple"), {"repeat": 5}),
+        (
+            "real:execute_code[cold]",
+            lambda: execute_code(SAMPLE_PROGRAM, SAMPLE_IMAGE, use_cache=False),
+            {"setup": clear_caches, "repeat": 5},
+        ),
+    ]
+
+
+def measure_model_load(backend):
+    """モデルのロード時間（1回のみ、ミリ秒）"""
+    start = time.perf_counter()
+    backend.load()
+    elapsed = (time.perf_counter() - start) * 1000
+    return {"load_ms": round(elapsed, 1), "model_id": backend.model_id}
+
+
+def run_cases(cases, pattern=None, warmup=3, repeat=20):
+    results = {}
+    for name, func, options in cases:
+        if pattern and pattern not in name:
+            continue
+        options = {"warmup": warmup, "repeat": repeat, **options}
+        # 生成プログラムとfind()のprintで表示が流れないよう標準出力を捨てる
+        with contextlib.redirect_stdout(io.StringIO()):
+            results[name] = measure(func, **options)
+        print(f"  {name:<34}{results[name]['median_ms']:>12.3f} ms", flush=True)
+    return results
+
+
+def compare_to_baseline(results, baseline, threshold):
+    """
+    中央値を保存済みの結果と比較する
+
+    Args:
+        results (dict): ケース名 -> 統計
+        baseline (dict): 保存済みのケース名 -> 統計
+        threshold (float): 遅くなったとみなす割合（%）
+
+    Returns:
+        list: (ケース名, 基準の中央値, 今回の中央値, 変化率%, 劣化したか) のリスト
+    """
+    rows = []
+    for name, stats in results.items():
+        if name not in baseline:
+            continue
+        before = baseline[name]["median_ms"]
+        after = stats["median_ms"]
+        change = (after - before) / before * 100 if before > 0 else 0.0
+        rows.append((name, before, after, change, change > threshold))
+    return rows
+
+
+def environment():
+    info = {
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "processor": platform.processor() or platform.machine(),
+    }
+    try:
+        import torch
+
+        info["torch"] = torch.__version__
+        info["torch_threads"] = torch.get_num_threads()
+    except ImportError:
+        pass
+    return info
+
+
+def main():
+    parser = argparse.ArgumentParser(description="検出・実行のホットパスのベンチマーク")
+    parser.add_argument("--warmup", type=int, default=3, help="ウォームアップの回数")
+    parser.add_argument("--repeat", type=int, default=20, help="計測するサンプル数")
+    parser.add_argument("--filter", help="名前にこの文字列を含むケースのみ計測する")
+    parser.add_argument(
+        "--real-model", action="store_true", help="Grounding DINOのケースも計測する"
+    )
+    parser.add_argument("--output", help="結果を保存するJSONファイル")
+    parser.add_argument(
+        "--baseline",
+        default=str(DEFAULT_BASELINE),
+        help="比較する保存済みの結果（JSON。デフォルトは benchmarks/baseline.json）",
+    )
+    parser.add_argument(
+        "--no-baseline", action="store_true", help="保存済みの結果と比較しない"
+    )
+    parser.add_argument(
+        "--threshold",
+        type=float,
+        default=10.0,
+        help="中央値がこの割合（%%）を超えて遅くなったら劣化とみなす",
+    )
+    args = parser.parse_args()
+
+    # 実行ごとのINFOログで計測結果の表示が流れないようにする
+    logging.getLogger().setLevel(logging.WARNING)
+
+    report = {"environment": environment(), "results": {}}
+
+    print("stub model (SyntheticBackend):")
+    with use_detector_backend(SyntheticBackend()):
+        report["results"].update(
+            run_cases(stub_cases(), args.filter, args.warmup, args.repeat)
+        )
+
+    if args.real_model:
+        print("real model (Grounding DINO):")
+        backend = GroundingDinoBackend()
+        with use_detector_backend(backend):
+            report["model_load"] = measure_model_load(backend)
+            load = report["model_load"]
+            print(f"  model load ({load['model_id']}): {load['load_ms']:.1f} ms")
+            report["results"].update(
+                run_cases(real_model_cases(), args.filter, 1, args.repeat)
+            )
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        print(f"結果: {args.output}")
+
+    if args.no_baseline or not args.baseline:
+        return 0
+    if args.output and Path(args.output).resolve() == Path(args.baseline).resolve():
+        return 0  # ベースラインを更新した場合は比較しない
+    if not Path(args.baseline).exists():
+        print(f"比較する結果がありません: {args.baseline}")
+        return 0
+
+    with open(args.baseline, encoding="utf-8") as f:
+        baseline = json.load(f)["results"]
+    rows = compare_to_baseline(report["results"], baseline, args.threshold)
+    print("-" * 72)
+    print(f"{'case':<34}{'baseline':>12}{'current':>12}{'change':>10}")
+    for name, before, after, change, regressed in rows:
+        mark = "  REGRESSION" if regressed else ""
+        print(f"{name:<34}{before:>12.3f}{after:>12.3f}{change:>+9.1f}%{mark}")
+    regressions = [row for row in rows if row[4]]
+    if regressions:
+        print(
+            f"{len(regressions)}件のケースが{args.threshold:.0f}%を超えて遅くなりました"
+        )
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
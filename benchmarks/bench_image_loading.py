@@ -0,0 +1,104 @@
+#!/usr/bin/env python3
+"""
+画像読み込みのベンチマーク（12MP JPEG）
+
+従来の Image.open().convert("RGB") + フルサイズからのリサイズと、
+load_image() による縮小デコード（JPEG draftモード）を比較する。
+
+使い方:
+    python benchmarks/bench_image_loading.py --images 5 --repeat 3
+"""
+
+import argparse
+import os
+import statistics
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import numpy as np
+from PIL import Image
+
+# プロジェクトルートをPythonパスに追加
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from app.utils.code_executor import MAX_IMAGE_SIDE, load_image  # noqa: E402
+
+# Grounding DINOのプロセッサが内部でリサイズする最大サイズ
+PROCESSOR_SIZE = (1333, 1333)
+
+
+def create_jpegs(directory, count, size=(4000, 3000)):
+    """ノイズを含む12MPのJPEGを作成する（圧縮が効きすぎないようにする）"""
+    rng = np.random.default_rng(0)
+    paths = []
+    for i in range(count):
+        base = np.linspace(0, 255, size[0], dtype=np.uint8)[None, :, None]
+        noise = rng.integers(0, 64, (size[1], size[0], 3), dtype=np.uint8)
+        array = (base + noise).astype(np.uint8)
+        path = os.path.join(directory, f"image_{i}.jpg")
+        Image.fromarray(array).save(path, quality=90)
+        paths.append(path)
+    return paths
+
+
+def load_full(path):
+    """従来の読み込み: フルサイズでデコードしてからリサイズする"""
+    image = Image.open(path).convert("RGB")
+    image.thumbnail(PROCESSOR_SIZE, Image.Resampling.BILINEAR)
+    return image
+
+
+def load_capped(path):
+    """load_image()による縮小デコード"""
+    image = load_image(path, max_side=MAX_IMAGE_SIDE)
+    image.thumbnail(PROCESSOR_SIZE, Image.Resampling.BILINEAR)
+    return image
+
+
+def measure(func, paths, repeat):
+    timings = []
+    for _ in range(repeat):
+        for path in paths:
+            start = time.perf_counter()
+            func(path)
+            timings.append((time.perf_counter() - start) * 1000)
+    return timings
+
+
+def main():
+    parser = argparse.ArgumentParser(description="12MP JPEGの読み込みベンチマーク")
+    parser.add_argument("--images", type=int, default=5, help="作成する画像の枚数")
+    parser.add_argument("--repeat", type=int, default=3, help="繰り返し回数")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        print(f"{args.images}枚の4000x3000 JPEGを作成中...")
+        paths = create_jpegs(directory, args.images)
+
+        # ウォームアップ
+        load_full(paths[0])
+        load_capped(paths[0])
+
+        results = {
+            "full decode": measure(load_full, paths, args.repeat),
+            f"capped (max_side={MAX_IMAGE_SIDE})": measure(
+                load_capped, paths, args.repeat
+            ),
+        }
+
+    print("-" * 60)
+    print(f"{'method':<28}{'mean[ms]':>10}{'p50[ms]':>10}{'max[ms]':>10}")
+    for name, timings in results.items():
+        print(
+            f"{name:<28}{statistics.mean(timings):>10.1f}"
+            f"{statistics.median(timings):>10.1f}{max(timings):>10.1f}"
+        )
+    full, capped = (statistics.mean(t) for t in results.values())
+    print("-" * 60)
+    print(f"speedup: {full / capped:.2f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,140 @@
+#!/usr/bin/env python3
+"""
+few-shot例の選択によるプロンプト縮小のベンチマーク
+
+すべての例を含むテンプレート（top_k=0）と、条件に近い上位k個の例だけを
+含むプロンプトで、入力トークン数と例の選択にかかる時間を比較する。
+--live を指定するとAPIのcount_tokensで正確なトークン数を数え、
+実際のコード生成の応答時間も計測する（ANTHROPIC_API_KEYが必要）。
+
+使い方:
+    python benchmarks/bench_prompt_selection.py --top-k 4
+    ANTHROPIC_API_KEY=... python benchmarks/bench_prompt_selection.py --live
+"""
+
+import argparse
+import os
+import statistics
+import sys
+import time
+from pathlib import Path
+
+# プロジェクトルートをPythonパスに追加
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from app.utils.code_generator import (  # noqa: E402
+    MAX_TOKENS,
+    MODEL_NAME,
+    build_messages,
+)
+from app.utils.prompt_builder import FewShotSelector  # noqa: E402
+
+# 現場でよく使われる条件の例
+SAMPLE_CONDITIONS = [
+    "- 画像に2つのリンゴがあること",
+    "- 左側にチョコレートが4個あること",
+    "- The [chocolate] in the image is white.",
+    "- There are two [push bottles] to the left of the [foaming net].",
+    "- もし靴の色が赤なら、ボールはバスケットボールであること",
+]
+
+# トークン数の概算に使う1トークンあたりの文字数
+CHARS_PER_TOKEN = 3.5
+
+
+def prompt_text(messages):
+    return "".join(block["text"] for block in messages[0]["content"])
+
+
+def estimate_tokens(messages):
+    return int(len(prompt_text(messages)) / CHARS_PER_TOKEN)
+
+
+def count_tokens(client, messages):
+    """APIで入力トークン数を数える"""
+    return client.messages.count_tokens(
+        model=MODEL_NAME, messages=messages
+    ).input_tokens
+
+
+def time_generation(client, messages):
+    """コード生成1回の応答時間（秒）を返す"""
+    start = time.perf_counter()
+    client.messages.create(max_tokens=MAX_TOKENS, messages=messages, model=MODEL_NAME)
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--top-k", type=int, default=4, help="選択する例の数")
+    parser.add_argument("--repeat", type=int, default=200, help="選択時間の計測回数")
+    parser.add_argument(
+        "--live", action="store_true", help="APIでトークン数と応答時間を計測する"
+    )
+    args = parser.parse_args()
+
+    client = None
+    if args.live:
+        import anthropic
+
+        client = anthropic.Anthropic(api_key=os.environ["ANTHROPIC_API_KEY"])
+
+    start = time.perf_counter()
+    selector = FewShotSelector()
+    build_ms = (time.perf_counter() - start) * 1000
+    print(f"セレクタの構築: {build_ms:.2f}ms（例 {len(selector.examples)}個）")
+
+    unit = "トークン" if client else "トークン（概算）"
+    rows = []
+    for condition in SAMPLE_CONDITIONS:
+        full = build_messages(condition, top_k=0)
+        selected = build_messages(condition, top_k=args.top_k)
+
+        timings = []
+        for _ in range(args.repeat):
+            start = time.perf_counter()
+            selector.select(condition, args.top_k)
+            timings.append((time.perf_counter() - start) * 1000)
+
+        if client:
+            full_tokens = count_tokens(client, full)
+            selected_tokens = count_tokens(client, selected)
+        else:
+            full_tokens = estimate_tokens(full)
+            selected_tokens = estimate_tokens(selected)
+
+        row = {
+            "condition": condition,
+            "examples": [i + 1 for i in selector.select(condition, args.top_k)],
+            "full": full_tokens,
+            "selected": selected_tokens,
+            "select_ms": statistics.median(timings),
+        }
+        if client:
+            row["full_latency"] = time_generation(client, full)
+            row["selected_latency"] = time_generation(client, selected)
+        rows.append(row)
+
+    print(f"\ntop_k={args.top_k}  入力{unit}: 全例 -> 選択後")
+    for row in rows:
+        reduction = 1 - row["selected"] / row["full"]
+        line = (
+            f"{row['condition'][:40]:<40} {row['full']:>6} -> {row['selected']:>6}"
+            f" ({reduction:.0%}減)  例{row['examples']}  選択 {row['select_ms']:.3f}ms"
+        )
+        if client:
+            line += (
+                f"  応答 {row['full_latency']:.2f}s -> {row['selected_latency']:.2f}s"
+            )
+        print(line)
+
+    total_full = sum(row["full"] for row in rows)
+    total_selected = sum(row["selected"] for row in rows)
+    print(
+        f"\n合計: {total_full} -> {total_selected}"
+        f" ({1 - total_selected / total_full:.0%}減)"
+    )
+
+
+if __name__ == "__main__":
+    main()
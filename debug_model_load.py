@@ -1,110 +1,362 @@
 #!/usr/bin/env python3
 """
-Grounding DINOモデルのロード検証スクリプト
-EC2コンテナ内でのメモリ使用量とモデルロード成功/失敗を確認
+Grounding DINOのロード・推論のプロファイリング
+
+モデル（tiny / base）・精度・実行バックエンド・スレッド数・入力解像度の
+組み合わせごとに、モデルのロード時間・ピークRSSの増分・初回推論と
+定常状態の推論レイテンシを計測し、表（と --output を指定した場合はJSON）で
+出力する。Cloud Runのメモリ・CPUの設定を決めるためのデータを取る。
+
+RSS・ロード時間が前の組み合わせの影響を受けないよう、組み合わせごとに
+別のプロセスで計測する。
+
+精度:
+    fp32  そのまま
+    bf16  重みと入力をbfloat16にする
+    fp16  重みと入力をfloat16にする（CUDAのみ）
+    int8  Linear層を動的量子化する（CPUのみ）
+バックエンド:
+    eager    通常の実行
+    compile  torch.compileしたモデルで実行する（初回推論にコンパイルを含む）
+
+使い方:
+    python debug_model_load.py
+    python debug_model_load.py --models tiny --precisions fp32,int8 \
+        --threads 1,2 --resolutions 480,800 --output profile.json
+    docker exec -it streamlit-app python3 /app/debug_model_load.py --models tiny
 """
 
-import psutil
-import torch
+import argparse
+import json
+import os
+import resource
+import statistics
+import subprocess
+import sys
 import time
-import gc
-from transformers import AutoProcessor, AutoModelForZeroShotObjectDetection
+import traceback
+from itertools import product
 
-def print_memory_usage(stage):
-    """メモリ使用量を表示"""
-    memory = psutil.virtual_memory()
-    print(f"[{stage}] Available RAM: {memory.available / (1024**3):.2f} GB")
-    print(f"[{stage}] Used RAM: {(memory.total - memory.available) / (1024**3):.2f} GB")
-    print(f"[{stage}] Memory usage: {memory.percent}%")
-    print("-" * 50)
+import psutil
 
-def main():
-    print("=== Grounding DINO Model Load Test ===")
-    print_memory_usage("Initial")
-    
-    print(f'PyTorch version: {torch.__version__}')
-    print(f'CUDA available: {torch.cuda.is_available()}')
-    print(f'CUDA device count: {torch.cuda.device_count() if torch.cuda.is_available() else 0}')
-    
-    if torch.cuda.is_available():
-        print(f'CUDA device name: {torch.cuda.get_device_name(0)}')
-    
-    print("-" * 50)
-    
-    try:
-        model_id = 'IDEA-Research/grounding-dino-base'
-        print(f'Model ID: {model_id}')
-        print('Starting model load test...')
-        
-        # Step 1: プロセッサロード
-        print('\n1. Loading processor...')
-        start_time = time.time()
-        processor = AutoProcessor.from_pretrained(model_id)
-        processor_time = time.time() - start_time
-        print(f'Processor loaded successfully! ({processor_time:.2f}s)')
-        print_memory_usage("After Processor Load")
-        
-        # Step 2: モデルロード
-        print('\n2. Loading model...')
-        start_time = time.time()
-        device = "cuda" if torch.cuda.is_available() else "cpu"
-        print(f'Using device: {device}')
-        
-        model = AutoModelForZeroShotObjectDetection.from_pretrained(model_id)
-        model = model.to(device)
-        model_time = time.time() - start_time
-        
-        print(f'Model loaded successfully! ({model_time:.2f}s)')
-        print_memory_usage("After Model Load")
-        
-        # Step 3: 簡単な推論テスト
-        print('\n3. Testing inference...')
-        from PIL import Image
-        import numpy as np
-        
-        # ダミー画像作成
-        dummy_image = Image.fromarray(np.random.randint(0, 255, (224, 224, 3), dtype=np.uint8))
-        
-        start_time = time.time()
-        inputs = processor(images=dummy_image, text="apple.", return_tensors="pt").to(device)
-        
+# プロジェクトルートから実行しなくてもappのモジュールを読み込めるようにする
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from app.utils.metrics import percentile  # noqa: E402
+
+MODEL_IDS = {
+    "tiny": "IDEA-Research/grounding-dino-tiny",
+    "base": "IDEA-Research/grounding-dino-base",
+}
+PRECISIONS = ("fp32", "bf16", "fp16", "int8")
+BACKENDS = ("eager", "compile")
+# Grounding DINOのプロセッサのデフォルトの長辺の上限
+LONGEST_EDGE = 1333
+
+SAMPLE_IMAGE = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "app", "utils", "apple_strawberry.png"
+)
+
+# 表に出す項目（キー, 見出し, 書式）
+TABLE_COLUMNS = [
+    ("model", "model", "{}"),
+    ("precision", "prec", "{}"),
+    ("backend", "backend", "{}"),
+    ("threads", "thr", "{}"),
+    ("resolution", "res", "{}"),
+    ("load_s", "load[s]", "{:.2f}"),
+    ("peak_rss_delta_mb", "peakΔ[MB]", "{:.0f}"),
+    ("first_inference_ms", "first[ms]", "{:.0f}"),
+    ("steady_median_ms", "p50[ms]", "{:.0f}"),
+    ("steady_p95_ms", "p95[ms]", "{:.0f}"),
+]
+
+
+def peak_rss_bytes():
+    """プロセスのピークRSS（LinuxではKB単位で返る）"""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+def skip_reason(precision, device):
+    """この環境で計測できない組み合わせの理由を返す"""
+    if precision == "fp16" and device != "cuda":
+        return "fp16はCUDAでのみ計測します"
+    if precision == "int8" and device != "cpu":
+        return "int8の動的量子化はCPUでのみ計測します"
+    return None
+
+
+def load_image(path, resolution):
+    """計測に使う画像（ファイルがなければ乱数の画像）"""
+    import numpy as np
+    from PIL import Image
+
+    if path and os.path.exists(path):
+        return Image.open(path).convert("RGB")
+    height = resolution
+    width = min(LONGEST_EDGE, resolution * 4 // 3)
+    array = np.random.default_rng(0).integers(
+        0, 255, (height, width, 3), dtype=np.uint8
+    )
+    return Image.fromarray(array)
+
+
+def profile_combination(config):
+    """
+    1つの組み合わせを計測する（子プロセスで実行される）
+
+    Args:
+        config (dict): model, precision, backend, threads, resolution,
+            runs, query, image
+
+    Returns:
+        dict: configに計測結果を加えた辞書
+    """
+    import torch
+    from transformers import AutoModelForZeroShotObjectDetection, AutoProcessor
+
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+    result = {**config, "device": device, "torch": torch.__version__}
+    reason = skip_reason(config["precision"], device)
+    if reason:
+        return {**result, "status": "skipped", "error": reason}
+
+    torch.set_num_threads(config["threads"])
+    dtype = {"bf16": torch.bfloat16, "fp16": torch.float16}.get(config["precision"])
+    process = psutil.Process()
+    rss_before = process.memory_info().rss
+
+    # ロード（プロセッサ・重み・精度の変換・コンパイルの準備まで）
+    start = time.perf_counter()
+    model_id = MODEL_IDS.get(config["model"], config["model"])
+    processor = AutoProcessor.from_pretrained(model_id)
+    model = AutoModelForZeroShotObjectDetection.from_pretrained(model_id).to(device)
+    model.eval()
+    if dtype is not None:
+        model = model.to(dtype)
+    if config["precision"] == "int8":
+        model = torch.ao.quantization.quantize_dynamic(
+            model, {torch.nn.Linear}, dtype=torch.qint8
+        )
+    if config["backend"] == "compile":
+        model = torch.compile(model)
+    result["load_s"] = round(time.perf_counter() - start, 3)
+    result["rss_after_load_mb"] = round(process.memory_info().rss / 2**20, 1)
+
+    image = load_image(config["image"], config["resolution"])
+    size = {"shortest_edge": config["resolution"], "longest_edge": LONGEST_EDGE}
+
+    def infer():
+        inputs = processor(
+            images=image, text=config["query"], size=size, return_tensors="pt"
+        ).to(device)
+        if dtype is not None:
+            inputs["pixel_values"] = inputs["pixel_values"].to(dtype)
         with torch.no_grad():
             outputs = model(**inputs)
-        
-        inference_time = time.time() - start_time
-        print(f'Inference test completed! ({inference_time:.2f}s)')
-        print_memory_usage("After Inference")
-        
-        # Step 4: メモリクリーンアップテスト
-        print('\n4. Testing memory cleanup...')
-        del model
-        del processor
-        del inputs
-        del outputs
-        gc.collect()
-        
-        if torch.cuda.is_available():
-            torch.cuda.empty_cache()
-        
-        print_memory_usage("After Cleanup")
-        
-        print("\n✅ ALL TESTS PASSED!")
-        
+        processor.post_process_grounded_object_detection(
+            outputs,
+            inputs.input_ids,
+            box_threshold=0.3,
+            text_threshold=0.3,
+            target_sizes=[image.size[::-1]],
+        )
+        if device == "cuda":
+            torch.cuda.synchronize()
+
+    start = time.perf_counter()
+    infer()
+    result["first_inference_ms"] = round((time.perf_counter() - start) * 1000, 1)
+
+    latencies = []
+    for _ in range(config["runs"]):
+        start = time.perf_counter()
+        infer()
+        latencies.append((time.perf_counter() - start) * 1000)
+    result["steady_median_ms"] = round(statistics.median(latencies), 1)
+    result["steady_p95_ms"] = round(percentile(latencies, 95), 1)
+    result["peak_rss_delta_mb"] = round((peak_rss_bytes() - rss_before) / 2**20, 1)
+    result["status"] = "ok"
+    return result
+
+
+def run_worker(config_json):
+    """子プロセスのエントリポイント（結果を1行のJSONで標準出力に書く）"""
+    config = json.loads(config_json)
+    try:
+        result = profile_combination(config)
     except Exception as e:
-        print(f'\n❌ Model loading failed: {e}')
-        print("\nDetailed error:")
-        import traceback
         traceback.print_exc()
-        
-        print_memory_usage("After Error")
-        
-        # メモリ不足の場合の対策提案
-        if "out of memory" in str(e).lower() or "memory" in str(e).lower():
-            print("\n🔧 MEMORY ISSUE DETECTED!")
-            print("Suggested solutions:")
-            print("1. Increase EC2 instance to t3.medium (4GB RAM)")
-            print("2. Add swap memory: sudo swapon /swapfile") 
-            print("3. Use smaller model: grounding-dino-tiny")
+        result = {**config, "status": "error", "error": f"{type(e).__name__}: {e}"}
+    print(json.dumps(result, ensure_ascii=False))
+
+
+def run_isolated(config, timeout):
+    """組み合わせを別のプロセスで計測して結果を返す"""
+    command = [
+        sys.executable,
+        os.path.abspath(__file__),
+        "--worker",
+        json.dumps(config),
+    ]
+    try:
+        completed = subprocess.run(
+            command, capture_output=True, text=True, timeout=timeout
+        )
+    except subprocess.TimeoutExpired:
+        return {**config, "status": "error", "error": f"{timeout}秒でタイムアウト"}
+
+    lines = completed.stdout.strip().splitlines()
+    if completed.returncode == 0 and lines:
+        return json.loads(lines[-1])
+    # OOM killerなどで強制終了された場合は結果が出力されない
+    error = completed.stderr.strip().splitlines()[-1:] or [
+        f"終了コード {completed.returncode}"
+    ]
+    return {**config, "status": "error", "error": error[0]}
+
+
+def build_matrix(args):
+    """引数から計測する組み合わせのリストを作る"""
+    return [
+        {
+            "model": model,
+            "precision": precision,
+            "backend": backend,
+            "threads": threads,
+            "resolution": resolution,
+            "runs": args.runs,
+            "query": args.query,
+            "image": args.image,
+        }
+        for model, precision, backend, threads, resolution in product(
+            args.models,
+            args.precisions,
+            args.backends,
+            args.threads,
+            args.resolutions,
+        )
+    ]
+
+
+def format_table(results):
+    """結果を固定幅の表にする"""
+    header = "  ".join(f"{title:>10}" for _, title, _ in TABLE_COLUMNS)
+    lines = [header, "-" * len(header)]
+    for result in results:
+        cells = []
+        for key, _, fmt in TABLE_COLUMNS:
+            value = result.get(key)
+            cells.append(f"{'-' if value is None else fmt.format(value):>10}")
+        line = "  ".join(cells)
+        if result.get("status") != "ok":
+            error = result.get("error", "").splitlines()[:1]
+            line += f"  {result.get('status')}: {''.join(error)}"
+        lines.append(line)
+    return "\n".join(lines)
+
+
+def print_memory_usage(stage):
+    """メモリ使用量を表示"""
+    memory = psutil.virtual_memory()
+    print(
+        f"[{stage}] Available RAM: {memory.available / 2**30:.2f} GB, "
+        f"used: {memory.percent}%, CPUs: {os.cpu_count()}"
+    )
+
+
+def _csv(cast=str, choices=None):
+    def parse(value):
+        items = [cast(item.strip()) for item in value.split(",") if item.strip()]
+        invalid = [item for item in items if choices and item not in choices]
+        if invalid:
+            raise argparse.ArgumentTypeError(
+                f"{invalid} は指定できません（{', '.join(map(str, choices))}）"
+            )
+        return items
+
+    return parse
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(
+        description="Grounding DINOのロード・推論のプロファイリング"
+    )
+    parser.add_argument(
+        "--models",
+        type=_csv(),
+        default=["tiny", "base"],
+        help="tiny, base またはHugging FaceのモデルID（カンマ区切り）",
+    )
+    parser.add_argument(
+        "--precisions",
+        type=_csv(choices=PRECISIONS),
+        default=["fp32"],
+        help="fp32, bf16, fp16, int8（カンマ区切り）",
+    )
+    parser.add_argument(
+        "--backends",
+        type=_csv(choices=BACKENDS),
+        default=["eager"],
+        help="eager, compile（カンマ区切り）",
+    )
+    parser.add_argument(
+        "--threads",
+        type=_csv(int),
+        default=[os.cpu_count() or 1],
+        help="torchのスレッド数（カンマ区切り）",
+    )
+    parser.add_argument(
+        "--resolutions",
+        type=_csv(int),
+        default=[800],
+        help="入力の短辺のピクセル数（カンマ区切り。デフォルトはプロセッサと同じ800）",
+    )
+    parser.add_argument("--runs", type=int, default=5, help="定常状態の推論回数")
+    parser.add_argument("--query", default="apple. strawberry.", help="検出クエリ")
+    parser.add_argument(
+        "--image", default=SAMPLE_IMAGE, help="推論に使う画像（なければ乱数の画像）"
+    )
+    parser.add_argument(
+        "--timeout", type=int, default=1800, help="1つの組み合わせの制限時間（秒）"
+    )
+    parser.add_argument("--output", help="結果を保存するJSONファイル")
+    parser.add_argument("--worker", help=argparse.SUPPRESS)
+    return parser
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    if args.worker:
+        run_worker(args.worker)
+        return 0
+
+    matrix = build_matrix(args)
+    print("=== Grounding DINO load/inference profile ===")
+    print_memory_usage("Initial")
+    print(f"{len(matrix)}通りの組み合わせを計測します")
+
+    results = []
+    for i, config in enumerate(matrix, 1):
+        label = " ".join(
+            str(config[key])
+            for key in ("model", "precision", "backend", "threads", "resolution")
+        )
+        print(f"[{i}/{len(matrix)}] {label} ...", flush=True)
+        result = run_isolated(config, args.timeout)
+        results.append(result)
+        if result["status"] == "error" and "memory" in result["error"].lower():
+            print("  メモリ不足のため失敗しました（より小さいモデル・精度を検討）")
+
+    print()
+    print(format_table(results))
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(results, f, ensure_ascii=False, indent=2)
+        print(f"\n結果: {args.output}")
+    return 1 if any(result["status"] == "error" for result in results) else 0
+
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    sys.exit(main())
@@ -49,3 +49,34 @@ def execute_command(image_path, image):
 def invalid_test_code():
     """テスト用の無効なコードを提供"""
     return "this is not valid python code"
+
+
+@pytest.fixture(autouse=True)
+def reset_shared_caches(tmp_path, monkeypatch):
+    """プロセス全体で共有するキャッシュをテストごとにクリア"""
+    from app.utils import generation_cache
+    from app.utils.client_pool import get_client_pool
+    from app.utils.detection_cache import get_detection_memory
+    from app.utils.image_cache import get_image_cache
+    from app.utils.result_cache import get_result_cache
+    from app.utils.single_flight import get_single_flight
+
+    # 生成キャッシュはテストごとに一時ディレクトリを使う
+    monkeypatch.setattr(
+        generation_cache,
+        "_generation_cache",
+        generation_cache.GenerationCache(str(tmp_path / "generation_cache")),
+    )
+
+    caches = [
+        get_image_cache(),
+        get_result_cache(),
+        get_client_pool(),
+        get_detection_memory(),
+    ]
+    for cache in caches:
+        cache.clear()
+    get_single_flight().reset_stats()
+    yield
+    for cache in caches:
+        cache.clear()
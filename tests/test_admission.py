@@ -0,0 +1,220 @@
+import threading
+import time
+from unittest.mock import patch
+
+import pytest
+
+from app.utils.admission import (
+    MB,
+    AdmissionCancelledError,
+    AdmissionController,
+    AdmissionTimeoutError,
+    estimate_execution_memory,
+)
+from app.utils.code_executor import execute_code
+from app.utils.detector_backend import SyntheticBackend, use_detector_backend
+
+
+def make_controller(budget_mb, timeout=5):
+    return AdmissionController(
+        budget_bytes=budget_mb * MB,
+        model_bytes=lambda: 0,
+        timeout=timeout,
+        poll_interval=0.01,
+    )
+
+
+def wait_for(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition() and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert condition()
+
+
+class TestEstimateExecutionMemory:
+    """実行ごとのメモリの見積もりのテスト"""
+
+    def test_larger_images_need_more(self):
+        """画像が大きいほど見積もりが大きいテスト"""
+        small = estimate_execution_memory((640, 480), inference_bytes=0)
+        large = estimate_execution_memory((4000, 3000), inference_bytes=0)
+        assert large > small > 0
+
+    def test_max_image_side_caps_decoded_size(self):
+        """読み込み時に縮小する場合は縮小後の大きさで見積もるテスト"""
+        capped = estimate_execution_memory(
+            (4000, 3000), max_image_side=1333, inference_bytes=0
+        )
+        full = estimate_execution_memory((4000, 3000), inference_bytes=0)
+        assert capped < full
+
+    def test_tiled_reserves_batch(self):
+        """タイル検出はまとめて推論するタイル数分を見積もるテスト"""
+        single = estimate_execution_memory((4000, 3000), inference_bytes=100 * MB)
+        tiled = estimate_execution_memory(
+            (4000, 3000), tiled=True, max_batch=4, inference_bytes=100 * MB
+        )
+        assert tiled - single >= 300 * MB
+
+
+class TestAdmissionController:
+    """メモリの予算による受け付けのテスト"""
+
+    def test_admits_within_budget(self):
+        """予算内の実行は待たずに同時に受け付けるテスト"""
+        controller = make_controller(budget_mb=100)
+        with controller.admit(40 * MB), controller.admit(40 * MB):
+            assert controller.stats()["running"] == 2
+            assert controller.stats()["reserved_bytes"] == 80 * MB
+        assert controller.stats()["running"] == 0
+
+    def test_model_memory_reduces_capacity(self):
+        """モデルのメモリを予算から差し引くテスト"""
+        controller = AdmissionController(
+            budget_bytes=100 * MB, model_bytes=lambda: 70 * MB, timeout=0.05
+        )
+        with controller.admit(20 * MB), pytest.raises(AdmissionTimeoutError):
+            with controller.admit(20 * MB):
+                pass
+
+    def test_oversized_execution_runs_alone(self):
+        """予算を超える見積もりでも、実行中のものがなければ受け付けるテスト"""
+        controller = make_controller(budget_mb=10)
+        with controller.admit(50 * MB) as ticket:
+            assert controller.position(ticket) == 0
+
+    def test_queues_in_arrival_order(self):
+        """予算を超えた実行は到着順に待ち、順番を知らせるテスト"""
+        controller = make_controller(budget_mb=100)
+        release = threading.Event()
+        order = []
+        positions = {"b": [], "c": []}
+
+        def run(name):
+            with controller.admit(60 * MB, on_wait=positions.get(name, []).append):
+                order.append(name)
+                release.wait(5)
+
+        threads = {name: threading.Thread(target=run, args=(name,)) for name in "abc"}
+        threads["a"].start()
+        wait_for(lambda: order == ["a"])
+        threads["b"].start()
+        wait_for(lambda: controller.stats()["waiting"] == 1)
+        threads["c"].start()
+        wait_for(lambda: controller.stats()["waiting"] == 2)
+
+        release.set()
+        for thread in threads.values():
+            thread.join(5)
+
+        assert order == ["a", "b", "c"]
+        assert positions["b"] == [1, 0]
+        # cが1番目で待つかは、bの終了とcの確認のタイミングによる
+        assert positions["c"][0] == 2 and positions["c"][-1] == 0
+        assert controller.stats()["queued"] == 2
+
+    def test_timeout(self):
+        """待ち時間の上限を超えたらAdmissionTimeoutErrorになるテスト"""
+        controller = make_controller(budget_mb=100, timeout=0.05)
+        with controller.admit(80 * MB), pytest.raises(AdmissionTimeoutError):
+            with controller.admit(80 * MB):
+                pass
+        assert controller.stats()["waiting"] == 0
+
+    def test_cancel_while_waiting(self):
+        """待っている間にキャンセルされたら実行しないテスト"""
+        controller = make_controller(budget_mb=100)
+        with controller.admit(80 * MB), pytest.raises(AdmissionCancelledError):
+            with controller.admit(80 * MB, should_stop=lambda: True):
+                pass
+
+
+class TestExecuteCodeAdmission:
+    """execute_codeとアドミッション制御の連携のテスト"""
+
+    def test_execution_waits_for_budget(self, valid_test_code):
+        """予算に空きがなければ実行を待ち、順番を知らせるテスト"""
+        controller = make_controller(budget_mb=1)
+        positions = []
+        results = []
+        backend = SyntheticBackend(
+            script={"apple": [([0, 0, 10, 10], 0.9), ([20, 0, 30, 10], 0.8)]}
+        )
+
+        with (
+            use_detector_backend(backend),
+            patch(
+                "app.utils.code_executor.get_admission_controller",
+                return_value=controller,
+            ),
+        ):
+            with controller.admit(MB):
+                thread = threading.Thread(
+                    target=lambda: results.append(
+                        execute_code(valid_test_code, on_wait=positions.append)
+                    )
+                )
+                thread.start()
+                wait_for(lambda: positions == [1])
+                assert not results
+            thread.join(5)
+
+        assert positions == [1, 0]
+        assert results[0]["status"] == "success"
+
+    def test_followers_survive_leader_cancellation(self, valid_test_code):
+        """同じ実行を待つ呼び出しは、先頭のキャンセルを受け取らずに実行するテスト"""
+        controller = make_controller(budget_mb=1)
+        stop_leader = threading.Event()
+        leader_positions, follower_positions = [], []
+        results = {}
+        backend = SyntheticBackend(
+            script={"apple": [([0, 0, 10, 10], 0.9), ([20, 0, 30, 10], 0.8)]}
+        )
+
+        def run(name, positions, should_stop=None):
+            results[name] = execute_code(
+                valid_test_code, on_wait=positions.append, should_stop=should_stop
+            )
+
+        with (
+            use_detector_backend(backend),
+            patch(
+                "app.utils.code_executor.get_admission_controller",
+                return_value=controller,
+            ),
+        ):
+            with controller.admit(MB):
+                leader = threading.Thread(
+                    target=run, args=("leader", leader_positions, stop_leader.is_set)
+                )
+                leader.start()
+                wait_for(lambda: leader_positions == [1])
+                follower = threading.Thread(
+                    target=run, args=("follower", follower_positions)
+                )
+                follower.start()
+                # 先頭の順番が待っている呼び出しにも知らされる
+                wait_for(lambda: follower_positions == [1])
+                stop_leader.set()
+                leader.join(5)
+                assert results["leader"]["error_type"] == "cancelled"
+                assert "follower" not in results
+            follower.join(5)
+
+        assert results["follower"]["status"] == "success"
+        assert follower_positions[-1] == 0
+
+    def test_busy_error_on_timeout(self, valid_test_code):
+        """受け付けがタイムアウトしたら混雑のエラーを返すテスト"""
+        controller = make_controller(budget_mb=1, timeout=0.05)
+        with (
+            patch(
+                "app.utils.code_executor.get_admission_controller",
+                return_value=controller,
+            ),
+            controller.admit(MB),
+        ):
+            result = execute_code(valid_test_code)
+        assert result["status"] == "error"
+        assert result["error_type"] == "busy"
@@ -0,0 +1,150 @@
+import csv
+import json
+import shutil
+from unittest.mock import patch
+
+import pytest
+
+from app.cli import collect_images, main, percentile, summarize
+from app.utils.detector_backend import SyntheticBackend, use_detector_backend
+
+CODE = """
+def execute_command(image_path, image):
+    image_patch = ImagePatch(image)
+    apple_patches = image_patch.find("apple")
+    print(f"Number of apples is {len(apple_patches)}")
+    return 0 if len(apple_patches) == 2 else 1
+"""
+
+MULTI_OBJECT_CODE = """
+def execute_command(image_path, image):
+    image_patch = ImagePatch(image)
+    patch_dict = image_patch.find("apple. strawberry")
+    apple_patches = patch_dict["apple"]
+    strawberry_patches = patch_dict["strawberry"]
+    print(f"apple: {len(apple_patches)}, strawberry: {len(strawberry_patches)}")
+    return 0 if len(apple_patches) == 2 else 1
+"""
+
+TWO_APPLES = ([[1, 1, 20, 20], [30, 30, 50, 50]], [0.9, 0.8], ["apple", "apple"])
+
+
+@pytest.fixture
+def batch(tmp_path, sample_image_path):
+    """プログラムと3枚の画像（サブディレクトリを含む）を用意する"""
+    program = tmp_path / "generated_code.py"
+    program.write_text(CODE, encoding="utf-8")
+    images = tmp_path / "images"
+    (images / "sub").mkdir(parents=True)
+    for name in ("a.png", "b.PNG", "sub/c.jpg"):
+        shutil.copy(sample_image_path, images / name)
+    (images / "notes.txt").write_text("not an image")
+    return program, images
+
+
+class TestBatchHelpers:
+    """バッチ検査の補助関数のテスト"""
+
+    def test_collect_images(self, batch):
+        """ディレクトリとglobから画像だけを重複なく集めるテスト"""
+        _, images = batch
+        from_dir = collect_images([str(images)])
+        assert [p.rsplit("images", 1)[1] for p in from_dir] == [
+            "/a.png",
+            "/b.PNG",
+            "/sub/c.jpg",
+        ]
+        from_glob = collect_images([str(images / "*.png"), str(images / "a.png")])
+        assert len(from_glob) == 1
+
+    def test_percentile(self):
+        """最近傍順位法のパーセンタイルのテスト"""
+        values = list(range(1, 101))
+        assert percentile(values, 50) == 50
+        assert percentile(values, 95) == 95
+        assert percentile([7], 95) == 7
+        assert percentile([], 50) == 0.0
+
+    def test_summarize(self):
+        """件数・スループット・レイテンシの集計のテスト"""
+        records = [
+            {"status": "success", "latency_ms": 10.0},
+            {"status": "failure", "latency_ms": 30.0},
+            {"status": "success", "latency_ms": 20.0},
+        ]
+        summary = summarize(records, elapsed=1.5)
+        assert summary["counts"] == {"success": 2, "failure": 1}
+        assert summary["images_per_s"] == 2.0
+        assert summary["p50_ms"] == 20.0
+        assert summary["p95_ms"] == 30.0
+
+
+class TestCommandLine:
+    """コマンドラインのテスト"""
+
+    def test_jsonl_output(self, batch, tmp_path, capsys):
+        """画像ごとの結果をJSON Linesで書き出し、集計を表示するテスト"""
+        program, images = batch
+        output = tmp_path / "results.jsonl"
+        with (
+            use_detector_backend(SyntheticBackend()),
+            patch("app.utils.code_executor.detect_raw", return_value=TWO_APPLES),
+        ):
+            code = main(
+                [str(program), str(images), "--workers", "2", "-o", str(output)]
+            )
+
+        assert code == 0
+        records = [json.loads(line) for line in output.read_text().splitlines()]
+        assert len(records) == 3
+        assert all(record["status"] == "success" for record in records)
+        assert "Number of apples is 2" in records[0]["output_text"]
+        out = capsys.readouterr()
+        assert "3枚を検査しました（success: 3）" in out.out
+        assert "p95" in out.out
+        assert "[3/3]" in out.err
+
+    def test_csv_output(self, batch, tmp_path):
+        """出力先が.csvの場合はCSVで書き出すテスト"""
+        program, images = batch
+        output = tmp_path / "results.csv"
+        with (
+            use_detector_backend(SyntheticBackend()),
+            patch("app.utils.code_executor.detect_raw", return_value=TWO_APPLES),
+        ):
+            main([str(program), str(images / "a.png"), "-o", str(output), "--quiet"])
+
+        with open(output, encoding="utf-8") as f:
+            rows = list(csv.DictReader(f))
+        assert len(rows) == 1
+        assert rows[0]["status"] == "success"
+
+    def test_multi_object_program(self, batch, tmp_path):
+        """複数の物体を検出するプログラムが事前の試験実行を通るテスト"""
+        _, images = batch
+        program = tmp_path / "multi.py"
+        program.write_text(MULTI_OBJECT_CODE, encoding="utf-8")
+        output = tmp_path / "results.jsonl"
+        with (
+            use_detector_backend(SyntheticBackend()),
+            patch("app.utils.code_executor.detect_raw", return_value=TWO_APPLES),
+        ):
+            code = main([str(program), str(images / "a.png"), "-o", str(output)])
+
+        assert code == 0
+        record = json.loads(output.read_text())
+        assert record["status"] == "success"
+        assert "apple: 2, strawberry: 0" in record["output_text"]
+
+    def test_invalid_program(self, tmp_path, batch, capsys):
+        """実行できないプログラムは検査せずに終了コード2を返すテスト"""
+        _, images = batch
+        program = tmp_path / "broken.py"
+        program.write_text("def broken(")
+        assert main([str(program), str(images)]) == 2
+        assert "プログラムを実行できません" in capsys.readouterr().err
+
+    def test_no_images(self, batch, tmp_path):
+        """画像が見つからない場合は終了コード2を返すテスト"""
+        program, _ = batch
+        assert main([str(program), str(tmp_path / "missing" / "*.png")]) == 2
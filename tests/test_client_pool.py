@@ -0,0 +1,128 @@
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest.mock import MagicMock, patch
+
+import pytest
+
+from app.utils.client_pool import AnthropicClientPool, hash_api_key
+from app.utils.code_generator import generate_anomaly_detection_code
+
+STUB_RESPONSE = {
+    "id": "msg_stub",
+    "type": "message",
+    "role": "assistant",
+    "model": "claude-3-7-sonnet-20250219",
+    "content": [
+        {
+            "type": "text",
+            "text": "def execute_command(image_path, image):\n    return 0\n",
+        }
+    ],
+    "stop_reason": "end_turn",
+    "stop_sequence": None,
+    "usage": {"input_tokens": 10, "output_tokens": 10},
+}
+
+
+@pytest.fixture
+def stub_server():
+    """接続数とリクエスト数を数えるMessages APIのスタブサーバー"""
+    counts = {"connections": 0, "requests": 0}
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"  # keep-aliveを有効にする
+
+        def setup(self):
+            super().setup()
+            counts["connections"] += 1
+
+        def do_POST(self):
+            self.rfile.read(int(self.headers.get("Content-Length", 0)))
+            counts["requests"] += 1
+            body = json.dumps(STUB_RESPONSE).encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield f"http://127.0.0.1:{server.server_address[1]}", counts
+    server.shutdown()
+    server.server_close()
+
+
+class TestAnthropicClientPool:
+    """Anthropicクライアントプールのテスト"""
+
+    def test_reuses_client_per_api_key(self):
+        """同じAPIキーには同じクライアントが返されることのテスト"""
+        pool = AnthropicClientPool()
+
+        first = pool.get("key-a")
+
+        assert pool.get("key-a") is first
+        assert pool.get("key-b") is not first
+        assert pool.stats() == {"size": 2, "created": 2, "reused": 1, "evicted": 0}
+
+    def test_pool_keys_do_not_contain_plaintext(self):
+        """プールのキーに平文のAPIキーが含まれないことのテスト"""
+        pool = AnthropicClientPool()
+        pool.get("sk-secret-key")
+
+        assert list(pool._clients) == [hash_api_key("sk-secret-key")]
+        assert "sk-secret-key" not in repr(list(pool._clients))
+
+    def test_bounded_size_closes_least_recently_used(self):
+        """上限を超えると最も古く使われたクライアントが閉じられることのテスト"""
+        with patch("app.utils.client_pool.anthropic.Anthropic") as mock_anthropic:
+            clients = [MagicMock(), MagicMock(), MagicMock()]
+            mock_anthropic.side_effect = clients
+            pool = AnthropicClientPool(max_size=2)
+
+            pool.get("a")
+            pool.get("b")
+            pool.get("c")
+
+        clients[0].close.assert_called_once()
+        assert pool.stats()["size"] == 2
+
+    def test_idle_clients_are_evicted(self):
+        """一定時間使われなかったクライアントが閉じられることのテスト"""
+        with (
+            patch("app.utils.client_pool.anthropic.Anthropic") as mock_anthropic,
+            patch("app.utils.client_pool.time.monotonic") as mock_time,
+        ):
+            client = MagicMock()
+            mock_anthropic.return_value = client
+            pool = AnthropicClientPool(idle_timeout=60)
+
+            mock_time.return_value = 0.0
+            pool.get("a")
+            mock_time.return_value = 61.0
+            assert pool.evict_idle() == 1
+
+        client.close.assert_called_once()
+        assert pool.stats()["size"] == 0
+
+    def test_generation_reuses_connection(self, stub_server):
+        """連続した生成でHTTP接続が再利用されることのテスト"""
+        base_url, counts = stub_server
+        pool = AnthropicClientPool(base_url=base_url, max_retries=0)
+
+        with patch("app.utils.code_generator.get_client_pool", return_value=pool):
+            for _ in range(3):
+                code = generate_anomaly_detection_code(
+                    "test condition", "dummy-key", use_cache=False
+                )
+                assert "def execute_command" in code
+
+        assert counts["requests"] == 3
+        assert counts["connections"] == 1
+        pool.clear()
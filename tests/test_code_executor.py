@@ -1,3 +1,5 @@
+import builtins
+import threading
 from unittest.mock import MagicMock, patch
 
 import numpy as np
@@ -5,11 +7,23 @@ import pytest
 from PIL import Image
 
 from app.utils.code_executor import (
+    ImagePatch,
     check_memory_usage,
+    compute_tiles,
     detect,
+    detect_tiles,
+    dry_run_code,
     execute_code,
+    execute_function_from_code,
+    extract_program,
+    get_original_size,
+    load_image,
     load_model_with_fallback,
+    merge_tile_detections,
+    scale_boxes_to_original,
 )
+from app.utils.detector_backend import SyntheticBackend, use_detector_backend
+from app.utils.image_cache import set_original_size
 
 
 class TestCodeExecutor:
@@ -223,3 +237,276 @@ class TestCodeExecutor:
                 result = execute_code(test_code)
                 # タイムアウトが適切に処理されることを確認
                 assert "status" in result
+
+    def test_print_captured_per_execution(self):
+        """同時に実行したプログラムのprint出力が混ざらないテスト"""
+        code = """
+def execute_command(image_path, image):
+    import time
+    for _ in range(20):
+        print(image_path)
+        time.sleep(0.001)
+    return formatting_answer(0)
+"""
+        original_print = builtins.print
+        image = Image.new("RGB", (10, 10))
+        outputs = {}
+
+        def run(name):
+            _, outputs[name] = execute_function_from_code(
+                code, "execute_command", name, image
+            )
+
+        threads = [threading.Thread(target=run, args=(name,)) for name in "ab"]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join(5)
+
+        assert builtins.print is original_print
+        for name in "ab":
+            lines = outputs[name].splitlines()
+            assert lines == [name] * 20 + ["Program output: 0"]
+
+    def test_detection_settings_per_execution(self):
+        """同時に実行したプログラムがそれぞれのしきい値で検出するテスト"""
+        code = """
+def execute_command(image_path, image):
+    import time
+    time.sleep(0.05)
+    return len(ImagePatch(image).find("apple"))
+"""
+        backend = SyntheticBackend(script={"apple": [([0, 0, 10, 10], 0.5)]})
+        image = Image.new("RGB", (20, 20))
+        counts = {}
+
+        def run(threshold):
+            counts[threshold], _ = execute_function_from_code(
+                code, "execute_command", None, image, box_threshold=threshold
+            )
+
+        with use_detector_backend(backend):
+            threads = [
+                threading.Thread(target=run, args=(threshold,))
+                for threshold in (0.3, 0.7)
+            ]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join(5)
+
+        assert counts == {0.3: 1, 0.7: 0}
+
+
+class TestTiledDetection:
+    """タイル分割推論のテスト"""
+
+    def test_compute_tiles_covers_image(self):
+        """タイルが画像全体を重なり付きで覆うことのテスト"""
+        tiles = compute_tiles(2000, 1000, tile_size=800, overlap=160)
+
+        assert tiles[0] == (0, 0, 800, 800)
+        assert max(t[2] for t in tiles) == 2000
+        assert max(t[3] for t in tiles) == 1000
+        for left, upper, right, lower in tiles:
+            assert right - left == 800
+            assert lower - upper == 800
+
+    def test_compute_tiles_small_image(self):
+        """タイルより小さい画像は1タイルになることのテスト"""
+        assert compute_tiles(300, 200, tile_size=800, overlap=160) == [(0, 0, 300, 200)]
+
+    def test_compute_tiles_invalid_overlap(self):
+        """overlapがtile_size以上の場合のエラーテスト"""
+        with pytest.raises(ValueError):
+            compute_tiles(1000, 1000, tile_size=100, overlap=100)
+
+    def test_detect_tiles_batches_and_offsets(self):
+        """タイルがmax_batchごとにまとめて推論され、座標が平行移動されることのテスト"""
+        image = Image.new("RGB", (1000, 500))
+        batch_sizes = []
+
+        def fake_batch(images, obj_name, box_threshold):
+            batch_sizes.append(len(images))
+            return [([[10, 10, 60, 60]], [0.9], ["apple"]) for _ in images]
+
+        boxes, scores, labels = detect_tiles(
+            fake_batch,
+            image,
+            "apple.",
+            0.3,
+            tile_size=400,
+            overlap=100,
+            max_batch=2,
+        )
+
+        # 1000x500 -> 横3 x 縦2 = 6タイル、2枚ずつ推論
+        assert batch_sizes == [2, 2, 2]
+        assert [10, 10, 60, 60] in boxes
+        assert [310, 110, 360, 160] in boxes
+        assert len(boxes) == len(scores) == len(labels) == 6
+
+    def test_merge_tile_detections_drops_truncated_duplicates(self):
+        """タイル境界で切れた検出結果が隣のタイルの結果に吸収されることのテスト"""
+        tiles = [(0, 0, 500, 500), (400, 0, 900, 500)]
+        boxes = [[420, 100, 500, 200], [420, 100, 560, 200]]
+        scores = [0.6, 0.8]
+        labels = ["apple", "apple"]
+
+        merged = merge_tile_detections(boxes, scores, labels, [0, 1], tiles, (900, 500))
+
+        assert merged[0] == [[420, 100, 560, 200]]
+        assert merged[1] == [0.8]
+
+    def test_merge_tile_detections_joins_wide_object(self):
+        """重なりより大きい物体の断片同士は削除せずに結合されることのテスト"""
+        tiles = [(0, 0, 500, 500), (400, 0, 900, 500)]
+        boxes = [[395, 100, 500, 200], [400, 100, 505, 200]]
+
+        merged = merge_tile_detections(
+            boxes, [0.6, 0.8], ["apple", "apple"], [0, 1], tiles, (900, 500)
+        )
+
+        assert merged == ([[395, 100, 505, 200]], [0.8], ["apple"])
+
+
+class TestImageLoading:
+    """画像読み込み時の解像度上限のテスト"""
+
+    def test_load_image_caps_large_jpeg(self, tmp_path):
+        """大きなJPEGが最大辺以下に縮小され、元サイズが保持されることのテスト"""
+        path = tmp_path / "large.jpg"
+        Image.new("RGB", (4000, 3000), (200, 10, 10)).save(path, quality=90)
+
+        image = load_image(str(path), max_side=1333)
+
+        assert max(image.size) <= 1333
+        assert image.mode == "RGB"
+        assert get_original_size(image) == (4000, 3000)
+
+    def test_load_image_without_cap(self, sample_image_path):
+        """max_sideを指定しない場合は元のサイズで読み込むことのテスト"""
+        original = Image.open(sample_image_path)
+
+        image = load_image(sample_image_path, max_side=None)
+
+        assert image.size == original.size
+        assert get_original_size(image) == original.size
+
+    def test_boxes_and_patches_use_original_coordinates(self):
+        """縮小画像上のboxとImagePatchが元画像の座標系になることのテスト"""
+        image = Image.new("RGB", (1000, 750))
+        set_original_size(image, (4000, 3000))
+
+        assert scale_boxes_to_original([[10, 20, 100, 200]], image) == [
+            [40, 80, 400, 800]
+        ]
+        patch = ImagePatch(image)
+        assert (patch.width, patch.height) == (4000, 3000)
+
+    @pytest.mark.parametrize("use_cache", [True, False])
+    def test_derived_images_use_their_own_size(self, tmp_path, use_cache):
+        """縮小して読み込んだ画像から切り出した画像は元のサイズを引き継がないテスト"""
+        path = tmp_path / "large.jpg"
+        Image.new("RGB", (4000, 3000), (200, 10, 10)).save(path, quality=90)
+        image = load_image(str(path), max_side=1333, use_cache=use_cache)
+
+        crop = image.crop((0, 0, 200, 100))
+        resized = image.resize((100, 75))
+
+        assert get_original_size(crop) == (200, 100)
+        assert get_original_size(resized) == (100, 75)
+        assert scale_boxes_to_original([[10, 20, 50, 60]], crop) == [[10, 20, 50, 60]]
+        patch = ImagePatch(crop)
+        assert (patch.width, patch.height) == (200, 100)
+
+
+class TestComposedProgram:
+    """複数の関数からなるプログラムの実行テスト"""
+
+    COMPOSED_CODE = """
+def check_condition_1(image_path, image):
+    print("condition 1")
+    return 0
+
+
+def check_condition_2(image_path, image):
+    print("condition 2")
+    return 1
+
+
+def execute_command(image_path, image):
+    anomaly_score = 0
+    anomaly_score += check_condition_1(image_path, image)
+    anomaly_score += check_condition_2(image_path, image)
+    return anomaly_score
+"""
+
+    def test_extract_program_keeps_all_functions(self):
+        """execute_commandを含む複数の関数をまとめて取り出すテスト"""
+        program = extract_program("```python" + self.COMPOSED_CODE + "```")
+        assert program.count("def ") == 3
+
+    def test_extract_program_falls_back_to_first_function(self):
+        """後ろに説明文が続く場合は最初の関数だけを取り出すテスト"""
+        code = "def execute_command(image_path, image):\n    return 0\n"
+        program = extract_program(code + "This def is explained here.")
+        assert program.startswith("def execute_command")
+        assert "explained" not in program
+
+    def test_execute_composed_program(self):
+        """関数同士の呼び出しを含むプログラムを実行できるテスト"""
+        dummy_image = Image.fromarray(np.zeros((50, 50, 3), dtype=np.uint8))
+
+        with patch("app.utils.code_executor.Image.open", return_value=dummy_image):
+            result = execute_code(self.COMPOSED_CODE, use_cache=False)
+
+        # 条件2だけが異常と判定するため、合計スコアは1
+        assert result["status"] == "failure"
+        assert result["score"] == 1
+        assert "condition 1" in result["output_text"]
+        assert "condition 2" in result["output_text"]
+
+    def test_dry_run_valid_code(self):
+        """モデルを使わずに試験実行できるテスト"""
+        code = """
+def execute_command(image_path, image):
+    image_patch = ImagePatch(image)
+    apples = image_patch.find("apple")
+    print(len(apples))
+    return 0 if len(apples) == 2 else 1
+"""
+        with patch("app.utils.code_executor.detect") as mock_detect:
+            dry_run_code(code)
+        mock_detect.assert_not_called()
+
+    def test_dry_run_multiple_objects(self):
+        """複数の物体を検出するテンプレートのコードを試験実行できるテスト"""
+        code = """
+def execute_command(image_path, image):
+    image_patch = ImagePatch(image)
+    patch_dict = image_patch.find("apple. watermelon")
+    apple_patches = patch_dict["apple"]
+    watermelon_patches = patch_dict["watermelon"]
+    apple_patches, watermelon_patches = delete_overlaps(
+        apple_patches, watermelon_patches
+    )
+    if len(apple_patches) == 0:
+        return formatting_answer(1)
+    if len(watermelon_patches) == 0:
+        return formatting_answer(1)
+    anomaly_score = 0
+    if apple_patches[0].vertical_center > watermelon_patches[0].vertical_center:
+        anomaly_score += 1
+    return formatting_answer(anomaly_score)
+"""
+        dry_run_code(code)
+
+    def test_dry_run_errors(self):
+        """試験実行で失敗するコードはValueErrorになるテスト"""
+        with pytest.raises(ValueError, match="NameError"):
+            dry_run_code("def execute_command(image_path, image):\n    return x\n")
+        with pytest.raises(ValueError, match="int型"):
+            dry_run_code("def execute_command(image_path, image):\n    return 'ok'\n")
+        with pytest.raises(ValueError, match="見つかりません"):
+            dry_run_code("def other(image_path, image):\n    return 0\n")
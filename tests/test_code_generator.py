@@ -1,8 +1,19 @@
+import re
+import threading
+import time
 from unittest.mock import MagicMock, patch
 
 import pytest
 
-from app.utils.code_generator import generate_anomaly_detection_code
+from app.utils.code_generator import (
+    build_messages,
+    compose_condition_functions,
+    find_complete_function,
+    generate_anomaly_detection_code,
+    generate_anomaly_detection_code_stream,
+    generate_per_condition_code,
+    generate_speculative_code,
+)
 
 
 class TestCodeGenerator:
@@ -153,3 +164,471 @@ class TestCodeGenerator:
         # エラーが発生してもコード生成は成功する
         result = generate_anomaly_detection_code("test condition", "dummy_api_key")
         assert "execute_command" in result
+
+
+class TestPromptCaching:
+    """プロンプトキャッシュのテスト"""
+
+    def test_build_messages_splits_static_prefix(self):
+        """テンプレートがキャッシュ対象のブロックとして分離されるテスト"""
+        from app.utils.template_prompt import prompt
+
+        messages = build_messages("There are two apples.", top_k=0)
+        static_block, condition_block = messages[0]["content"]
+
+        assert static_block["text"] == prompt
+        assert static_block["cache_control"] == {"type": "ephemeral"}
+        assert "cache_control" not in condition_block
+        assert "Normal condition: There are two apples." in condition_block["text"]
+        # 条件が変わっても固定部分は同じ（キャッシュが再利用される）
+        other = build_messages("There is one banana.", top_k=0)[0]["content"][0]
+        assert other == static_block
+
+    def test_build_messages_with_selected_examples(self):
+        """例を絞った場合もモジュールの説明部分はキャッシュ対象で共通のテスト"""
+        from app.utils.template_prompt import prompt
+
+        static_block, dynamic_block = build_messages(
+            "There are two [apples].", top_k=3
+        )[0]["content"]
+        other = build_messages("The [chocolate] is white.", top_k=3)[0]["content"]
+
+        assert static_block["cache_control"] == {"type": "ephemeral"}
+        assert static_block == other[0]
+        assert prompt.startswith(static_block["text"])
+        assert len(re.findall(r"Normal_condition\d+:", dynamic_block["text"])) == 3
+        assert dynamic_block["text"] != other[1]["text"]
+
+    @patch("app.utils.code_generator.anthropic.Anthropic")
+    def test_usage_is_returned(self, mock_anthropic):
+        """キャッシュの読み書きトークン数が結果に含まれるテスト"""
+        mock_client = MagicMock()
+        mock_anthropic.return_value = mock_client
+        mock_response = MagicMock()
+        mock_response.content = [MagicMock()]
+        mock_response.content[0].text = "def execute_command(image_path, image):\n"
+        mock_response.usage.input_tokens = 20
+        mock_response.usage.output_tokens = 50
+        mock_response.usage.cache_creation_input_tokens = 0
+        mock_response.usage.cache_read_input_tokens = 6000
+        mock_client.messages.create.return_value = mock_response
+
+        code, usage = generate_anomaly_detection_code(
+            "test condition", "dummy_api_key", return_usage=True
+        )
+
+        assert "execute_command" in code
+        assert usage == {
+            "input_tokens": 20,
+            "output_tokens": 50,
+            "cache_creation_input_tokens": 0,
+            "cache_read_input_tokens": 6000,
+        }
+        kwargs = mock_client.messages.create.call_args.kwargs
+        assert kwargs["messages"][0]["content"][0]["cache_control"] == {
+            "type": "ephemeral"
+        }
+
+
+class FakeStream:
+    """messages.stream()の代わりに決まったチャンクを返すストリーム"""
+
+    def __init__(self, chunks, usage=None):
+        self.chunks = chunks
+        self.consumed = 0
+        self.closed = False
+        self.current_message_snapshot = MagicMock(usage=usage)
+
+    @property
+    def text_stream(self):
+        for chunk in self.chunks:
+            self.consumed += 1
+            yield chunk
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.closed = True
+        return False
+
+
+STREAM_CHUNKS = [
+    "```python\n",
+    "def execute_command(image_path, image):\n",
+    "    image_patch = ImagePatch(image)\n",
+    "    return 0\n",
+    "```\n",
+    "This function checks ",
+    "the number of apples.\n",
+    "def helper():\n",
+    "    return 1\n",
+]
+
+
+class TestStreamingCodeGenerator:
+    """ストリーミング生成のテスト"""
+
+    def test_find_complete_function_waits_for_body_end(self):
+        """関数の終わりが確定するまでNoneを返すテスト"""
+        partial = "def execute_command(image_path, image):\n    return 0\n"
+        assert find_complete_function(partial) is None
+        assert find_complete_function(partial + "    #続き") is None
+
+        complete = find_complete_function(partial + "```\n")
+        assert complete == partial
+
+    def test_find_complete_function_dedent(self):
+        """インデントが戻った行で関数の終わりを検出するテスト"""
+        text = (
+            "    def execute_command(image_path, image):\n"
+            "        if True:\n"
+            "\n"
+            "            return 1\n"
+            "        return 0\n"
+            "    print('done')\n"
+        )
+        complete = find_complete_function(text)
+        assert complete.endswith("        return 0\n")
+        assert "print" not in complete
+
+    @patch("app.utils.code_generator.anthropic.Anthropic")
+    def test_stream_stops_after_execute_command(self, mock_anthropic):
+        """execute_commandが完結した時点でストリームを止めるテスト"""
+        stream = FakeStream(STREAM_CHUNKS)
+        mock_client = MagicMock()
+        mock_client.messages.stream.return_value = stream
+        mock_anthropic.return_value = mock_client
+        received = []
+
+        result = generate_anomaly_detection_code_stream(
+            "test condition", "dummy_api_key", on_text=received.append
+        )
+
+        assert result.startswith("def execute_command(image_path, image):")
+        assert "return 0" in result
+        assert "helper" not in result
+        # 閉じコードブロックまでで停止し、後続のチャンクは受信しない
+        assert stream.consumed == 5
+        assert stream.closed
+        assert len(received) == 5
+        assert received[-1].endswith("```\n")
+        mock_client.messages.create.assert_not_called()
+
+    @patch("app.utils.code_generator.anthropic.Anthropic")
+    def test_stream_without_early_stop(self, mock_anthropic):
+        """関数の終わりが検出できない場合は全文から抽出するテスト"""
+        chunks = ["def execute_command(image_path, image):\n", "    return 0"]
+        stream = FakeStream(chunks)
+        mock_client = MagicMock()
+        mock_client.messages.stream.return_value = stream
+        mock_anthropic.return_value = mock_client
+
+        result = generate_anomaly_detection_code_stream(
+            "test condition", "dummy_api_key"
+        )
+
+        assert stream.consumed == 2
+        assert result == "def execute_command(image_path, image):\n    return 0"
+
+    @patch("app.utils.code_generator.anthropic.Anthropic")
+    def test_stream_empty_response(self, mock_anthropic):
+        """ストリームが空の場合のテスト"""
+        mock_client = MagicMock()
+        mock_client.messages.stream.return_value = FakeStream([])
+        mock_anthropic.return_value = mock_client
+
+        with pytest.raises(ValueError, match="APIからの応答が空です"):
+            generate_anomaly_detection_code_stream("test condition", "dummy_api_key")
+
+    @patch("app.utils.code_generator.anthropic.Anthropic")
+    def test_stream_connection_error(self, mock_anthropic):
+        """ストリーミング中のAPI接続エラーのテスト"""
+        import anthropic
+
+        mock_client = MagicMock()
+        mock_anthropic.return_value = mock_client
+        mock_client.messages.stream.side_effect = anthropic.APIConnectionError(
+            request=MagicMock()
+        )
+
+        with pytest.raises(
+            ConnectionError, match="Anthropic APIへの接続に失敗しました"
+        ):
+            generate_anomaly_detection_code_stream("test condition", "dummy_api_key")
+
+    @patch("app.utils.code_generator.anthropic.Anthropic")
+    def test_stream_usage_after_early_stop(self, mock_anthropic):
+        """途中で止めた場合もキャッシュのトークン数を返すテスト"""
+        usage = MagicMock(
+            input_tokens=20,
+            output_tokens=1,
+            cache_creation_input_tokens=6000,
+            cache_read_input_tokens=0,
+        )
+        mock_client = MagicMock()
+        mock_client.messages.stream.return_value = FakeStream(STREAM_CHUNKS, usage)
+        mock_anthropic.return_value = mock_client
+
+        _, result_usage = generate_anomaly_detection_code_stream(
+            "test condition", "dummy_api_key", return_usage=True
+        )
+
+        assert result_usage["cache_creation_input_tokens"] == 6000
+        assert result_usage["cache_read_input_tokens"] == 0
+        # 出力トークン数はmessage_startの仮の値しかないため不明とする
+        assert result_usage["output_tokens"] is None
+
+    @patch("app.utils.code_generator.anthropic.Anthropic")
+    def test_stream_usage_without_early_stop(self, mock_anthropic):
+        """最後まで受信した場合は出力トークン数を返すテスト"""
+        usage = MagicMock(
+            input_tokens=20,
+            output_tokens=12,
+            cache_creation_input_tokens=0,
+            cache_read_input_tokens=0,
+        )
+        chunks = ["def execute_command(image_path, image):\n", "    return 0"]
+        mock_client = MagicMock()
+        mock_client.messages.stream.return_value = FakeStream(chunks, usage)
+        mock_anthropic.return_value = mock_client
+
+        _, result_usage = generate_anomaly_detection_code_stream(
+            "test condition", "dummy_api_key", return_usage=True
+        )
+
+        assert result_usage["output_tokens"] == 12
+
+
+def condition_response(**kwargs):
+    """条件のテキストに応じたexecute_commandを返すmessages.createの代わり"""
+    condition = kwargs["messages"][0]["content"][-1]["text"]
+    response = MagicMock()
+    response.content = [MagicMock()]
+    score = 1 if "banana" in condition else 0
+    response.content[
+        0
+    ].text = f"def execute_command(image_path, image):\n    return {score}\n"
+    return response
+
+
+class TestPerConditionGeneration:
+    """条件ごとの並列生成のテスト"""
+
+    def test_compose_condition_functions(self):
+        """条件ごとの関数を改名し、スコアを合計する関数を作るテスト"""
+        code = compose_condition_functions(
+            [
+                "def execute_command(image_path, image):\n    return 0\n",
+                "def execute_command(image_path, image):\n    return 1\n",
+            ]
+        )
+
+        namespace = {}
+        exec(code, namespace)
+        assert namespace["check_condition_1"](None, None) == 0
+        assert namespace["check_condition_2"](None, None) == 1
+        assert namespace["execute_command"](None, None) == 1
+
+    @patch("app.utils.code_generator.anthropic.Anthropic")
+    def test_generates_each_condition(self, mock_anthropic):
+        """条件の数だけAPIを呼び、1つのプログラムにまとめるテスト"""
+        mock_client = MagicMock()
+        mock_client.messages.create.side_effect = condition_response
+        mock_anthropic.return_value = mock_client
+
+        code = generate_per_condition_code(
+            ["two apples", "no banana", ""], "dummy_api_key"
+        )
+
+        assert mock_client.messages.create.call_count == 2
+        namespace = {}
+        exec(code, namespace)
+        assert namespace["execute_command"](None, None) == 1
+
+    @patch("app.utils.code_generator.anthropic.Anthropic")
+    def test_only_changed_conditions_are_regenerated(self, mock_anthropic):
+        """変更した条件だけが再生成されるテスト"""
+        mock_client = MagicMock()
+        mock_client.messages.create.side_effect = condition_response
+        mock_anthropic.return_value = mock_client
+
+        generate_per_condition_code(["two apples", "no banana"], "dummy_api_key")
+        generate_per_condition_code(["two apples", "one banana"], "dummy_api_key")
+
+        assert mock_client.messages.create.call_count == 3
+        last_condition = mock_client.messages.create.call_args.kwargs["messages"][0][
+            "content"
+        ][-1]["text"]
+        assert "one banana" in last_condition
+
+    @patch("app.utils.code_generator.anthropic.Anthropic")
+    def test_requests_run_concurrently(self, mock_anthropic):
+        """条件ごとのAPI呼び出しが並列に行われるテスト"""
+        barrier = threading.Barrier(3, timeout=5)
+
+        def wait_for_all(**kwargs):
+            # 3件の呼び出しが同時に行われないとBrokenBarrierErrorになる
+            barrier.wait()
+            return condition_response(**kwargs)
+
+        mock_client = MagicMock()
+        mock_client.messages.create.side_effect = wait_for_all
+        mock_anthropic.return_value = mock_client
+
+        code = generate_per_condition_code(
+            ["a apple", "b apple", "c apple"], "dummy_api_key", max_workers=3
+        )
+
+        assert "check_condition_3" in code
+
+    @patch("app.utils.code_generator.anthropic.Anthropic")
+    def test_cancel_skips_remaining_conditions(self, mock_anthropic):
+        """キャンセルされたら残りの条件のAPI呼び出しを行わないテスト"""
+        cancelled = threading.Event()
+
+        def cancel_after_first(**kwargs):
+            cancelled.set()
+            return condition_response(**kwargs)
+
+        mock_client = MagicMock()
+        mock_client.messages.create.side_effect = cancel_after_first
+        mock_anthropic.return_value = mock_client
+
+        with pytest.raises(ValueError, match="キャンセル"):
+            generate_per_condition_code(
+                ["a apple", "b apple", "c apple"],
+                "dummy_api_key",
+                max_workers=1,
+                should_stop=cancelled.is_set,
+            )
+        assert mock_client.messages.create.call_count == 1
+
+    def test_empty_conditions(self):
+        """有効な条件がない場合のバリデーションテスト"""
+        with pytest.raises(ValueError, match="入力テキストが空です"):
+            generate_per_condition_code(["", "  "], "dummy_api_key")
+
+
+class SlowStream(FakeStream):
+    """チャンクの間に待ち時間を入れるストリーム（打ち切りの確認用）"""
+
+    def __init__(self, chunks, delay):
+        super().__init__(chunks)
+        self.delay = delay
+
+    @property
+    def text_stream(self):
+        for chunk in self.chunks:
+            time.sleep(self.delay)
+            self.consumed += 1
+            yield chunk
+
+
+def stream_client(streams):
+    """呼び出しごとに異なるストリームを返すクライアントのモック"""
+    lock = threading.Lock()
+    remaining = list(streams)
+
+    def next_stream(**kwargs):
+        with lock:
+            return remaining.pop(0)
+
+    client = MagicMock()
+    client.messages.stream.side_effect = next_stream
+    return client
+
+
+VALID_CHUNKS = [
+    "def execute_command(image_path, image):\n",
+    "    image_patch = ImagePatch(image)\n",
+    "    return len(image_patch.find('apple'))\n",
+    "```\n",
+]
+RUNTIME_ERROR_CHUNKS = [
+    "def execute_command(image_path, image):\n",
+    "    return undefined_name\n",
+    "```\n",
+]
+
+
+class TestSpeculativeGeneration:
+    """投機的な複数候補生成のテスト"""
+
+    @patch("app.utils.code_generator.anthropic.Anthropic")
+    def test_returns_first_valid_candidate(self, mock_anthropic):
+        """試験実行に失敗した候補を除き、有効な候補を返すテスト"""
+        mock_anthropic.return_value = stream_client(
+            [FakeStream(RUNTIME_ERROR_CHUNKS), FakeStream(VALID_CHUNKS)]
+        )
+
+        code = generate_speculative_code(
+            "test condition", "dummy_api_key", candidates=2
+        )
+
+        assert "image_patch.find" in code
+
+    @patch("app.utils.code_generator.anthropic.Anthropic")
+    def test_cancels_remaining_candidates(self, mock_anthropic):
+        """有効な候補が得られたら残りのストリームを打ち切るテスト"""
+        slow_chunks = ["# thinking\n"] * 50 + VALID_CHUNKS
+        slow = SlowStream(slow_chunks, delay=0.02)
+        fast = SlowStream(VALID_CHUNKS, delay=0.05)
+        mock_anthropic.return_value = stream_client([fast, slow])
+
+        generate_speculative_code(
+            "test condition",
+            "dummy_api_key",
+            candidates=2,
+            validator=lambda code: None,
+        )
+
+        # 打ち切られた候補は次のチャンクの受信時に終了する
+        for _ in range(100):
+            if slow.closed:
+                break
+            time.sleep(0.02)
+        assert slow.closed
+        assert slow.consumed < len(slow_chunks)
+
+    @patch("app.utils.code_generator.anthropic.Anthropic")
+    def test_all_candidates_invalid(self, mock_anthropic):
+        """すべての候補が無効な場合はValueErrorになるテスト"""
+        mock_anthropic.return_value = stream_client(
+            [FakeStream(RUNTIME_ERROR_CHUNKS), FakeStream(["no function here\n"])]
+        )
+
+        with pytest.raises(ValueError, match="有効なコードが生成されませんでした"):
+            generate_speculative_code("test condition", "dummy_api_key", candidates=2)
+
+    @patch("app.utils.code_generator.anthropic.Anthropic")
+    def test_custom_validator(self, mock_anthropic):
+        """任意の検証関数を使えるテスト"""
+        mock_anthropic.return_value = stream_client([FakeStream(VALID_CHUNKS)])
+        validated = []
+
+        generate_speculative_code(
+            "test condition",
+            "dummy_api_key",
+            candidates=1,
+            validator=validated.append,
+        )
+
+        assert len(validated) == 1
+
+    @patch("app.utils.code_generator.anthropic.Anthropic")
+    def test_stream_cancelled(self, mock_anthropic):
+        """should_stopでストリーミング生成をキャンセルできるテスト"""
+        stream = FakeStream(STREAM_CHUNKS)
+        mock_client = MagicMock()
+        mock_client.messages.stream.return_value = stream
+        mock_anthropic.return_value = mock_client
+
+        with pytest.raises(ValueError, match="キャンセル"):
+            generate_anomaly_detection_code_stream(
+                "test condition",
+                "dummy_api_key",
+                should_stop=lambda: stream.consumed >= 2,
+            )
+        assert stream.consumed == 2
+        assert stream.closed
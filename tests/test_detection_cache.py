@@ -0,0 +1,191 @@
+import multiprocessing
+from unittest.mock import patch
+
+from PIL import Image
+
+from app.utils.code_executor import detect
+from app.utils.detection_cache import (
+    DetectionCache,
+    get_detection_memory,
+    make_detection_key,
+    normalize_query,
+    pack_detections,
+    unpack_detections,
+)
+from app.utils.detector_backend import SyntheticBackend, use_detector_backend
+from app.utils.disk_cache import DiskCache
+from app.utils.image_cache import set_content_hash
+
+
+def _write_entries(directory, worker, count):
+    """別プロセスから同じキャッシュに書き込む"""
+    cache = DiskCache(directory, max_bytes=64 * 1024)
+    for i in range(count):
+        cache.put(f"{worker}-{i}", bytes([worker]) * 1024)
+        cache.get(f"{worker}-{i // 2}")
+
+
+class TestDetectionCacheFormat:
+    """検出結果のキーとバイナリ形式のテスト"""
+
+    def test_normalize_query(self):
+        """クエリの表記揺れが同じキーになることのテスト"""
+        assert normalize_query("Apple") == "apple."
+        assert normalize_query(" red  apple .banana.") == "red apple. banana."
+
+    def test_key_depends_on_query_model_and_threshold(self):
+        """クエリ・モデル・しきい値が違えばキーが変わることのテスト"""
+        base = make_detection_key("img", "apple.", "tiny", 0.3)
+
+        assert base == make_detection_key("img", "Apple", "tiny", 0.3)
+        assert base != make_detection_key("img", "pear.", "tiny", 0.3)
+        assert base != make_detection_key("img", "apple.", "base", 0.3)
+        assert base != make_detection_key("img", "apple.", "tiny", 0.4)
+
+    def test_pack_roundtrip(self):
+        """バイナリ形式への変換と復元のテスト"""
+        boxes = [[10, 20, 30, 40], [1, 2, 3, 4]]
+        scores = [0.81, 0.35]
+        labels = ["apple", "green apple"]
+
+        data = pack_detections(boxes, scores, labels)
+
+        assert unpack_detections(data) == (boxes, scores, labels)
+        assert len(data) < 100
+
+    def test_pack_empty(self):
+        """検出なしの結果も保存できることのテスト"""
+        assert unpack_detections(pack_detections([], [], [])) == ([], [], [])
+
+
+class TestDiskCache:
+    """ディスクキャッシュのテスト"""
+
+    def test_lru_eviction_by_size(self, tmp_path):
+        """合計サイズの上限を超えると最終アクセスが古いものから削除されることのテスト"""
+        cache = DiskCache(str(tmp_path), max_bytes=300)
+        cache.put("a", b"a" * 100)
+        cache.put("b", b"b" * 100)
+        cache.put("c", b"c" * 100)
+        assert cache.get("a") == b"a" * 100  # aを最近使ったことにする
+
+        cache.put("d", b"d" * 100)
+
+        assert cache.get("b") is None
+        assert cache.get("a") is not None
+        stats = cache.stats()
+        assert stats["bytes"] <= 300
+        assert stats["evictions"] == 1
+
+    def test_shared_between_instances(self, tmp_path):
+        """同じディレクトリを使う別のインスタンス間で共有されることのテスト"""
+        DiskCache(str(tmp_path), max_bytes=1000).put("key", b"value")
+
+        other = DiskCache(str(tmp_path), max_bytes=1000)
+        assert other.get("key") == b"value"
+        assert other.stats()["hit_ratio"] == 1.0
+
+    def test_concurrent_writers_from_processes(self, tmp_path):
+        """複数プロセスから同時に書き込んでも壊れず上限が守られることのテスト"""
+        context = multiprocessing.get_context("fork")
+        processes = [
+            context.Process(target=_write_entries, args=(str(tmp_path), worker, 40))
+            for worker in range(4)
+        ]
+        for process in processes:
+            process.start()
+        for process in processes:
+            process.join(timeout=60)
+            assert process.exitcode == 0
+
+        stats = DiskCache(str(tmp_path), max_bytes=64 * 1024).stats()
+        assert 0 < stats["entries"] <= 64
+        assert stats["bytes"] <= 64 * 1024
+
+
+class TestDetectWithCache:
+    """detect()とディスクキャッシュの連携のテスト"""
+
+    def test_second_detect_skips_model(self, tmp_path):
+        """2回目の検出ではモデルを使わずにキャッシュから結果を返すことのテスト"""
+        cache = DetectionCache(str(tmp_path))
+        image = Image.new("RGB", (200, 100))
+        set_content_hash(image, "hash")
+        raw = ([[10, 10, 50, 50]], [0.8], ["apple"])
+
+        with (
+            use_detector_backend(SyntheticBackend()),
+            patch("app.utils.code_executor.get_detection_cache", return_value=cache),
+            patch("app.utils.code_executor.detect_raw", return_value=raw) as mock_raw,
+        ):
+            first = detect(image, "apple")
+            # メモリキャッシュがない別プロセス相当でもディスクから取得できる
+            get_detection_memory().clear()
+            second = detect(image, "Apple.")
+
+        assert mock_raw.call_count == 1
+        assert [p.box for p in first] == [p.box for p in second] == [[10, 10, 50, 50]]
+        assert cache.stats()["hits"] == 1
+
+    def test_memory_cache_without_disk(self):
+        """ディスクキャッシュが無効でもプロセス内では検出結果を再利用するテスト"""
+        image = Image.new("RGB", (200, 100))
+        set_content_hash(image, "hash")
+        raw = ([[10, 10, 50, 50]], [0.8], ["apple"])
+
+        with (
+            use_detector_backend(SyntheticBackend()),
+            patch("app.utils.code_executor.get_detection_cache", return_value=None),
+            patch("app.utils.code_executor.detect_raw", return_value=raw) as mock_raw,
+        ):
+            first = detect(image, "apple")
+            second = detect(image, "apple")
+
+        assert mock_raw.call_count == 1
+        assert [p.box for p in first] == [p.box for p in second]
+        assert get_detection_memory().stats()["hits"] == 1
+
+    def test_crops_are_not_cached_under_parent_hash(self, tmp_path):
+        """同じサイズの別の切り出し画像に親画像の検出結果を使わないことのテスト"""
+        cache = DetectionCache(str(tmp_path))
+        image = Image.new("RGB", (200, 100))
+        set_content_hash(image, "hash")
+        left = image.crop((0, 0, 100, 100))
+        right = image.crop((100, 0, 200, 100))
+        raws = [
+            ([[10, 10, 50, 50]], [0.8], ["apple"]),
+            ([[60, 60, 90, 90]], [0.8], ["apple"]),
+        ]
+
+        with (
+            use_detector_backend(SyntheticBackend()),
+            patch("app.utils.code_executor.get_detection_cache", return_value=cache),
+            patch("app.utils.code_executor.detect_raw", side_effect=raws) as mock_raw,
+        ):
+            left_patches = detect(left, "apple")
+            right_patches = detect(right, "apple")
+
+        assert mock_raw.call_count == 2
+        assert [p.box for p in left_patches] == [[10, 10, 50, 50]]
+        assert [p.box for p in right_patches] == [[60, 60, 90, 90]]
+        assert cache.stats()["entries"] == 0
+
+    def test_key_uses_model_id_after_load(self):
+        """読み込み後に確定したモデルIDでキャッシュキーを作ることのテスト"""
+
+        class FallbackBackend(SyntheticBackend):
+            def load(self):
+                super().load()
+                self.model_id = "fallback-model"
+
+        image = Image.new("RGB", (200, 100))
+        set_content_hash(image, "hash")
+        backend = FallbackBackend(script={"apple": [([10, 10, 50, 50], 0.8)]})
+
+        with use_detector_backend(backend):
+            detect(image, "apple")
+
+        key = make_detection_key(
+            "hash", "apple.", "fallback-model", 0.3, image_size=(200, 100), tiled=False
+        )
+        assert get_detection_memory().get(key) is not None
@@ -0,0 +1,126 @@
+import threading
+from unittest.mock import patch
+
+from app.utils.admission import MB, AdmissionController
+from app.utils.code_executor import execute_function_from_code, load_image
+from app.utils.detection_warmup import (
+    candidate_queries,
+    extract_object_names,
+    singularize,
+    warm_detection,
+)
+from app.utils.detector_backend import SyntheticBackend, use_detector_backend
+
+
+class TestCandidateQueries:
+    """条件からの検出クエリの推測のテスト"""
+
+    def test_singularize(self):
+        """テンプレートの例と同じ単数形にそろえるテスト"""
+        assert singularize("apples") == "apple"
+        assert singularize("push bottles") == "push bottle"
+        assert singularize("strawberries") == "strawberry"
+        assert singularize("boxes") == "box"
+        assert singularize("glass") == "glass"
+        assert singularize("リンゴ") == "リンゴ"
+
+    def test_extract_object_names(self):
+        """[ ] で囲まれた物体名を行ごとに抽出するテスト"""
+        conditions = (
+            "- There are two [Apples] on the left side.\n"
+            "- 条件なしの行\n"
+            "- There are 2 [apple]s and 3 [watermelon]s."
+        )
+        assert extract_object_names(conditions) == [
+            ["apple"],
+            ["apple", "watermelon"],
+        ]
+
+    def test_combined_query_first(self):
+        """複数の物体を含む条件はまとめたクエリを優先するテスト"""
+        conditions = "- There are two [push bottles] to the left of the [foaming net]."
+        assert candidate_queries(conditions) == [
+            "push bottle. foaming net",
+            "push bottle",
+            "foaming net",
+        ]
+
+    def test_deduplicate_and_limit(self):
+        """重複を除き、上限までのクエリを返すテスト"""
+        conditions = "- [apple] が2つ\n- [apple] が左\n- [a] [b] [c] [d]"
+        queries = candidate_queries(conditions, max_queries=3)
+        assert queries == ["apple", "a", "b"]
+
+    def test_no_brackets(self):
+        """[ ] がない条件からはクエリを推測しないテスト"""
+        assert candidate_queries("- 画像に2つのリンゴがあること") == []
+
+
+class TestWarmDetection:
+    """ウォームアップと実行時の検出の連携のテスト"""
+
+    def test_first_find_hits_warm_cache(self, sample_image_path):
+        """ウォームアップした検出を実行時のfind()がモデルなしで使うテスト"""
+        backend = SyntheticBackend(
+            {"apple": [([1, 1, 5, 5], 0.9), ([6, 6, 9, 9], 0.8)]}
+        )
+        code = (
+            "def execute_command(image_path, image):\n"
+            "    image_patch = ImagePatch(image)\n"
+            "    return 0 if len(image_patch.find('apple')) == 2 else 1\n"
+        )
+
+        with use_detector_backend(backend):
+            summary = warm_detection(
+                "- There are two [apples] in the image.", sample_image_path, 0.3
+            )
+            image = load_image(sample_image_path)
+            score, _ = execute_function_from_code(
+                code, "execute_command", sample_image_path, image, 0.3
+            )
+
+        assert summary["queries"] == ["apple"]
+        assert score == 0
+        assert backend.calls == [("apple.", 1)]
+
+    def test_should_stop(self, sample_image_path):
+        """中断が要求されたら残りのクエリを検出しないテスト"""
+        backend = SyntheticBackend()
+        with use_detector_backend(backend):
+            summary = warm_detection(
+                "- [apple] and [banana]", sample_image_path, should_stop=lambda: True
+            )
+
+        assert summary["queries"] == []
+        assert backend.loaded
+        assert backend.calls == []
+
+    def test_skips_when_executions_wait(self, sample_image_path):
+        """予算を待っている実行がある場合はウォームアップを行わないテスト"""
+        controller = AdmissionController(
+            budget_bytes=MB, model_bytes=lambda: 0, timeout=5, poll_interval=0.01
+        )
+        backend = SyntheticBackend()
+        waiting = threading.Event()
+
+        def waiting_execution():
+            with controller.admit(MB, on_wait=lambda position: waiting.set()):
+                pass
+
+        with (
+            use_detector_backend(backend),
+            patch(
+                "app.utils.detection_warmup.get_admission_controller",
+                return_value=controller,
+            ),
+            controller.admit(MB),
+        ):
+            thread = threading.Thread(target=waiting_execution)
+            thread.start()
+            assert waiting.wait(5)
+            summary = warm_detection("- [apple]", sample_image_path)
+        thread.join(5)
+
+        assert summary["skipped"]
+        assert not backend.loaded
+        assert controller.stats()["admitted"] == 2
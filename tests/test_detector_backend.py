@@ -0,0 +1,200 @@
+import time
+from unittest.mock import patch
+
+import numpy as np
+import pytest
+import torch
+from PIL import Image
+from transformers import BatchFeature
+
+from app.utils.code_executor import (
+    detect,
+    detect_raw,
+    execute_code,
+    get_active_model_id,
+)
+from app.utils.detector_backend import (
+    GroundingDinoBackend,
+    SyntheticBackend,
+    create_backend,
+    split_query,
+    use_detector_backend,
+)
+from app.utils.image_cache import set_content_hash
+
+CODE = """
+def execute_command(image_path, image):
+    image_patch = ImagePatch(image)
+    patches = image_patch.find("apple. banana")
+    return 0 if len(patches["apple"]) == 2 and len(patches["banana"]) == 0 else 1
+"""
+
+
+class _MeanPixelProcessor:
+    """画像の平均画素値をscoreとして画像全体のboxを1つ返すプロセッサ"""
+
+    def image_processor(self, images, return_tensors):
+        pixel_values = torch.stack(
+            [torch.from_numpy(np.asarray(image, dtype=np.float32)) for image in images]
+        )
+        return BatchFeature(data={"pixel_values": pixel_values})
+
+    def tokenizer(self, texts, padding, return_tensors):
+        return BatchFeature(data={"input_ids": torch.zeros((len(texts), 1))})
+
+    def post_process_grounded_object_detection(self, outputs, input_ids, **kwargs):
+        return [
+            {
+                "scores": pixel_values.mean().reshape(1) / 255,
+                "labels": ["object"],
+                "boxes": torch.tensor([[0.0, 0.0, 10.0, 10.0]]),
+            }
+            for pixel_values in outputs
+        ]
+
+
+class TestSyntheticBackend:
+    """合成の検出器のテスト"""
+
+    def test_scripted_detections(self):
+        """指定した検出結果をしきい値で絞り込んで返すテスト"""
+        backend = SyntheticBackend(
+            {"Apple": [([1, 2, 3, 4], 0.9), ([5, 6, 7, 8], 0.2)]}
+        )
+        image = Image.new("RGB", (100, 100))
+
+        assert backend.detect(image, "apple.", 0.3) == (
+            [[1, 2, 3, 4]],
+            [0.9],
+            ["apple"],
+        )
+        assert backend.calls == [("apple.", 1)]
+
+    def test_multi_object_query(self):
+        """複数の物体名のクエリでは物体名をラベルにして結果をまとめるテスト"""
+        backend = SyntheticBackend(
+            {"apple": [([1, 1, 2, 2], 0.9)], "push bottle": [([3, 3, 4, 4], 0.8)]}
+        )
+        _, _, labels = backend.detect(
+            Image.new("RGB", (10, 10)), "apple. push bottle.", 0.3
+        )
+        assert labels == ["apple", "push bottle"]
+
+    def test_unscripted_is_deterministic(self):
+        """指定のない物体名にも同じ入力には同じboxを返すテスト"""
+        image = Image.new("RGB", (640, 480))
+        first = SyntheticBackend(boxes_per_object=5).detect(image, "kid.", 0.0)
+        second = SyntheticBackend(boxes_per_object=5).detect(image, "kid.", 0.0)
+        other_seed = SyntheticBackend(boxes_per_object=5, seed=1).detect(
+            image, "kid.", 0.0
+        )
+
+        assert first == second
+        assert first != other_seed
+        assert len(first[0]) == 5
+        for x0, y0, x1, y1 in first[0]:
+            assert 0 <= x0 < x1 <= 640
+            assert 0 <= y0 < y1 <= 480
+
+    def test_latency_and_footprint(self):
+        """設定した遅延で推論し、ロード後のメモリ量を返すテスト"""
+        backend = SyntheticBackend(
+            latency=0.05, per_image_latency=0.01, footprint_bytes=1024
+        )
+        assert backend.memory_footprint() == 0
+
+        start = time.perf_counter()
+        results = backend.detect_batch([Image.new("RGB", (10, 10))] * 3, "a.", 0.3)
+        elapsed = time.perf_counter() - start
+
+        assert len(results) == 3
+        assert elapsed >= 0.08
+        assert backend.memory_footprint() == 1024
+
+    def test_split_query(self):
+        """クエリを物体名のリストに分けるテスト"""
+        assert split_query("Apple. push  bottle .") == ["apple", "push  bottle"]
+
+    def test_create_backend(self):
+        """名前に対応するバックエンドを作成するテスト"""
+        assert isinstance(create_backend("synthetic"), SyntheticBackend)
+        assert isinstance(create_backend("grounding-dino"), GroundingDinoBackend)
+        with pytest.raises(ValueError):
+            create_backend("unknown")
+
+
+class TestBackendIntegration:
+    """detect()・execute_codeとバックエンドの連携のテスト"""
+
+    def test_execute_code_offline(self, sample_image_path):
+        """合成の検出器でモデルなしにプログラムを実行できるテスト"""
+        backend = SyntheticBackend(
+            {"apple": [([10, 10, 30, 30], 0.9), ([50, 50, 80, 80], 0.8)], "banana": []}
+        )
+        with use_detector_backend(backend):
+            result = execute_code(CODE, sample_image_path, use_cache=False)
+
+        assert result["status"] == "success"
+        assert backend.calls == [("apple. banana.", 1)]
+
+    def test_model_id_separates_caches(self):
+        """バックエンドのモデルIDがキャッシュキーに使われるテスト"""
+        with use_detector_backend(SyntheticBackend(model_id="fake-v1")):
+            assert get_active_model_id() == "fake-v1"
+        assert get_active_model_id() != "fake-v1"
+
+    def test_tiled_detection(self):
+        """タイル推論でもバックエンドのdetect_batchを使い座標を戻すテスト"""
+        backend = SyntheticBackend({"apple": [([10, 10, 60, 60], 0.9)]})
+        image = Image.new("RGB", (2000, 1000))
+        with use_detector_backend(backend):
+            boxes, _, _ = detect_raw(image, "apple.", 0.3, tiled=True)
+
+        assert [10, 10, 60, 60] in boxes
+        assert all(count <= 4 for _, count in backend.calls)
+        assert sum(count for _, count in backend.calls) == len(boxes)
+
+    def test_detect_patches(self):
+        """detect()がバックエンドの結果からImagePatchを作るテスト"""
+        image = Image.new("RGB", (100, 100))
+        with use_detector_backend(SyntheticBackend({"apple": [([1, 2, 30, 40], 0.9)]})):
+            patches = detect(image, "apple")
+        assert [patch.box for patch in patches] == [[1, 2, 30, 40]]
+
+
+class TestGroundingDinoBackend:
+    """Grounding DINOのバックエンドのテスト"""
+
+    def test_memory_footprint(self):
+        """読み込んだモデルのパラメータとバッファのバイト数を返すテスト"""
+        model = torch.nn.BatchNorm1d(4)  # weight, bias + running_mean, running_var
+        with patch("app.utils.code_executor._cached_model", model):
+            footprint = GroundingDinoBackend().memory_footprint()
+        assert footprint == 4 * 4 * 4 + 8  # float32 x4 + num_batches_tracked(int64)
+
+    def test_not_loaded(self):
+        """未読み込みの場合は0を返すテスト"""
+        with patch("app.utils.code_executor._cached_model", None):
+            assert GroundingDinoBackend().memory_footprint() == 0
+
+    def test_crops_do_not_reuse_parent_pixel_inputs(self):
+        """読み込んだ画像から切り出した同じサイズの別の領域は別の入力で推論するテスト"""
+        image = Image.new("RGB", (20, 10), (0, 0, 0))
+        image.paste((255, 255, 255), (10, 0, 20, 10))
+        set_content_hash(image, "hash")
+        left = image.crop((0, 0, 10, 10))
+        right = image.crop((10, 0, 20, 10))
+
+        def model(pixel_values, input_ids):
+            return pixel_values
+
+        backend = GroundingDinoBackend()
+        with patch(
+            "app.utils.code_executor.get_cached_model",
+            return_value=(_MeanPixelProcessor(), model),
+        ):
+            _, left_scores, _ = backend.detect(left, "object.", 0.0)
+            _, right_scores, _ = backend.detect(right, "object.", 0.0)
+
+        assert left_scores == [0.0]
+        assert right_scores == [1.0]
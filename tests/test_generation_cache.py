@@ -0,0 +1,153 @@
+from unittest.mock import MagicMock, patch
+
+import pytest
+
+from app.utils.code_generator import (
+    combine_conditions,
+    generate_anomaly_detection_code,
+    generate_anomaly_detection_code_stream,
+)
+from app.utils.generation_cache import (
+    GenerationCache,
+    make_generation_key,
+    normalize_conditions,
+)
+
+GENERATED_CODE = """
+def execute_command(image_path, image):
+    image_patch = ImagePatch(image)
+    return 0
+"""
+
+
+def make_client(text=GENERATED_CODE):
+    """messages.createが決まったテキストを返すクライアントのモック"""
+    client = MagicMock()
+    response = MagicMock()
+    response.content = [MagicMock()]
+    response.content[0].text = text
+    client.messages.create.return_value = response
+    return client
+
+
+class TestNormalizeConditions:
+    """条件の正規化のテスト"""
+
+    def test_bullets_whitespace_and_order(self):
+        """箇条書き・空白・順序の違いを同じ条件として扱うテスト"""
+        a = "- 画像に2つのリンゴがあること\n- no  bananas"
+        b = "・no bananas\n\n* 画像に2つのリンゴがあること  "
+        assert normalize_conditions(a) == normalize_conditions(b)
+
+    def test_nfkc_and_duplicates(self):
+        """全角・半角の揺れと重複を吸収するテスト"""
+        assert normalize_conditions("- 画像に２つのリンゴ\n- 画像に2つのリンゴ") == [
+            "画像に2つのリンゴ"
+        ]
+
+    def test_numbers_are_not_bullets(self):
+        """数値で始まる条件を箇条書き記号として削らないテスト"""
+        assert normalize_conditions("1. 3.5cm以上の傷がないこと") == [
+            "3.5cm以上の傷がないこと"
+        ]
+
+    def test_combine_conditions_matches_key(self):
+        """combine_conditionsの出力と手入力の揺れが同じキーになるテスト"""
+        combined = combine_conditions([" リンゴが2つ ", "", "バナナがない"])
+        assert combined == "- リンゴが2つ\n- バナナがない"
+        assert make_generation_key(combined, "m", "v") == make_generation_key(
+            "バナナがない\nリンゴが2つ", "m", "v"
+        )
+
+    def test_key_depends_on_model_and_prompt(self):
+        """モデルやプロンプトが変わるとキーも変わるテスト"""
+        key = make_generation_key("リンゴが2つ", "model-a", "v1")
+        assert key != make_generation_key("リンゴが2つ", "model-b", "v1")
+        assert key != make_generation_key("リンゴが2つ", "model-a", "v2")
+
+
+class TestGenerationCache:
+    """生成キャッシュのテスト"""
+
+    def test_put_and_get(self, tmp_path):
+        """保存したコードを取得できるテスト"""
+        cache = GenerationCache(str(tmp_path))
+        assert cache.get("key") is None
+        cache.put("key", GENERATED_CODE)
+        assert cache.get("key") == GENERATED_CODE
+
+    def test_persists_across_instances(self, tmp_path):
+        """別のインスタンス（別プロセス相当）からも参照できるテスト"""
+        GenerationCache(str(tmp_path)).put("key", GENERATED_CODE)
+        assert GenerationCache(str(tmp_path)).get("key") == GENERATED_CODE
+
+    def test_eviction(self, tmp_path):
+        """上限を超えると古いエントリが削除されるテスト"""
+        cache = GenerationCache(str(tmp_path), max_bytes=300)
+        for i in range(5):
+            cache.put(f"key{i}", "x" * 100)
+        stats = cache.stats()
+        assert stats["bytes"] <= 300
+        assert stats["evictions"] > 0
+        assert cache.get("key4") is not None
+
+    @patch("app.utils.code_generator.anthropic.Anthropic")
+    def test_generation_hit_skips_api(self, mock_anthropic):
+        """同じ条件の2回目の生成でAPIを呼ばないテスト"""
+        client = make_client()
+        mock_anthropic.return_value = client
+
+        first = generate_anomaly_detection_code("- リンゴが2つ", "dummy_api_key")
+        second, usage = generate_anomaly_detection_code(
+            "リンゴが2つ", "dummy_api_key", return_usage=True
+        )
+
+        assert first == second
+        assert usage["output_tokens"] == 0
+        client.messages.create.assert_called_once()
+
+    @patch("app.utils.code_generator.anthropic.Anthropic")
+    def test_regenerate_bypasses_cache(self, mock_anthropic):
+        """use_cache=Falseで再生成し、結果でキャッシュを更新するテスト"""
+        client = make_client()
+        mock_anthropic.return_value = client
+        generate_anomaly_detection_code("リンゴが2つ", "dummy_api_key")
+
+        new_code = GENERATED_CODE.replace("return 0", "return 1")
+        client.messages.create.return_value.content[0].text = new_code
+        regenerated = generate_anomaly_detection_code(
+            "リンゴが2つ", "dummy_api_key", use_cache=False
+        )
+
+        assert "return 1" in regenerated
+        assert client.messages.create.call_count == 2
+        assert "return 1" in generate_anomaly_detection_code(
+            "リンゴが2つ", "dummy_api_key"
+        )
+        assert client.messages.create.call_count == 2
+
+    @patch("app.utils.code_generator.anthropic.Anthropic")
+    def test_invalid_code_is_not_cached(self, mock_anthropic):
+        """検証に失敗したコードは保存しないテスト"""
+        client = make_client("invalid code without function")
+        mock_anthropic.return_value = client
+
+        for _ in range(2):
+            with pytest.raises(ValueError):
+                generate_anomaly_detection_code("リンゴが2つ", "dummy_api_key")
+        assert client.messages.create.call_count == 2
+
+    @patch("app.utils.code_generator.anthropic.Anthropic")
+    def test_stream_hit_reports_code(self, mock_anthropic):
+        """ストリーミング生成でもキャッシュのコードをon_textに渡すテスト"""
+        client = make_client()
+        mock_anthropic.return_value = client
+        generate_anomaly_detection_code("リンゴが2つ", "dummy_api_key")
+        received = []
+
+        result = generate_anomaly_detection_code_stream(
+            "リンゴが2つ", "dummy_api_key", on_text=received.append
+        )
+
+        assert received == [result]
+        client.messages.stream.assert_not_called()
@@ -0,0 +1,146 @@
+import numpy as np
+import torch
+from PIL import Image
+
+from app.utils.cache import BoundedCache
+from app.utils.image_cache import (
+    DecodedImageCache,
+    file_content_hash,
+    get_content_hash,
+    get_original_size,
+    set_original_size,
+)
+
+
+def _decode(path, max_side):
+    image = Image.open(path).convert("RGB")
+    set_original_size(image, image.size)
+    return image
+
+
+class TestBoundedCache:
+    """サイズ上限付きLRUキャッシュのテスト"""
+
+    def test_evicts_least_recently_used_by_bytes(self):
+        """バイト数の上限を超えると最も古く使われたエントリが削除されることのテスト"""
+        cache = BoundedCache(max_bytes=100)
+        cache.put("a", "A", size=40)
+        cache.put("b", "B", size=40)
+        assert cache.get("a") == "A"  # aを最近使ったことにする
+
+        cache.put("c", "C", size=40)
+
+        assert "b" not in cache
+        assert cache.get("a") == "A"
+        assert cache.get("c") == "C"
+        assert cache.total_bytes == 80
+        assert cache.stats()["evictions"] == 1
+
+    def test_rejects_oversized_value(self):
+        """単体で上限を超える値は保存されないことのテスト"""
+        cache = BoundedCache(max_bytes=10)
+        assert cache.put("big", "x", size=11) is False
+        assert len(cache) == 0
+
+    def test_max_entries_and_stats(self):
+        """エントリ数の上限とヒット率の統計のテスト"""
+        cache = BoundedCache(max_bytes=1000, max_entries=2)
+        for key in ["a", "b", "c"]:
+            cache.put(key, key, size=1)
+        assert cache.keys() == ["b", "c"]
+
+        cache.get("b")
+        cache.get("missing")
+        stats = cache.stats()
+        assert stats["hits"] == 1
+        assert stats["misses"] == 1
+        assert stats["hit_ratio"] == 0.5
+
+
+class TestDecodedImageCache:
+    """デコード済み画像キャッシュのテスト"""
+
+    def test_same_content_is_decoded_once(self, tmp_path):
+        """内容が同じファイルは別のパスでも1回だけデコードされることのテスト"""
+        array = np.random.randint(0, 255, (50, 80, 3), dtype=np.uint8)
+        path_a = tmp_path / "a.png"
+        path_b = tmp_path / "b.png"
+        Image.fromarray(array).save(path_a)
+        Image.fromarray(array).save(path_b)
+        calls = []
+
+        def counting_decode(path, max_side):
+            calls.append(path)
+            return _decode(path, max_side)
+
+        cache = DecodedImageCache()
+        first = cache.get_image(str(path_a), 1333, counting_decode)
+        second = cache.get_image(str(path_b), 1333, counting_decode)
+
+        assert len(calls) == 1
+        assert np.array_equal(np.asarray(first), np.asarray(second))
+        assert get_content_hash(first) == file_content_hash(str(path_a))
+        assert get_original_size(first) == (80, 50)
+
+    def test_derived_images_have_no_content_hash(self, tmp_path):
+        """切り出し・縮小・コピーした画像は読み込んだ画像のハッシュを持たないことのテスト"""
+        path = tmp_path / "a.png"
+        Image.new("RGB", (20, 10)).save(path)
+        image = DecodedImageCache().get_image(str(path), None, _decode)
+
+        assert get_content_hash(image) is not None
+        assert get_content_hash(image.crop((0, 0, 10, 10))) is None
+        assert get_content_hash(image.resize((10, 5))) is None
+        assert get_content_hash(image.copy()) is None
+
+    def test_returned_image_does_not_share_cache_state(self, tmp_path):
+        """返された画像を変更してもキャッシュの内容が変わらないことのテスト"""
+        path = tmp_path / "a.png"
+        Image.new("RGB", (10, 10), (0, 0, 0)).save(path)
+        cache = DecodedImageCache()
+
+        image = cache.get_image(str(path), None, _decode)
+        image.paste((255, 255, 255), (0, 0, 10, 10))
+
+        again = cache.get_image(str(path), None, _decode)
+        assert again.getpixel((0, 0)) == (0, 0, 0)
+
+    def test_preview_is_thumbnail(self, sample_image_path):
+        """プレビューが最大辺以下のサムネイルになることのテスト"""
+        cache = DecodedImageCache()
+
+        preview = cache.get_preview(sample_image_path, max_side=64)
+
+        assert max(preview.size) <= 64
+        assert cache.get_preview(sample_image_path, max_side=64) is preview
+
+    def test_pixel_inputs_are_cached_per_model(self):
+        """pixel tensorがモデルIDごとにキャッシュされることのテスト"""
+        cache = DecodedImageCache()
+        calls = []
+
+        def compute():
+            calls.append(1)
+            return {"pixel_values": torch.zeros(1, 3, 8, 8)}
+
+        cache.get_pixel_inputs("hash", (8, 8), "model-a", compute)
+        cache.get_pixel_inputs("hash", (8, 8), "model-a", compute)
+        cache.get_pixel_inputs("hash", (8, 8), "model-b", compute)
+
+        assert len(calls) == 2
+        assert cache.pixels.total_bytes == 2 * 3 * 8 * 8 * 4
+
+    def test_byte_limit_evicts_images(self, tmp_path):
+        """バイト数の上限を超えると古い画像が削除されることのテスト"""
+        cache = DecodedImageCache(max_bytes=20 * 20 * 3)
+        paths = []
+        for i in range(2):
+            path = tmp_path / f"{i}.png"
+            Image.new("RGB", (20, 20), (i, i, i)).save(path)
+            paths.append(str(path))
+
+        cache.get_image(paths[0], None, _decode)
+        cache.get_image(paths[1], None, _decode)
+
+        assert len(cache.images) == 1
+        assert cache.images.stats()["evictions"] == 1
@@ -0,0 +1,228 @@
+import threading
+import time
+from unittest.mock import patch
+
+import pytest
+from fastapi.testclient import TestClient
+
+from app.utils.detector_backend import SyntheticBackend, use_detector_backend
+from app.utils.inspection_api import (
+    InspectionQueue,
+    QueueFullError,
+    create_app,
+    program_id_for,
+)
+
+CODE = """
+def execute_command(image_path, image):
+    image_patch = ImagePatch(image)
+    apple_patches = image_patch.find("apple")
+    return 0 if len(apple_patches) == 2 else 1
+"""
+
+TOKEN = "test-token"
+AUTH = {"Authorization": f"Bearer {TOKEN}"}
+
+# 検出モデルの代わりに決まった結果を返すスタブ
+TWO_APPLES = ([[1, 1, 20, 20], [30, 30, 50, 50]], [0.9, 0.8], ["apple", "apple"])
+
+
+@pytest.fixture
+def stub_detector():
+    """detect_rawをスタブにしてモデルを使わずに実行する"""
+    with (
+        use_detector_backend(SyntheticBackend()),
+        patch("app.utils.code_executor.detect_raw", return_value=TWO_APPLES) as stub,
+    ):
+        yield stub
+
+
+@pytest.fixture
+def client():
+    return TestClient(create_app(token=TOKEN), headers=AUTH)
+
+
+def image_file(path, name="sample.png"):
+    with open(path, "rb") as f:
+        return (name, f.read(), "image/png")
+
+
+def register(client, code=CODE):
+    response = client.post("/programs", json={"code": code})
+    assert response.status_code == 201
+    return response.json()["program_id"]
+
+
+class TestInspectionQueue:
+    """同時実行数と待ち行列の上限のテスト"""
+
+    def test_rejects_when_full(self):
+        """実行中と待機中の合計が上限に達すると拒否するテスト"""
+        queue = InspectionQueue(max_concurrency=1, max_queue=0)
+        with queue.slot():
+            assert queue.stats()["running"] == 1
+            with pytest.raises(QueueFullError), queue.slot():
+                pass
+        assert queue.stats() == {"running": 0, "waiting": 0, "rejected": 1}
+
+    def test_waits_for_slot(self):
+        """空きがなければ待ち行列で待ってから実行するテスト"""
+        queue = InspectionQueue(max_concurrency=1, max_queue=1)
+        order = []
+        release = threading.Event()
+
+        def first():
+            with queue.slot():
+                order.append("first")
+                release.wait(5)
+
+        def second():
+            with queue.slot():
+                order.append("second")
+
+        threads = [threading.Thread(target=first), threading.Thread(target=second)]
+        threads[0].start()
+        while queue.stats()["running"] == 0:
+            time.sleep(0.01)
+        threads[1].start()
+        while queue.stats()["waiting"] == 0:
+            time.sleep(0.01)
+        release.set()
+        for thread in threads:
+            thread.join(5)
+
+        assert order == ["first", "second"]
+
+
+class TestInspectionAPI:
+    """検査APIのテスト"""
+
+    def test_register_program(self, client):
+        """プログラムを登録して取得できるテスト"""
+        program_id = register(client)
+        assert program_id == program_id_for(CODE)
+        response = client.get(f"/programs/{program_id}")
+        assert response.json()["code"] == CODE
+
+    def test_register_invalid_program(self, client):
+        """試験実行できないプログラムは400を返すテスト"""
+        response = client.post("/programs", json={"code": "def broken("})
+        assert response.status_code == 400
+
+    def test_inspect_single(self, client, stub_detector, sample_image_path):
+        """画像1枚の検査でexecute_codeと同じ形式の結果を返すテスト"""
+        program_id = register(client)
+        response = client.post(
+            f"/programs/{program_id}/inspect",
+            files={"image": image_file(sample_image_path)},
+            data={"box_threshold": "0.4"},
+        )
+
+        assert response.status_code == 200
+        result = response.json()
+        assert result["status"] == "success"
+        assert result["score"] == 0
+        assert result["filename"] == "sample.png"
+        assert "timings" in result
+        assert stub_detector.call_args.args[2] == 0.4
+
+    def test_inspect_batch(self, client, stub_detector, sample_image_path):
+        """複数の画像を送った順に検査するテスト"""
+        program_id = register(client)
+        response = client.post(
+            f"/programs/{program_id}/inspect/batch",
+            files=[
+                ("images", image_file(sample_image_path, "a.png")),
+                ("images", image_file(sample_image_path, "b.png")),
+            ],
+        )
+
+        assert response.status_code == 200
+        results = response.json()["results"]
+        assert [r["filename"] for r in results] == ["a.png", "b.png"]
+        assert all(r["status"] == "success" for r in results)
+
+    def test_unknown_program(self, client, sample_image_path):
+        """登録されていないプログラムは404を返すテスト"""
+        response = client.post(
+            "/programs/unknown/inspect",
+            files={"image": image_file(sample_image_path)},
+        )
+        assert response.status_code == 404
+
+    def test_unsupported_file(self, client):
+        """対応していない形式のファイルは415を返すテスト"""
+        program_id = register(client)
+        response = client.post(
+            f"/programs/{program_id}/inspect",
+            files={"image": ("notes.txt", b"text", "text/plain")},
+        )
+        assert response.status_code == 415
+
+    def test_delete_program(self, client):
+        """削除したプログラムは使えなくなるテスト"""
+        program_id = register(client)
+        assert client.delete(f"/programs/{program_id}").status_code == 204
+        assert client.get(f"/programs/{program_id}").status_code == 404
+
+    def test_queue_full_returns_503(self, sample_image_path):
+        """待ち行列が満杯の場合は503を返すテスト"""
+        app = create_app(max_concurrency=1, max_queue=0, token=TOKEN)
+        client = TestClient(app, headers=AUTH)
+        program_id = register(client)
+        started = threading.Event()
+        release = threading.Event()
+
+        def slow_execute(*args, **kwargs):
+            started.set()
+            release.wait(5)
+            return {"status": "success", "score": 0}
+
+        responses = []
+        with patch("app.utils.inspection_api.execute_code", side_effect=slow_execute):
+            thread = threading.Thread(
+                target=lambda: responses.append(
+                    client.post(
+                        f"/programs/{program_id}/inspect",
+                        files={"image": image_file(sample_image_path)},
+                    )
+                )
+            )
+            thread.start()
+            assert started.wait(5)
+            rejected = client.post(
+                f"/programs/{program_id}/inspect",
+                files={"image": image_file(sample_image_path)},
+            )
+            release.set()
+            thread.join(5)
+
+        assert rejected.status_code == 503
+        assert rejected.headers["Retry-After"] == "1"
+        assert responses[0].status_code == 200
+        assert app.state.queue.stats()["rejected"] == 1
+
+    def test_requires_token(self, sample_image_path):
+        """トークンのない・誤った要求はプログラムの登録・実行を拒否するテスト"""
+        client = TestClient(create_app(token=TOKEN))
+        assert client.post("/programs", json={"code": CODE}).status_code == 401
+        wrong = {"Authorization": "Bearer wrong"}
+        response = client.post("/programs", json={"code": CODE}, headers=wrong)
+        assert response.status_code == 401
+        response = client.post(
+            f"/programs/{program_id_for(CODE)}/inspect",
+            files={"image": image_file(sample_image_path)},
+        )
+        assert response.status_code == 401
+        assert client.get("/health").status_code == 200
+
+    def test_rejects_all_without_configured_token(self):
+        """API_TOKENが未設定の場合はどのトークンでも拒否するテスト"""
+        client = TestClient(create_app(token=""), headers={"Authorization": "Bearer "})
+        assert client.post("/programs", json={"code": CODE}).status_code == 401
+
+    def test_metrics(self, client):
+        """/metrics でメトリクスを返すテスト"""
+        response = client.get("/metrics")
+        assert response.status_code == 200
+        assert "ad_executions_total" in response.text
@@ -0,0 +1,154 @@
+import threading
+import time
+
+import pytest
+
+from app.utils.job_manager import CANCELLED, DONE, FAILED, PENDING, JobManager
+
+
+def wait_until_done(job, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not job.done and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert job.done
+
+
+@pytest.fixture
+def manager():
+    manager = JobManager(max_workers=2)
+    yield manager
+    manager.shutdown()
+
+
+class TestJobManager:
+    """バックグラウンドジョブのテスト"""
+
+    def test_submit_returns_immediately(self, manager):
+        """処理の完了を待たずに登録でき、結果を取得できるテスト"""
+        release = threading.Event()
+
+        def work(job, value):
+            release.wait(5)
+            return value * 2
+
+        job = manager.submit("session-a", "execute", work, 21)
+        assert not job.done
+
+        release.set()
+        wait_until_done(job)
+        assert job.status == DONE
+        assert job.result == 42
+        assert job.elapsed() > 0
+
+    def test_failure_keeps_error(self, manager):
+        """例外が発生したジョブは失敗として例外を保持するテスト"""
+
+        def work(job):
+            raise ValueError("入力エラー")
+
+        job = manager.submit("session-a", "generate", work)
+        wait_until_done(job)
+        assert job.status == FAILED
+        assert isinstance(job.error, ValueError)
+
+    def test_cancel_running_job(self, manager):
+        """実行中のジョブがキャンセル要求を受けて中断するテスト"""
+        started = threading.Event()
+
+        def work(job):
+            started.set()
+            while not job.cancelled():
+                job.set_progress("生成中")
+                time.sleep(0.01)
+            raise ValueError("キャンセルされました")
+
+        job = manager.submit("session-a", "generate", work)
+        started.wait(5)
+        assert job.progress == "生成中"
+        assert manager.cancel(job.id)
+        wait_until_done(job)
+        assert job.status == CANCELLED
+        assert not manager.cancel(job.id)
+
+    def test_cancel_pending_job(self):
+        """開始前のジョブはその場でキャンセルされるテスト"""
+        manager = JobManager(max_workers=1, kind_workers={})
+        release = threading.Event()
+        try:
+            manager.submit("session-a", "execute", lambda job: release.wait(5))
+            pending = manager.submit("session-b", "execute", lambda job: "done")
+            assert manager.cancel(pending.id)
+            assert pending.status == CANCELLED
+        finally:
+            release.set()
+            manager.shutdown()
+
+    def test_kinds_use_separate_pools(self):
+        """生成ジョブでワーカーが埋まっても実行ジョブは待たされないテスト"""
+        manager = JobManager(max_workers=1, kind_workers={})
+        release = threading.Event()
+        try:
+            running = manager.submit(
+                "session-a", "generate", lambda job: release.wait(5)
+            )
+            waiting = manager.submit(
+                "session-b", "generate", lambda job: release.wait(5)
+            )
+            execution = manager.submit("session-c", "execute", lambda job: "done")
+            wait_until_done(execution)
+            assert execution.result == "done"
+            assert waiting.status == PENDING
+            assert waiting.elapsed() == 0
+            assert waiting.queued_for() > 0
+            release.set()
+            wait_until_done(waiting)
+            assert running.status == DONE
+        finally:
+            release.set()
+            manager.shutdown()
+
+    def test_jobs_are_isolated_by_session(self, manager):
+        """ジョブがセッションごとに管理されるテスト"""
+        job_a = manager.submit("session-a", "execute", lambda job: "a")
+        job_b = manager.submit("session-b", "execute", lambda job: "b")
+        wait_until_done(job_a)
+        wait_until_done(job_b)
+
+        assert manager.latest("session-a", "execute") is job_a
+        assert manager.latest("session-b", "execute") is job_b
+        assert manager.latest("session-a", "generate") is None
+
+        manager.clear_session("session-a")
+        assert manager.session_jobs("session-a") == []
+        assert manager.get(job_b.id) is job_b
+
+    def test_resubmit_cancels_previous(self, manager):
+        """同じ種類のジョブを再登録すると前のジョブがキャンセルされるテスト"""
+
+        def work(job):
+            while not job.cancelled():
+                time.sleep(0.01)
+            return "stale"
+
+        first = manager.submit("session-a", "generate", work)
+        second = manager.submit("session-a", "generate", lambda job: "fresh")
+        wait_until_done(first)
+        wait_until_done(second)
+
+        assert first.status == CANCELLED
+        assert first.result is None
+        assert second.result == "fresh"
+        assert manager.latest("session-a", "generate") is second
+
+    def test_prune_finished_jobs(self):
+        """保持期間を過ぎた終了済みのジョブが削除されるテスト"""
+        manager = JobManager(max_workers=1, retention=0)
+        try:
+            old = manager.submit("session-a", "execute", lambda job: 1)
+            wait_until_done(old)
+            time.sleep(0.01)
+            manager.submit("session-a", "execute", lambda job: 2)
+            assert manager.get(old.id) is None
+            assert manager.stats()[DONE] + manager.stats()["running"] <= 1
+        finally:
+            manager.shutdown()
@@ -0,0 +1,171 @@
+import re
+import socket
+import time
+import urllib.request
+from unittest.mock import patch
+
+import pytest
+from PIL import Image
+
+from app.utils import metrics
+from app.utils.admission import AdmissionCancelledError
+from app.utils.code_executor import cached_detect_raw, execute_code
+from app.utils.detector_backend import SyntheticBackend, use_detector_backend
+from app.utils.image_cache import set_content_hash
+from app.utils.metrics import (
+    DETECT_SECONDS,
+    EXECUTIONS_TOTAL,
+    Counter,
+    Gauge,
+    Histogram,
+    MetricsRegistry,
+    render_metrics,
+)
+
+CODE = "def execute_command(image_path, image):\n    return 0\n"
+
+
+@pytest.fixture(autouse=True)
+def reset_metrics():
+    """共有レジストリの値をテストごとにリセット"""
+    metrics.REGISTRY.clear()
+    yield
+    metrics.REGISTRY.clear()
+
+
+def sample_value(text, sample):
+    """テキスト形式の出力からサンプルの値を取り出す"""
+    match = re.search(rf"^{re.escape(sample)} (\S+)$", text, re.MULTILINE)
+    return float(match.group(1)) if match else None
+
+
+class TestMetricTypes:
+    """メトリクスの型とテキスト形式のテスト"""
+
+    def test_counter_and_gauge(self):
+        """カウンタとゲージがラベルごとに出力されるテスト"""
+        registry = MetricsRegistry()
+        counter = registry.register(Counter("c_total", "count", ["status"]))
+        gauge = registry.register(Gauge("g", "gauge"))
+        counter.inc(status="ok")
+        counter.inc(2, status="ok")
+        counter.inc(status='say "hi"')
+        gauge.set(5)
+
+        text = registry.render()
+        assert "# TYPE c_total counter" in text
+        assert sample_value(text, 'c_total{status="ok"}') == 3
+        assert 'c_total{status="say \\"hi\\""} 1.0' in text
+        assert sample_value(text, "g") == 5
+
+    def test_histogram_buckets(self):
+        """ヒストグラムが累積バケット・合計・件数を出力するテスト"""
+        registry = MetricsRegistry()
+        histogram = registry.register(Histogram("h_seconds", "h", buckets=(0.1, 1)))
+        for value in (0.05, 0.5, 5):
+            histogram.observe(value)
+
+        text = registry.render()
+        assert sample_value(text, 'h_seconds_bucket{le="0.1"}') == 1
+        assert sample_value(text, 'h_seconds_bucket{le="1.0"}') == 2
+        assert sample_value(text, 'h_seconds_bucket{le="+Inf"}') == 3
+        assert sample_value(text, "h_seconds_sum") == pytest.approx(5.55)
+        assert sample_value(text, "h_seconds_count") == 3
+
+    def test_wrong_labels(self):
+        """定義と異なるラベルを指定するとエラーになるテスト"""
+        with pytest.raises(ValueError):
+            Counter("c_total", "count", ["status"]).inc(kind="x")
+
+    def test_failing_collector_is_skipped(self):
+        """失敗したコレクタがあっても他のメトリクスを出力するテスト"""
+        registry = MetricsRegistry()
+        registry.register(Gauge("g", "gauge")).set(1)
+        registry.add_collector(lambda: 1 / 0)
+        assert sample_value(registry.render(), "g") == 1
+
+
+class TestApplicationMetrics:
+    """アプリケーションのメトリクスのテスト"""
+
+    def test_execution_counters(self, sample_image_path):
+        """実行回数がステータスとキャッシュの有無ごとに数えられるテスト"""
+        with patch(
+            "app.utils.code_executor.execute_function_from_code",
+            return_value=(0, ""),
+        ):
+            execute_code(CODE, sample_image_path)
+            execute_code(CODE, sample_image_path)
+        execute_code("def broken(", sample_image_path, use_cache=False)
+
+        assert EXECUTIONS_TOTAL.value(status="success", cached="false") == 1
+        assert EXECUTIONS_TOTAL.value(status="success", cached="true") == 1
+        assert EXECUTIONS_TOTAL.value(status="error", cached="false") == 1
+
+    def test_cancelled_execution_is_counted(self, sample_image_path):
+        """受け付けを待つ間にキャンセルされた実行もcancelledとして数えられるテスト"""
+        with patch(
+            "app.utils.code_executor._admitted_run",
+            side_effect=AdmissionCancelledError("cancelled"),
+        ):
+            result = execute_code(CODE, sample_image_path)
+
+        assert result["error_type"] == "cancelled"
+        assert EXECUTIONS_TOTAL.value(status="cancelled", cached="false") == 1
+
+    def test_detect_latency_by_source(self):
+        """検出の所要時間が推論・メモリキャッシュ別に記録されるテスト"""
+        image = Image.new("RGB", (100, 100))
+        set_content_hash(image, "hash")
+        raw = ([[1, 1, 5, 5]], [0.9], ["apple"])
+        with (
+            use_detector_backend(SyntheticBackend()),
+            patch("app.utils.code_executor.get_detection_cache", return_value=None),
+            patch("app.utils.code_executor.detect_raw", return_value=raw),
+        ):
+            cached_detect_raw(image, "apple.", 0.3)
+            cached_detect_raw(image, "apple.", 0.3)
+
+        assert DETECT_SECONDS.count(source="model") == 1
+        assert DETECT_SECONDS.count(source="memory") == 1
+
+    def test_render_includes_gauges(self):
+        """RSS・キャッシュのヒット率・ジョブ数などの現在値を出力するテスト"""
+        text = render_metrics()
+        assert sample_value(text, "ad_process_resident_memory_bytes") > 0
+        assert 'ad_cache_hit_ratio{cache="result"}' in text
+        assert 'ad_jobs{status="pending"}' in text
+        assert "ad_executions_coalesced_total" in text
+        assert "# TYPE ad_detect_seconds histogram" in text
+
+
+class TestMetricsServer:
+    """メトリクスのサーバーのテスト"""
+
+    def test_disabled_without_port(self):
+        """ポートが未設定の場合はサーバーを起動しないテスト"""
+        with patch.object(metrics, "METRICS_PORT", ""):
+            assert metrics.start_metrics_server() is None
+
+    def test_serves_metrics(self, monkeypatch):
+        """/metrics でテキスト形式のメトリクスを返すテスト"""
+        with socket.socket() as sock:
+            sock.bind(("127.0.0.1", 0))
+            port = sock.getsockname()[1]
+        monkeypatch.setattr(metrics, "_metrics_server", None)
+
+        server = metrics.start_metrics_server(port=port, host="127.0.0.1")
+        try:
+            assert metrics.start_metrics_server(port=port) is server
+            deadline = time.monotonic() + 10
+            while not server.started and time.monotonic() < deadline:
+                time.sleep(0.05)
+            url = f"http://127.0.0.1:{port}/metrics"
+            with urllib.request.urlopen(url, timeout=5) as response:
+                body = response.read().decode("utf-8")
+                content_type = response.headers["Content-Type"]
+        finally:
+            server.should_exit = True
+
+        assert content_type.startswith("text/plain; version=0.0.4")
+        assert "ad_process_resident_memory_bytes" in body
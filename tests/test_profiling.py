@@ -0,0 +1,88 @@
+import os
+import sys
+
+import pytest
+
+from app.utils.code_executor import execute_code
+from app.utils.detector_backend import SyntheticBackend, use_detector_backend
+from app.utils.profiling import (
+    format_hotspots,
+    normalize_profilers,
+    profile_execution,
+)
+
+
+def busy_function():
+    return sum(i * i for i in range(20000))
+
+
+class TestProfileExecution:
+    """実行のプロファイリングのテスト"""
+
+    def test_normalize_profilers(self):
+        """プロファイラの指定の正規化のテスト"""
+        assert normalize_profilers(None) == ()
+        assert normalize_profilers(True) == ("cprofile",)
+        assert normalize_profilers("torch") == ("torch",)
+        assert normalize_profilers(["torch", "cprofile"]) == ("cprofile", "torch")
+        assert normalize_profilers("all") == ("cprofile", "torch")
+        with pytest.raises(ValueError):
+            normalize_profilers("perf")
+
+    def test_disabled_installs_no_profiler(self):
+        """指定しない場合はプロファイラを設定しないテスト"""
+        with profile_execution(None) as report:
+            assert sys.getprofile() is None
+            busy_function()
+        assert report["hotspots"] == {}
+        assert report["files"] == {}
+
+    def test_cprofile_hotspots_and_file(self, tmp_path):
+        """cProfileの上位の関数とプロファイルのファイルのテスト"""
+        with profile_execution("cprofile", str(tmp_path / "run")) as report:
+            busy_function()
+
+        names = [row["function"] for row in report["hotspots"]["cprofile"]]
+        assert any(name.startswith("busy_function") for name in names)
+        assert report["files"]["cprofile"] == str(tmp_path / "run.prof")
+        assert os.path.getsize(report["files"]["cprofile"]) > 0
+        assert "cumtime_ms" in format_hotspots(report["hotspots"]["cprofile"])
+
+    def test_profile_saved_on_error(self, tmp_path):
+        """例外で終了した場合もそこまでのプロファイルを保存するテスト"""
+        with (
+            pytest.raises(RuntimeError),
+            profile_execution("cprofile", str(tmp_path / "run")) as report,
+        ):
+            busy_function()
+            raise RuntimeError("failed")
+        assert os.path.exists(report["files"]["cprofile"])
+
+    def test_overlapping_profile_is_skipped(self):
+        """プロファイル中に重なった実行はプロファイルせずに実行するテスト"""
+        with profile_execution("cprofile"), profile_execution("cprofile") as inner:
+            busy_function()
+        assert "error" in inner
+        assert inner["hotspots"] == {}
+
+    def test_execute_code_with_profile(self, valid_test_code, tmp_path):
+        """execute_codeのprofileで実行ごとのプロファイルを返すテスト"""
+        backend = SyntheticBackend(
+            script={"apple": [([0, 0, 10, 10], 0.9), ([20, 0, 30, 10], 0.8)]}
+        )
+        with use_detector_backend(backend):
+            cached = execute_code(valid_test_code)
+            result = execute_code(
+                valid_test_code,
+                profile="all",
+                profile_path=str(tmp_path / "profile"),
+            )
+
+        assert "profile" not in cached
+        assert result["status"] == "success"
+        assert "cached" not in result  # キャッシュを使わずに実行する
+        profile = result["profile"]
+        assert set(profile["files"]) == {"cprofile", "torch"}
+        assert all(os.path.exists(path) for path in profile["files"].values())
+        names = [row["function"] for row in profile["hotspots"]["cprofile"]]
+        assert any(name.startswith("execute_command") for name in names)
@@ -0,0 +1,56 @@
+import re
+
+from app.utils.prompt_builder import (
+    FewShotSelector,
+    get_fewshot_selector,
+    split_template,
+    tokenize,
+)
+from app.utils.template_prompt import prompt
+
+
+class TestPromptBuilder:
+    """few-shot例の選択のテスト"""
+
+    def test_split_template(self):
+        """テンプレートを説明部分と例に分割できるテスト"""
+        header, examples = split_template()
+
+        assert header.endswith("Some examples:\n")
+        assert len(examples) == 13
+        assert examples[0][0] == (
+            "There are two [apples] on the left side of the image."
+        )
+        assert header + "".join(block for _, block in examples) == prompt
+
+    def test_tokenize_maps_japanese_concepts(self):
+        """日本語と英語の表現が共通の概念トークンになるテスト"""
+        assert "<left>" in tokenize("左側にリンゴが2つ")
+        assert "<left>" in tokenize("on the left side")
+        assert "<color>" in tokenize("チョコレートは白い")
+        assert "apple" in tokenize("two [apples]")
+
+    def test_select_relevant_examples(self):
+        """条件に近い例が選ばれるテスト"""
+        selector = get_fewshot_selector()
+
+        color = selector.select("- The [chocolate] in the image is white.", k=2)
+        assert 10 in color  # Normal_condition11（チョコレートの色）
+
+        position = selector.select("- 左側に[りんご]が2つあること", k=2)
+        assert 0 in position  # Normal_condition1（左側のりんご）
+
+    def test_select_returns_all_when_disabled_or_unrelated(self):
+        """k=0や類似する例がない場合はすべての例を使うテスト"""
+        selector = get_fewshot_selector()
+        everything = list(range(len(selector.examples)))
+
+        assert selector.select("two apples", k=0) == everything
+        assert selector.select("ゼブラ", k=3) == everything
+
+    def test_build_shrinks_prompt(self):
+        """選んだ例だけでプロンプトが作られるテスト"""
+        header, examples = FewShotSelector().build("There are 3 [apples].", k=3)
+
+        assert len(re.findall(r"Normal_condition\d+:", examples)) == 3
+        assert len(header) + len(examples) < len(prompt)
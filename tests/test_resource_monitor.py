@@ -0,0 +1,93 @@
+import time
+from unittest.mock import patch
+
+from app.utils.code_executor import check_memory_usage
+from app.utils.resource_monitor import ResourceMonitor
+
+
+class TestResourceMonitor:
+    """リソース使用量のサンプラーのテスト"""
+
+    def test_sample_fields(self):
+        """1回のサンプルに必要な項目が含まれるテスト"""
+        monitor = ResourceMonitor(interval=0.05)
+        record = monitor.sample()
+        assert set(record) == {
+            "time",
+            "memory_percent",
+            "available_bytes",
+            "rss_bytes",
+            "cpu_percent",
+            "process_cpu_percent",
+        }
+        assert record["rss_bytes"] > 0
+        assert monitor.latest() == record
+
+    def test_ring_buffer(self):
+        """保持するサンプル数を超えたら古いものから捨てるテスト"""
+        monitor = ResourceMonitor(interval=0.05, history_size=3)
+        for _ in range(5):
+            monitor.sample()
+        history = monitor.history()
+        assert len(history) == 3
+        assert [r["time"] for r in history] == sorted(r["time"] for r in history)
+
+    def test_background_sampling(self):
+        """スレッドが定期的にサンプルを記録し、停止できるテスト"""
+        monitor = ResourceMonitor(interval=0.02)
+        monitor.start()
+        try:
+            deadline = time.time() + 2
+            while len(monitor.history()) < 3 and time.time() < deadline:
+                time.sleep(0.01)
+            assert len(monitor.history()) >= 3
+            assert monitor.is_fresh()
+        finally:
+            monitor.stop(timeout=1)
+        assert not monitor.running
+        assert not monitor.is_fresh()
+
+    def test_smoothed_average(self):
+        """直近の期間のサンプルの平均を返すテスト"""
+        monitor = ResourceMonitor(interval=1.0)
+        assert monitor.smoothed() is None
+        now = time.time()
+        for percent, offset in ((90.0, 60), (40.0, 2), (60.0, 1)):
+            record = monitor.sample()
+            record.update(time=now - offset, memory_percent=percent)
+            monitor._samples[-1] = record
+        assert monitor.smoothed(window=5)["memory_percent"] == 50.0
+
+
+class TestCheckMemoryUsageWithMonitor:
+    """check_memory_usageがサンプラーの記録を使うテスト"""
+
+    def test_uses_sampler_when_running(self):
+        """サンプラーの動作中はpsutilを呼ばずに直近の平均を使うテスト"""
+        monitor = ResourceMonitor(interval=0.02)
+        monitor.start()
+        try:
+            deadline = time.time() + 2
+            while monitor.latest() is None and time.time() < deadline:
+                time.sleep(0.01)
+            with (
+                patch("app.utils.code_executor.get_resource_monitor") as get_monitor,
+                patch("app.utils.code_executor.psutil.virtual_memory") as memory,
+            ):
+                get_monitor.return_value = monitor
+                result = check_memory_usage()
+        finally:
+            monitor.stop(timeout=1)
+
+        memory.assert_not_called()
+        assert 0 <= result["percent_used"] <= 100
+        assert result["available_gb"] > 0
+
+    def test_falls_back_when_stopped(self):
+        """サンプラーが止まっている場合はその場で取得するテスト"""
+        monitor = ResourceMonitor(interval=0.02)
+        monitor.sample()
+        with patch("app.utils.code_executor.get_resource_monitor") as get_monitor:
+            get_monitor.return_value = monitor
+            result = check_memory_usage()
+        assert isinstance(result["warning"], bool)
@@ -0,0 +1,117 @@
+from unittest.mock import patch
+
+import pytest
+
+from app.utils.code_executor import execute_code
+from app.utils.result_cache import ExecutionResultCache, make_result_key
+
+TEST_CODE = """
+def execute_command(image_path, image):
+    print("counted")
+    return 0
+"""
+
+
+class TestExecutionResultCache:
+    """実行結果キャッシュのテスト"""
+
+    def test_key_depends_on_all_inputs(self):
+        """コード・画像・しきい値・モデルのいずれかが違えばキーが変わることのテスト"""
+        base = make_result_key("code", "img", 0.3, "model")
+
+        assert base == make_result_key("code", "img", 0.3, "model")
+        assert base != make_result_key("code2", "img", 0.3, "model")
+        assert base != make_result_key("code", "img2", 0.3, "model")
+        assert base != make_result_key("code", "img", 0.4, "model")
+        assert base != make_result_key("code", "img", 0.3, "model2")
+        assert base != make_result_key("code", "img", 0.3, "model", tiled=True)
+
+    def test_get_marks_result_as_cached_copy(self):
+        """取得した結果がcached=Trueのコピーであることのテスト"""
+        cache = ExecutionResultCache()
+        cache.put("key", {"status": "success", "output_text": "x"})
+
+        result = cache.get("key")
+        result["output_text"] = "changed"
+
+        assert result["cached"] is True
+        assert cache.get("key")["output_text"] == "x"
+
+    def test_ttl_expiry(self):
+        """有効期限を過ぎた結果が返されないことのテスト"""
+        cache = ExecutionResultCache(ttl=10)
+        with patch("app.utils.cache.time.monotonic", return_value=100.0):
+            cache.put("key", {"status": "success"})
+        with patch("app.utils.cache.time.monotonic", return_value=111.0):
+            assert cache.get("key") is None
+
+    def test_invalidate_session(self):
+        """セッション単位で結果を無効化できることのテスト"""
+        cache = ExecutionResultCache()
+        cache.put("a", {"status": "success"}, session_id="s1")
+        cache.put("b", {"status": "success"}, session_id="s2")
+        cache.get("b", session_id="s1")
+
+        assert cache.invalidate_session("s1") == 2
+        assert cache.get("a") is None
+        assert cache.get("b") is None
+
+    def test_evicted_keys_leave_session_records(self):
+        """追い出された結果のキーがセッションの記録から消えることのテスト"""
+        cache = ExecutionResultCache(max_entries=2)
+        cache.put("a", {"status": "success"}, session_id="s1")
+        for key in ("b", "c", "d"):
+            cache.put(key, {"status": "success"}, session_id="s2")
+
+        assert cache._session_keys == {"s2": {"c", "d"}}
+
+
+class TestExecuteCodeMemoization:
+    """execute_codeのメモ化のテスト"""
+
+    @pytest.fixture
+    def fake_detect(self):
+        with patch("app.utils.code_executor.detect", return_value=[]) as mock:
+            yield mock
+
+    def test_second_execution_is_served_from_cache(
+        self, sample_image_path, fake_detect
+    ):
+        """同じ条件の2回目の実行がキャッシュから返されることのテスト"""
+        with patch(
+            "app.utils.code_executor.execute_function_from_code",
+            return_value=(0, "counted\n"),
+        ) as mock_run:
+            first = execute_code(TEST_CODE, sample_image_path, 0.3, session_id="s")
+            second = execute_code(TEST_CODE, sample_image_path, 0.3, session_id="s")
+
+        assert mock_run.call_count == 1
+        assert "cached" not in first
+        assert second["cached"] is True
+        assert second["output_text"] == first["output_text"]
+
+    def test_changed_threshold_or_disabled_cache_recomputes(
+        self, sample_image_path, fake_detect
+    ):
+        """しきい値の変更やuse_cache=Falseで再計算されることのテスト"""
+        with patch(
+            "app.utils.code_executor.execute_function_from_code",
+            return_value=(1, ""),
+        ) as mock_run:
+            execute_code(TEST_CODE, sample_image_path, 0.3)
+            execute_code(TEST_CODE, sample_image_path, 0.5)
+            execute_code(TEST_CODE, sample_image_path, 0.3, use_cache=False)
+
+        assert mock_run.call_count == 3
+
+    def test_errors_are_not_cached(self, sample_image_path, fake_detect):
+        """エラー結果はキャッシュされないことのテスト"""
+        with patch(
+            "app.utils.code_executor.execute_function_from_code",
+            side_effect=RuntimeError("boom"),
+        ) as mock_run:
+            execute_code(TEST_CODE, sample_image_path)
+            result = execute_code(TEST_CODE, sample_image_path)
+
+        assert mock_run.call_count == 2
+        assert result["status"] == "error"
@@ -211,6 +211,20 @@ class TestSecurityIsolation(unittest.TestCase):
             self.assertFalse(mock_session_state.get("api_key_set", False))
             self.assertNotIn("encrypted_api_key", mock_session_state)
 
+    def test_session_cleanup_calls_on_cleanup(self):
+        """セッションのクリーンアップ時にセッションIDでコールバックが呼ばれるテスト"""
+        mock_session_state = MockSessionState()
+        on_cleanup = MagicMock()
+
+        with patch("app.security.session_manager.st.session_state", mock_session_state):
+            manager = SecureSessionManager(on_cleanup=on_cleanup)
+            session_id = mock_session_state._data["secure_session_id"]
+
+            with patch("app.security.session_manager.shutil.rmtree"):
+                manager.cleanup_session()
+
+        on_cleanup.assert_called_once_with(session_id)
+
     def test_session_migration(self):
         """セッション移行テスト"""
         mock_session_state = MockSessionState(
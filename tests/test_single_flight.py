@@ -0,0 +1,205 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from unittest.mock import patch
+
+import numpy as np
+import pytest
+from PIL import Image
+
+from app.utils.code_executor import execute_code
+from app.utils.single_flight import (
+    FlightCancelledError,
+    SingleFlight,
+    get_single_flight,
+)
+
+
+class TestSingleFlight:
+    """同一リクエストの実行共有のテスト"""
+
+    def test_concurrent_calls_share_one_execution(self):
+        """同じキーの同時呼び出しが1回の実行を共有するテスト"""
+        flight = SingleFlight()
+        calls = []
+        release = threading.Event()
+
+        def work():
+            calls.append(1)
+            release.wait(5)
+            return {"score": 0}
+
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            futures = [executor.submit(flight.do, "key", work) for _ in range(4)]
+            # 全員が待ち始めるまで待つ
+            deadline = time.monotonic() + 5
+            while flight.stats()["coalesced"] < 3 and time.monotonic() < deadline:
+                time.sleep(0.01)
+            release.set()
+            results = [future.result() for future in futures]
+
+        assert len(calls) == 1
+        assert all(result == {"score": 0} for result, _ in results)
+        assert sorted(shared for _, shared in results) == [False, True, True, True]
+        assert flight.stats() == {"in_flight": 0, "executed": 1, "coalesced": 3}
+
+    def test_different_keys_run_separately(self):
+        """キーが異なる呼び出しは別々に実行されるテスト"""
+        flight = SingleFlight()
+        assert flight.do("a", lambda: 1) == (1, False)
+        assert flight.do("b", lambda: 2) == (2, False)
+        # 完了後の同じキーは新たに実行される
+        assert flight.do("a", lambda: 3) == (3, False)
+        assert flight.stats()["coalesced"] == 0
+
+    def test_error_is_shared(self):
+        """実行中の例外が待っていた呼び出しにも伝わるテスト"""
+        flight = SingleFlight()
+        started = threading.Event()
+        release = threading.Event()
+
+        def fail():
+            started.set()
+            release.wait(5)
+            raise RuntimeError("失敗")
+
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            leader = executor.submit(flight.do, "key", fail)
+            started.wait(5)
+            follower = executor.submit(flight.do, "key", fail)
+            while flight.stats()["coalesced"] < 1:
+                time.sleep(0.01)
+            release.set()
+            for future in (leader, follower):
+                with pytest.raises(RuntimeError, match="失敗"):
+                    future.result()
+        assert flight.in_flight() == 0
+
+    def test_retry_on_error_is_not_shared(self):
+        """retry_onの例外は共有せず、待っていた呼び出しが改めて実行するテスト"""
+        flight = SingleFlight()
+        started = threading.Event()
+        release = threading.Event()
+
+        def cancelled():
+            started.set()
+            release.wait(5)
+            raise TimeoutError("先頭の呼び出しだけのエラー")
+
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            leader = executor.submit(
+                flight.do, "key", cancelled, retry_on=(TimeoutError,)
+            )
+            started.wait(5)
+            follower = executor.submit(
+                flight.do, "key", lambda: "follower", retry_on=(TimeoutError,)
+            )
+            while flight.stats()["coalesced"] < 1:
+                time.sleep(0.01)
+            release.set()
+            with pytest.raises(TimeoutError):
+                leader.result()
+            assert follower.result() == ("follower", False)
+        assert flight.stats()["executed"] == 2
+
+    def test_progress_reaches_followers(self):
+        """実行中の途中経過が待っている呼び出しにも知らされるテスト"""
+        flight = SingleFlight()
+        started = threading.Event()
+        release = threading.Event()
+        leader_progress = []
+        follower_progress = []
+
+        def work():
+            flight.progress("key", 2)
+            started.set()
+            release.wait(5)
+            flight.progress("key", 0)
+            return 1
+
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            leader = executor.submit(
+                flight.do, "key", work, on_progress=leader_progress.append
+            )
+            started.wait(5)
+            follower = executor.submit(
+                flight.do, "key", work, on_progress=follower_progress.append
+            )
+            while flight.stats()["coalesced"] < 1:
+                time.sleep(0.01)
+            release.set()
+            assert leader.result() == (1, False)
+            assert follower.result() == (1, True)
+
+        assert leader_progress == [2, 0]
+        # 参加した時点の途中経過から知らされる
+        assert follower_progress == [2, 0]
+
+    def test_follower_can_stop_waiting(self):
+        """待っている呼び出しはshould_stopで待つのをやめられるテスト"""
+        flight = SingleFlight()
+        started = threading.Event()
+        release = threading.Event()
+        stop = threading.Event()
+
+        def work():
+            started.set()
+            release.wait(5)
+            return 1
+
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            leader = executor.submit(flight.do, "key", work)
+            started.wait(5)
+            follower = executor.submit(
+                flight.do,
+                "key",
+                work,
+                should_stop=stop.is_set,
+                poll_interval=0.01,
+            )
+            while flight.stats()["coalesced"] < 1:
+                time.sleep(0.01)
+            stop.set()
+            with pytest.raises(FlightCancelledError):
+                follower.result(5)
+            release.set()
+            assert leader.result() == (1, False)
+
+    def test_execute_code_coalesces_identical_requests(self, sample_image_path):
+        """execute_codeの同一リクエストが1回の実行にまとめられるテスト"""
+        code = "def execute_command(image_path, image):\n    return 0\n"
+        executions = []
+        release = threading.Event()
+
+        def slow_run(*args, **kwargs):
+            executions.append(args)
+            release.wait(5)
+            return (0, "")
+
+        dummy_image = Image.fromarray(np.zeros((10, 10, 3), dtype=np.uint8))
+        with (
+            patch(
+                "app.utils.code_executor.execute_function_from_code",
+                side_effect=slow_run,
+            ),
+            patch("app.utils.code_executor.load_image", return_value=dummy_image),
+            ThreadPoolExecutor(max_workers=3) as executor,
+        ):
+            futures = [
+                executor.submit(
+                    execute_code, code, sample_image_path, 0.3, use_cache=False
+                )
+                for _ in range(3)
+            ]
+            deadline = time.monotonic() + 5
+            while (
+                get_single_flight().stats()["coalesced"] < 2
+                and time.monotonic() < deadline
+            ):
+                time.sleep(0.01)
+            release.set()
+            results = [future.result() for future in futures]
+
+        assert len(executions) == 1
+        assert all(result["status"] == "success" for result in results)
+        assert get_single_flight().stats()["coalesced"] == 2
@@ -0,0 +1,102 @@
+import threading
+from unittest.mock import patch
+
+from app.utils.code_executor import execute_code
+from app.utils.detector_backend import SyntheticBackend, use_detector_backend
+from app.utils.timing import format_timings, record_timeline, span
+
+
+class TestTiming:
+    """段階ごとの所要時間の計測のテスト"""
+
+    def test_nested_spans(self):
+        """入れ子の区間が開始順・階層付きで記録されるテスト"""
+        with record_timeline() as timeline:
+            with span("program"):
+                with span("find", detail="apple"):
+                    with span("forward"):
+                        pass
+                with span("find", detail="banana"):
+                    pass
+
+        spans = timeline.to_list()
+        assert [(s["name"], s["depth"]) for s in spans] == [
+            ("program", 0),
+            ("find", 1),
+            ("forward", 2),
+            ("find", 1),
+        ]
+        assert spans[1]["detail"] == "apple"
+        assert spans[0]["ms"] >= spans[1]["ms"] >= spans[2]["ms"] >= 0
+
+    def test_span_without_timeline(self):
+        """計測中でない場合は何も記録せずに処理を実行するテスト"""
+        executed = []
+        with span("program"):
+            executed.append(1)
+        assert executed == [1]
+
+    def test_timelines_are_per_thread(self):
+        """別のスレッドの区間が混ざらないテスト"""
+        other = []
+
+        def worker():
+            with record_timeline() as timeline:
+                with span("other"):
+                    pass
+            other.extend(timeline.to_list())
+
+        with record_timeline() as timeline:
+            thread = threading.Thread(target=worker)
+            thread.start()
+            thread.join()
+            with span("mine"):
+                pass
+
+        assert [s["name"] for s in timeline.to_list()] == ["mine"]
+        assert [s["name"] for s in other] == ["other"]
+
+    def test_format_timings(self):
+        """階層をインデントで表したテキストにするテスト"""
+        text = format_timings(
+            [
+                {"name": "program", "start_ms": 0, "ms": 12.5, "depth": 0},
+                {
+                    "name": "find",
+                    "start_ms": 1,
+                    "ms": 10.0,
+                    "depth": 1,
+                    "detail": "apple",
+                },
+            ]
+        )
+        lines = text.splitlines()
+        assert lines[0].startswith("program")
+        assert lines[1].startswith("  find (apple)")
+        assert lines[1].endswith("10.0 ms")
+
+    def test_execute_code_reports_find_spans(self, sample_image_path):
+        """execute_codeの結果にfind()ごとの区間が含まれるテスト"""
+        code = (
+            "def execute_command(image_path, image):\n"
+            "    image_patch = ImagePatch(image)\n"
+            "    image_patch.find('apple')\n"
+            "    image_patch.find('banana')\n"
+            "    return 0\n"
+        )
+        raw = ([[1, 1, 5, 5]], [0.9], ["apple"])
+        with (
+            use_detector_backend(SyntheticBackend()),
+            patch("app.utils.code_executor.detect_raw", return_value=raw),
+        ):
+            result = execute_code(code, sample_image_path, use_cache=False)
+
+        assert result["status"] == "success"
+        spans = result["timings"]
+        assert [s["name"] for s in spans if s["depth"] == 0] == [
+            "image_load",
+            "program",
+        ]
+        finds = [s for s in spans if s["name"] == "find"]
+        assert [s["detail"] for s in finds] == ["apple", "banana"]
+        assert all(s["depth"] == 1 for s in finds)